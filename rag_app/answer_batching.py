@@ -0,0 +1,192 @@
+import threading
+
+from django.conf import settings
+
+from .embedding import get_embedding_engine
+from .registry import get_registry
+from .retrieval import retrieve_many
+
+
+class _SearchRequest:
+    def __init__(self, documents, question, k):
+        self.documents = documents
+        self.question = question
+        self.k = k
+        self.done = threading.Event()
+        self.question_vector = None
+        self.retrieved = None
+        self.error = None
+
+
+class _SharedGeneration:
+    """
+    一次進行中的生成：帶頭的請求依序寫入事件，共用這次生成的其他請求從頭重播並等待後續事件。
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._events = []
+        self._finished = False
+        self._error = None
+
+    def publish(self, kind, value):
+        with self._cond:
+            self._events.append((kind, value))
+            self._cond.notify_all()
+
+    def finish(self, error=None):
+        with self._cond:
+            self._finished = True
+            self._error = error
+            self._cond.notify_all()
+
+    def follow(self):
+        position = 0
+        while True:
+            with self._cond:
+                while position >= len(self._events) and not self._finished:
+                    self._cond.wait()
+                events = self._events[position:]
+                finished, error = self._finished, self._error
+            yield from events
+            position += len(events)
+            if finished and position >= len(self._events):
+                if error is not None:
+                    raise RuntimeError(f"共用的生成失敗: {error}")
+                return
+
+
+class AnswerBatcher:
+    """
+    Worker 進程內的問答微批次層 (以 threads pool 運行時，同一進程內並行的問答任務才能在這裡會合)。
+
+    - search：短時間窗口內到達的問題合併成一次嵌入計算，再以 retrieve_many 一起檢索 (同一 Collection 合併成多向量查詢)。
+    - answer：相同文件 (與版本) 上正規化後相同、且仍在生成中的問題共用同一次生成，後到的請求重播並等待相同的事件。
+    進程內只有一個問答在進行時不等待窗口，直接計算。
+    """
+
+    def __init__(self, embedder, window_seconds=0.02, max_batch_size=32):
+        self.embedder = embedder
+        self.window_seconds = window_seconds
+        self.max_batch_size = max(1, max_batch_size)
+        self._lock = threading.Lock()
+        self._encode_lock = threading.Lock()
+        self._pending = []
+        self._inflight = {}
+        self._active_answers = 0
+
+        self.search_requests = 0
+        self.search_batches = 0
+        self.coalesced_answers = 0
+
+    def search(self, documents, question, k):
+        """
+        回傳 (問題嵌入, 檢索結果)。
+        """
+        request = _SearchRequest(documents, question, k)
+        with self._lock:
+            self._pending.append(request)
+            self.search_requests += 1
+            leader = len(self._pending) == 1
+            flush_now = len(self._pending) >= self.max_batch_size or (leader and self._active_answers <= 1)
+        if flush_now:
+            self._flush()
+        elif leader and not request.done.wait(self.window_seconds):
+            self._flush()
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.question_vector, request.retrieved
+
+    def _flush(self):
+        with self._lock:
+            batch, self._pending = self._pending, []
+        if not batch:
+            return
+        try:
+            with self._encode_lock:
+                vectors = self.embedder.embed_documents([request.question for request in batch])
+            by_k = {}
+            for request, vector in zip(batch, vectors):
+                request.question_vector = vector
+                by_k.setdefault(request.k, []).append(request)
+            registry = get_registry()
+            for k, requests in by_k.items():
+                results = retrieve_many(
+                    registry, [(request.documents, request.question_vector, request.question) for request in requests], k
+                )
+                for request, retrieved in zip(requests, results):
+                    request.retrieved = retrieved
+            with self._lock:
+                self.search_batches += 1
+        except Exception as e:
+            for request in batch:
+                request.error = e
+        finally:
+            for request in batch:
+                request.done.set()
+
+    def answer(self, key, produce):
+        """
+        produce() 依序產出 (kind, value) 事件；相同 key 且仍在進行中的請求共用同一次 produce()，回傳事件的迭代器。
+        """
+        with self._lock:
+            self._active_answers += 1
+            generation = self._inflight.get(key)
+            leader = generation is None
+            if leader:
+                generation = self._inflight[key] = _SharedGeneration()
+            else:
+                self.coalesced_answers += 1
+        try:
+            if leader:
+                yield from self._lead(key, generation, produce)
+            else:
+                yield from generation.follow()
+        finally:
+            with self._lock:
+                self._active_answers -= 1
+
+    def _lead(self, key, generation, produce):
+        error = None
+        try:
+            for kind, value in produce():
+                generation.publish(kind, value)
+                yield kind, value
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            generation.finish(error)
+
+    def stats(self):
+        return {
+            'search_requests': self.search_requests,
+            'search_batches': self.search_batches,
+            'avg_batch_size': round(self.search_requests / self.search_batches, 2) if self.search_batches else None,
+            'coalesced_answers': self.coalesced_answers,
+            'inflight_answers': len(self._inflight),
+        }
+
+
+_answer_batcher = None
+_answer_batcher_lock = threading.Lock()
+
+
+def get_answer_batcher():
+    """
+    取得進程內共用的問答微批次層；RAG_ANSWER_BATCHING_ENABLED 為 False 時回傳 None。
+    """
+    global _answer_batcher
+    if not settings.RAG_ANSWER_BATCHING_ENABLED:
+        return None
+    with _answer_batcher_lock:
+        if _answer_batcher is None:
+            _answer_batcher = AnswerBatcher(
+                get_embedding_engine(),
+                window_seconds=settings.RAG_ANSWER_BATCH_WINDOW_MS / 1000,
+                max_batch_size=settings.RAG_ANSWER_BATCH_MAX_SIZE,
+            )
+    return _answer_batcher
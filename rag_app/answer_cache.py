@@ -0,0 +1,116 @@
+import hashlib
+import re
+import unicodedata
+
+import numpy as np
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+from .models import AnswerCacheEntry, Document
+
+
+def normalize_question(question):
+    """
+    正規化問題文字：NFKC、轉小寫、合併空白並去除結尾標點，讓只差在大小寫或標點的問題可以精確命中。
+    """
+    text = unicodedata.normalize('NFKC', question).lower()
+    text = re.sub(r'\s+', ' ', text).strip()
+    return text.rstrip('?？!！.。 ')
+
+
+def _question_hash(normalized_question):
+    return hashlib.sha256(normalized_question.encode('utf-8')).hexdigest()
+
+
+def _valid_entries(document):
+    return AnswerCacheEntry.objects.filter(document=document, index_version=document.index_version)
+
+
+def _record_hit(entry):
+    AnswerCacheEntry.objects.filter(pk=entry.pk).update(hit_count=F('hit_count') + 1, last_hit_at=timezone.now())
+
+
+def lookup_exact(document, question):
+    normalized = normalize_question(question)
+    entry = _valid_entries(document).filter(question_hash=_question_hash(normalized)).order_by('-created_at').first()
+    if entry is not None:
+        _record_hit(entry)
+    return entry
+
+
+def lookup_semantic(document, question_vector):
+    """
+    回傳與問題嵌入餘弦相似度最高且超過門檻的快取項目 (沒有則回傳 None)。
+    """
+    rows = list(
+        _valid_entries(document)
+        .exclude(question_embedding=None)
+        .order_by('-created_at')
+        .values_list('id', 'question_embedding')[:settings.RAG_ANSWER_CACHE_MAX_ENTRIES_PER_DOCUMENT]
+    )
+    if not rows:
+        return None
+
+    query = np.asarray(question_vector, dtype=np.float32)
+    query /= max(np.linalg.norm(query), 1e-12)
+    matrix = np.stack([np.frombuffer(bytes(blob), dtype=np.float32) for _, blob in rows])
+    matrix /= np.clip(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12, None)
+    similarities = matrix @ query
+    best = int(np.argmax(similarities))
+    if similarities[best] < settings.RAG_ANSWER_CACHE_SIMILARITY_THRESHOLD:
+        return None
+
+    entry = AnswerCacheEntry.objects.get(pk=rows[best][0])
+    _record_hit(entry)
+    return entry
+
+
+def lookup(document, question, question_vector=None, embedder=None):
+    """
+    先以正規化問題精確比對，未命中時再做語意比對；question_vector 未提供時以 embedder 計算 (embedder 為 None 則略過語意比對)。
+    """
+    if not settings.RAG_ANSWER_CACHE_ENABLED:
+        return None
+    entry = lookup_exact(document, question)
+    if entry is not None:
+        return entry
+    if question_vector is None and embedder is not None:
+        question_vector = embedder.embed_query(question)
+    if question_vector is None:
+        return None
+    return lookup_semantic(document, question_vector)
+
+
+def store(document, index_version, question, question_vector, answer, source_documents):
+    """
+    保存答案；index_version 為回答開始時文件的版本，若期間文件已重新向量化則不保存。
+    """
+    if not settings.RAG_ANSWER_CACHE_ENABLED:
+        return None
+    current_version = Document.objects.filter(pk=document.pk).values_list('index_version', flat=True).first()
+    if current_version != index_version:
+        return None
+    normalized = normalize_question(question)
+    entry = AnswerCacheEntry.objects.create(
+        document=document,
+        index_version=index_version,
+        normalized_question=normalized,
+        question_hash=_question_hash(normalized),
+        question_embedding=None if question_vector is None else np.asarray(question_vector, dtype=np.float32).tobytes(),
+        answer=answer,
+        source_documents=source_documents,
+    )
+
+    # 每個文件只保留最新的 N 筆，舊版本的項目一併清除
+    keep_ids = list(
+        AnswerCacheEntry.objects.filter(document=document, index_version=index_version).order_by('-created_at')
+        .values_list('id', flat=True)[:settings.RAG_ANSWER_CACHE_MAX_ENTRIES_PER_DOCUMENT]
+    )
+    AnswerCacheEntry.objects.filter(document=document).exclude(id__in=keep_ids).delete()
+    return entry
+
+
+def invalidate(document_id):
+    deleted, _ = AnswerCacheEntry.objects.filter(document_id=document_id).delete()
+    return deleted
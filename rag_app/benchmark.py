@@ -0,0 +1,620 @@
+import json
+import math
+import os
+import platform
+import random
+import re
+import string
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import numpy as np
+from celery import current_app
+from django.conf import settings
+from django.db import connection
+from django.test import Client
+from django.test.utils import override_settings
+
+from . import registry as registry_module
+from .embedding import get_embedding_engine
+from .models import Document, IngestBatch, QuestionAnswer
+from .registry import WorkerRegistry, get_registry
+from .tasks import answer_question_with_rag_task, parse_and_vectorize_document_task
+from .views import DocumentViewSet
+
+_SYLLABLES = ('ka', 'ri', 'mo', 'te', 'lu', 'sa', 'no', 'vi', 'de', 'ra', 'po', 'zen', 'tal', 'mir', 'gos', 'bel')
+_LINE_WIDTH = 90
+
+# 比較兩次結果時採用的指標與方向 (higher：越大越好；lower：越小越好)
+COMPARED_METRICS = {
+    ('ingest', 'chunks_per_second'): 'higher',
+    ('ingest', 'embeddings_per_second'): 'higher',
+    ('ingest', 'pages_per_second'): 'higher',
+    ('qa', 'answers_per_second'): 'higher',
+    ('qa', 'retrieval_hit_rate'): 'higher',
+    ('qa', 'retrieve_seconds.p50'): 'lower',
+    ('qa', 'retrieve_seconds.p95'): 'lower',
+    ('qa', 'retrieve_seconds.p99'): 'lower',
+    ('qa', 'total_seconds.p95'): 'lower',
+    ('qa', 'context_tokens_mean'): 'lower',
+    ('search', 'document.latency_seconds.p95'): 'lower',
+    ('search', 'corpus.latency_seconds.p95'): 'lower',
+    ('search', 'document.hit_rate'): 'higher',
+    ('resources', 'peak_rss_mb'): 'lower',
+    ('resources', 'index_disk_mb'): 'lower',
+}
+
+
+def _pdf_escape(text):
+    return text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+
+def write_text_pdf(path, pages):
+    """
+    寫出只含文字的最小 PDF (Helvetica，每頁一個內容串流，pages 為各頁的文字行)，pypdf 可以直接抽出文字。
+    """
+    objects = [b'<< /Type /Catalog /Pages 2 0 R >>', None, b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>']
+    kids = []
+    for lines in pages:
+        text = ''.join(f"({_pdf_escape(line)}) Tj T* " for line in lines)
+        stream = f"BT /F1 10 Tf 12 TL 50 760 Td {text}ET".encode('latin-1')
+        objects.append(b'<< /Length %d >>\nstream\n%s\nendstream' % (len(stream), stream))
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 3 0 R >> >> "
+            f"/Contents {len(objects)} 0 R >>".encode()
+        )
+        kids.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {len(pages)} >>".encode()
+
+    out = bytearray(b'%PDF-1.4\n')
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b'%d 0 obj\n%s\nendobj\n' % (number, body)
+    xref = len(out)
+    out += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    out += b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+    out += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref)
+    with open(path, 'wb') as f:
+        f.write(out)
+
+
+class SyntheticCorpus:
+    """
+    以固定亂數種子產生的合成 PDF 語料：每頁是合成詞彙組成的段落，部分頁面埋入一句「事實」(文件與頁碼對應的代碼)，
+    問題詢問這些代碼，可用來檢查檢索是否找回正確的頁面。相同參數產生的內容完全相同。
+    """
+
+    def __init__(self, documents, pages, words_per_page=300, facts_per_document=1, seed=0):
+        self.documents = documents
+        self.pages = pages
+        self.words_per_page = words_per_page
+        self.facts_per_document = max(1, min(facts_per_document, pages))
+        self.seed = seed
+        self.facts = [] # (文件序號, 頁碼, 代碼)
+
+    def _vocabulary(self, rng):
+        words = set()
+        while len(words) < 2000:
+            words.add(''.join(rng.choice(_SYLLABLES) for _ in range(rng.randint(2, 4))))
+        return sorted(words)
+
+    @staticmethod
+    def question(document_index, page):
+        return f"What is the access code for ledger {document_index:05d} section {page + 1}?"
+
+    def _page_lines(self, rng, vocabulary, fact):
+        sentences = []
+        words = 0
+        while words < self.words_per_page:
+            length = rng.randint(8, 16)
+            sentence = ' '.join(rng.choice(vocabulary) for _ in range(length))
+            sentences.append(sentence.capitalize() + '.')
+            words += length
+        if fact is not None:
+            sentences.insert(rng.randrange(len(sentences) + 1), fact)
+        lines, line = [], ''
+        for word in ' '.join(sentences).split(' '):
+            if line and len(line) + 1 + len(word) > _LINE_WIDTH:
+                lines.append(line)
+                line = word
+            else:
+                line = f"{line} {word}" if line else word
+        lines.append(line)
+        return lines
+
+    def generate(self, directory):
+        """
+        在 directory 下寫出所有文件，回傳各文件的路徑。
+        """
+        rng = random.Random(self.seed)
+        vocabulary = self._vocabulary(rng)
+        os.makedirs(directory, exist_ok=True)
+        paths = []
+        self.facts = []
+        for document_index in range(self.documents):
+            fact_pages = set(rng.sample(range(self.pages), self.facts_per_document))
+            pages = []
+            for page in range(self.pages):
+                fact = None
+                if page in fact_pages:
+                    code = ''.join(rng.choice(string.ascii_uppercase + string.digits) for _ in range(8))
+                    fact = f"The access code for ledger {document_index:05d} section {page + 1} is {code}."
+                    self.facts.append((document_index, page, code))
+                pages.append(self._page_lines(rng, vocabulary, fact))
+            path = os.path.join(directory, f"bench-{document_index:05d}.pdf")
+            write_text_pdf(path, pages)
+            paths.append(path)
+        return paths
+
+
+class ExtractiveLLM:
+    """
+    取代 Ollama 的決定性 LLM 替身：從 Prompt 的 Context 中挑出與問題共同詞最多的句子，逐詞串流回傳。
+    token_delay 可模擬生成速度 (秒/詞)；介面與統計欄位與 OllamaClient 相同。
+    """
+
+    def __init__(self, token_delay=0.0, max_parallel=4):
+        self.token_delay = token_delay
+        self.max_parallel = max_parallel
+        self.request_count = 0
+        self.total_seconds = 0.0
+        self.slot_wait_seconds = 0.0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _answer(prompt):
+        context, _, rest = prompt.partition('Context:')[2].rpartition('Question:')
+        question_words = set(re.findall(r'\w+', rest.split('----------------')[0].lower()))
+        best, best_score = "I don't know.", 0
+        for sentence in re.split(r'(?<=[.!?])\s+', context):
+            score = len(question_words & set(re.findall(r'\w+', sentence.lower())))
+            if score > best_score:
+                best, best_score = ' '.join(sentence.split()), score
+        return best
+
+    def stream(self, prompt):
+        started = time.perf_counter()
+        try:
+            for index, word in enumerate(self._answer(prompt).split(' ')):
+                if self.token_delay:
+                    time.sleep(self.token_delay)
+                yield word if index == 0 else f" {word}"
+        finally:
+            with self._lock:
+                self.request_count += 1
+                self.total_seconds += time.perf_counter() - started
+
+    def generate(self, prompt):
+        return ''.join(self.stream(prompt))
+
+    def close(self):
+        pass
+
+
+class PeakRssSampler:
+    """
+    以背景執行緒定期取樣本進程與所有子進程 (PDF 解析、嵌入進程池) 的 RSS 總和並記錄峰值。
+    沒有 /proc 的平台改用 getrusage 回報本進程的峰值 (進程生命週期內的最大值)。
+    """
+
+    def __init__(self, interval=0.25):
+        self.interval = interval
+        self.peak_bytes = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._page_size = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+    def _process_tree_rss(self):
+        children = {}
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    ppid = int(f.read().rpartition(')')[2].split()[1])
+            except (OSError, ValueError, IndexError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+        total, stack = 0, [os.getpid()]
+        while stack:
+            pid = stack.pop()
+            try:
+                with open(f'/proc/{pid}/statm') as f:
+                    total += int(f.read().split()[1]) * self._page_size
+            except (OSError, ValueError, IndexError):
+                continue
+            stack.extend(children.get(pid, ()))
+        return total
+
+    def _sample(self):
+        if os.path.isdir('/proc'):
+            self.peak_bytes = max(self.peak_bytes, self._process_tree_rss())
+        else:
+            import resource
+
+            scale = 1 if sys.platform == 'darwin' else 1024
+            self.peak_bytes = max(self.peak_bytes, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        self._sample()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+
+def directory_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def _percentiles(values):
+    if not values:
+        return {'p50': None, 'p95': None, 'p99': None}
+    array = np.array(values)
+    return {f'p{q}': round(float(np.percentile(array, q)), 4) for q in (50, 95, 99)}
+
+
+def _rate(count, seconds):
+    return round(count / seconds, 2) if seconds else None
+
+
+@contextmanager
+def isolated_environment(workdir, llm, redis_url=None, embedding_cache=False):
+    """
+    在 workdir 下建立獨立的資料庫、媒體目錄、ChromaDB 與倒排索引，任務以 eager 模式在本進程內執行，
+    LLM 換成 llm 替身；預設停用嵌入快取，讓每次執行都實際計算嵌入。結束後還原所有設定。
+    """
+    overrides = override_settings(
+        MEDIA_ROOT=os.path.join(workdir, 'media'),
+        RAG_LEXICAL_INDEX_DIR=os.path.join(workdir, 'lexical_index'),
+        RAG_QUANTIZED_INDEX_DIR=os.path.join(workdir, 'quantized_index'),
+        RAG_REDIS_URL=redis_url or settings.RAG_REDIS_URL,
+        ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver'], # 語意搜尋以 django.test.Client 呼叫實際的 API
+    )
+    test_settings = connection.settings_dict.setdefault('TEST', {})
+    saved_test_name = test_settings.get('NAME')
+    if connection.vendor == 'sqlite':
+        # 使用檔案型的 SQLite (而非記憶體資料庫)，與實際部署的 I/O 特性一致，也能讓多個執行緒共用
+        test_settings['NAME'] = os.path.join(workdir, 'db.sqlite3')
+    saved_registry, saved_redis = registry_module._registry, registry_module._redis_client
+    saved_eager = current_app.conf.task_always_eager
+    engine = get_embedding_engine()
+    saved_cache = engine.cache
+
+    overrides.enable()
+    old_database_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        registry = WorkerRegistry(
+            max_vector_stores=settings.RAG_VECTOR_STORE_POOL_SIZE, chroma_path=os.path.join(workdir, 'chroma_db')
+        )
+        registry._llm = llm
+        registry_module._registry, registry_module._redis_client = registry, None
+        current_app.conf.task_always_eager = True
+        if not embedding_cache:
+            engine.cache = None
+        yield registry
+    finally:
+        engine.cache = saved_cache
+        current_app.conf.task_always_eager = saved_eager
+        registry_module._registry, registry_module._redis_client = saved_registry, saved_redis
+        connection.creation.destroy_test_db(old_database_name, verbosity=0)
+        overrides.disable()
+        if saved_test_name is None:
+            test_settings.pop('NAME', None)
+        else:
+            test_settings['NAME'] = saved_test_name
+
+
+class BenchmarkRun:
+    """
+    對一個合成語料執行一次完整的基準測試：產生文件 → 匯入 (向量化) → 問答 → 語意搜尋，回傳各項量測結果。
+    匯入與問答都呼叫實際的 Celery 任務 (eager 模式)，與 Worker 走相同的程式路徑；語意搜尋經過實際的 API (中介層、DRF 與序列化)。
+    """
+
+    def __init__(self, corpus, questions=50, ingest_mode='document', scope='DOCUMENT', qa_concurrency=1,
+                 search_queries=0):
+        self.corpus = corpus
+        self.questions = questions
+        self.ingest_mode = ingest_mode
+        self.scope = scope
+        self.qa_concurrency = max(1, qa_concurrency)
+        self.search_queries = search_queries
+
+    def run(self, registry):
+        media_dir = os.path.join(settings.MEDIA_ROOT, 'documents')
+        generate_started = time.perf_counter()
+        paths = self.corpus.generate(media_dir)
+        generate_seconds = time.perf_counter() - generate_started
+        documents = Document.objects.bulk_create(
+            Document(file=f"documents/{os.path.basename(path)}", filename=os.path.basename(path)) for path in paths
+        )
+
+        warm_up_started = time.perf_counter()
+        get_embedding_engine().embed_query("warm up")
+        warm_up_seconds = time.perf_counter() - warm_up_started
+
+        with PeakRssSampler() as sampler:
+            ingest = self._ingest(registry, documents)
+            qa = self._answer(documents)
+            search = self._search(documents) if self.search_queries else None
+        index_bytes = sum(directory_size(path) for path in (
+            registry.chroma_path, settings.RAG_LEXICAL_INDEX_DIR, settings.RAG_QUANTIZED_INDEX_DIR,
+        ))
+        return {
+            'corpus': {
+                'documents': self.corpus.documents,
+                'pages_per_document': self.corpus.pages,
+                'words_per_page': self.corpus.words_per_page,
+                'seed': self.corpus.seed,
+                'bytes': sum(os.path.getsize(path) for path in paths),
+                'generate_seconds': round(generate_seconds, 3),
+            },
+            'warm_up_seconds': round(warm_up_seconds, 3),
+            'ingest': ingest,
+            'qa': qa,
+            'search': search,
+            'resources': {
+                'peak_rss_mb': round(sampler.peak_bytes / 2 ** 20, 1),
+                'index_disk_mb': round(index_bytes / 2 ** 20, 2),
+            },
+        }
+
+    def _ingest(self, registry, documents):
+        started = time.perf_counter()
+        if self.ingest_mode == 'bulk':
+            batch = IngestBatch.objects.create(total_documents=len(documents))
+            Document.objects.filter(id__in=[document.id for document in documents]).update(ingest_batch=batch)
+            DocumentViewSet._dispatch_batch(batch, documents)
+        else:
+            for document in documents:
+                parse_and_vectorize_document_task.delay(str(document.id))
+        seconds = time.perf_counter() - started
+
+        stages = {}
+        pages = chunks = completed = 0
+        for document in Document.objects.only('status', 'total_pages', 'processed_chunks', 'stage_timings'):
+            if document.status != 'COMPLETED':
+                continue
+            completed += 1
+            pages += document.total_pages or 0
+            chunks += document.processed_chunks
+            for stage, stage_seconds in (document.stage_timings or {}).items():
+                stages[stage] = stages.get(stage, 0.0) + stage_seconds
+        # 全新的向量庫且停用嵌入快取時，寫入的向量數即為實際計算的嵌入數
+        vectors = sum(collection.count() for collection in registry.get_chroma_client().list_collections())
+        return {
+            'mode': self.ingest_mode,
+            'seconds': round(seconds, 3),
+            'documents_completed': completed,
+            'documents_failed': len(documents) - completed,
+            'pages': pages,
+            'chunks': chunks,
+            'vectors': vectors,
+            'pages_per_second': _rate(pages, seconds),
+            'chunks_per_second': _rate(chunks, seconds),
+            'embeddings_per_second': _rate(vectors, stages.get('embed')),
+            'stage_seconds': {stage: round(value, 3) for stage, value in stages.items()},
+        }
+
+    def _ask(self, document, document_index, page, question):
+        try:
+            qa = QuestionAnswer.objects.create(
+                document=document, scope=self.scope, question=question, status='PENDING'
+            )
+            answer_question_with_rag_task.delay(str(qa.id), str(document.id), question)
+            return QuestionAnswer.objects.get(id=qa.id), document, page
+        finally:
+            if threading.current_thread() is not threading.main_thread():
+                connection.close() # 執行緒池中的每個執行緒各自開啟資料庫連線
+
+    def _answer(self, documents):
+        facts = list(self.corpus.facts)
+        random.Random(self.corpus.seed).shuffle(facts)
+        # 問題數超過事實數時重複提問 (重複的問題會命中答案快取，另外統計)
+        asked = [facts[i % len(facts)] for i in range(self.questions)] if facts else []
+        jobs = [(documents[index], index, page, self.corpus.question(index, page)) for index, page, _ in asked]
+
+        started = time.perf_counter()
+        if self.qa_concurrency > 1:
+            with ThreadPoolExecutor(max_workers=self.qa_concurrency) as pool:
+                results = list(pool.map(lambda job: self._ask(*job), jobs))
+        else:
+            results = [self._ask(*job) for job in jobs]
+        seconds = time.perf_counter() - started
+
+        codes = {(index, page): code for index, page, code in facts}
+        timings = {}
+        context_tokens, context_saved = [], []
+        completed = hits = correct = cache_hits = 0
+        for (qa, document, page), (_, index, _, _) in zip(results, jobs):
+            if qa.status != 'COMPLETED':
+                continue
+            completed += 1
+            cache_hits += qa.cache_hit
+            if qa.context_tokens is not None:
+                context_tokens.append(qa.context_tokens)
+                context_saved.append(qa.context_tokens_saved)
+            for stage, stage_seconds in (qa.stage_timings or {}).items():
+                timings.setdefault(stage, []).append(stage_seconds)
+            hits += any(
+                source['metadata'].get('source_file_id') == str(document.id) and source['metadata'].get('page') == page
+                for source in qa.source_documents or []
+            )
+            correct += codes[(index, page)] in (qa.answer or '')
+        return {
+            'questions': len(jobs),
+            'scope': self.scope,
+            'concurrency': self.qa_concurrency,
+            'seconds': round(seconds, 3),
+            'completed': completed,
+            'cache_hits': cache_hits,
+            'answers_per_second': _rate(completed, seconds),
+            'retrieval_hit_rate': round(hits / completed, 3) if completed else None,
+            'answer_accuracy': round(correct / completed, 3) if completed else None,
+            'context_tokens_mean': round(float(np.mean(context_tokens)), 1) if context_tokens else None,
+            'context_tokens_saved_mean': round(float(np.mean(context_saved)), 1) if context_saved else None,
+            **{f'{stage}_seconds': _percentiles(values) for stage, values in timings.items()},
+        }
+
+    def _search_pass(self, client, jobs, path):
+        """
+        依序送出語意搜尋請求，回傳端到端延遲 (含 API 處理與 JSON 序列化) 與伺服器回報的各階段延遲百分位數、前 k 個結果的命中率。
+        """
+        latencies, stages = [], {}
+        hits = completed = 0
+        for document, page, question in jobs:
+            started = time.perf_counter()
+            response = client.get(path(document), {'q': question, 'k': settings.RAG_RETRIEVAL_TOP_K})
+            latencies.append(time.perf_counter() - started)
+            if response.status_code != 200:
+                continue
+            body = response.json()
+            completed += 1
+            for stage, milliseconds in body['timings_ms'].items():
+                stages.setdefault(stage, []).append(milliseconds / 1000)
+            hits += any(
+                result['document'] == str(document.id) and result['page'] == page for result in body['results']
+            )
+        return {
+            'queries': len(jobs),
+            'completed': completed,
+            'hit_rate': round(hits / completed, 3) if completed else None,
+            'latency_seconds': _percentiles(latencies),
+            **{f'{stage}_seconds': _percentiles(values) for stage, values in stages.items()},
+        }
+
+    def _search(self, documents):
+        facts = list(self.corpus.facts)
+        random.Random(self.corpus.seed + 1).shuffle(facts)
+        asked = [facts[i % len(facts)] for i in range(self.search_queries)] if facts else []
+        jobs = [(documents[index], page, self.corpus.question(index, page)) for index, page, _ in asked]
+        completed = list(Document.objects.filter(status='COMPLETED').only('id'))
+        client = Client()
+
+        # 與常駐的 Web 進程相同：先預熱嵌入模型並讓每個文件的向量庫與索引都開啟過一次，只量測穩定狀態的延遲
+        get_registry().warm_up(('chroma', 'embedding'))
+        for document in completed:
+            client.get(f'/api/documents/{document.id}/search/', {'q': "warm up"})
+        client.get('/api/documents/search/', {'q': "warm up"})
+
+        document_pass = self._search_pass(client, jobs, lambda document: f'/api/documents/{document.id}/search/')
+        corpus_pass = self._search_pass(client, jobs, lambda document: '/api/documents/search/')
+        target = settings.RAG_SEARCH_LATENCY_TARGET_MS
+        return {
+            'target_ms': target,
+            'document': document_pass,
+            'corpus': corpus_pass,
+            'document_within_target': _within_target(document_pass, target),
+            'corpus_within_target': _within_target(corpus_pass, target),
+        }
+
+
+def _within_target(search_pass, target_ms):
+    p95 = search_pass['latency_seconds']['p95']
+    return None if p95 is None else p95 * 1000 <= target_ms
+
+
+def environment_info():
+    """
+    記錄本次結果的程式版本、執行環境與影響效能的設定，比較不同 commit 的結果時用來確認條件相同。
+    """
+    def git(*args):
+        try:
+            result = subprocess.run(['git', *args], cwd=settings.BASE_DIR, capture_output=True, text=True, timeout=10)
+        except (OSError, subprocess.SubprocessError):
+            return None
+        return result.stdout.strip() if result.returncode == 0 else None
+
+    status = git('status', '--porcelain', '--untracked-files=no')
+    return {
+        'git_commit': git('rev-parse', 'HEAD'),
+        'git_dirty': bool(status) if status is not None else None,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'settings': {
+            name: getattr(settings, name, None)
+            for name in (
+                'RAG_EMBEDDING_MODEL_NAME', 'RAG_EMBEDDING_BACKEND', 'RAG_EMBEDDING_BATCH_SIZE',
+                'RAG_EMBEDDING_NUM_WORKERS', 'RAG_INGEST_FLUSH_CHUNKS', 'RAG_INGEST_PAGES_PER_TASK',
+                'RAG_PDF_PARSE_WORKERS', 'RAG_VECTOR_STORE_LAYOUT', 'RAG_VECTOR_SEARCH_BACKEND', 'RAG_QUANTIZATION',
+                'RAG_HYBRID_SEARCH_ENABLED',
+                'RAG_ANSWER_BATCHING_ENABLED', 'RAG_ANSWER_CACHE_ENABLED', 'RAG_CONTEXT_BUILDER_ENABLED',
+                'RAG_CONTEXT_TOKEN_BUDGET', 'RAG_CONTEXT_CANDIDATES',
+                'RAG_RERANK_ENABLED', 'RAG_RERANK_CANDIDATES', 'RAG_RERANK_BUDGET_MS', 'RAG_SEARCH_LATENCY_TARGET_MS',
+            )
+        },
+    }
+
+
+def _metric(section, path):
+    value = section
+    for key in path.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+
+def compare_results(baseline, current):
+    """
+    比較兩份結果中語料規模相同的項目，回傳 [(語料, 指標, 基準值, 目前值, 變化百分比, 是否退步)]；
+    變化百分比以「越大越好」為正方向。
+    """
+    def corpus_key(result):
+        corpus = result['corpus']
+        return f"{corpus['documents']}x{corpus['pages_per_document']}"
+
+    baseline_runs = {corpus_key(result): result for result in baseline.get('runs', [])}
+    rows = []
+    for result in current.get('runs', []):
+        key = corpus_key(result)
+        reference = baseline_runs.get(key)
+        if reference is None:
+            continue
+        for (section, path), direction in COMPARED_METRICS.items():
+            before = _metric(reference.get(section), path)
+            after = _metric(result.get(section), path)
+            if not before or after is None:
+                continue
+            change = (after - before) / before * 100
+            if direction == 'lower':
+                change = -change
+            rows.append((key, f"{section}.{path}", before, after, round(change, 1), change < 0))
+    return rows
+
+
+def load_results(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_results(path, results):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+def facts_per_document(documents, questions):
+    # 讓問題盡量不重複：每個文件埋入足夠的事實
+    return max(1, math.ceil(questions / documents))
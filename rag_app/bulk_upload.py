@@ -0,0 +1,127 @@
+import codecs
+import hashlib
+import os
+import zipfile
+
+from django.conf import settings
+from django.core.files.uploadedfile import TemporaryUploadedFile
+
+SUPPORTED_EXTENSIONS = ('.pdf', '.txt', '.docx')
+# 判斷檔案格式時讀取的開頭長度
+SNIFF_BYTES = 2048
+# 解壓 zip 內的檔案時每次讀取的大小
+_EXTRACT_CHUNK_BYTES = 1024 * 1024
+
+
+def file_sha256(file_obj):
+    """
+    逐塊計算上傳檔案內容的 SHA-256 (不一次讀入記憶體)，計算完後將讀取位置移回開頭。
+    """
+    digest = hashlib.sha256()
+    for block in file_obj.chunks():
+        digest.update(block)
+    file_obj.seek(0)
+    return digest.hexdigest()
+
+
+def content_matches_extension(extension, head):
+    """
+    以檔案開頭的內容確認實際格式與副檔名相符：PDF 在前 1024 bytes 內有 %PDF- 標記、DOCX 為 zip 格式、TXT 為 UTF-8 文字。
+    """
+    if extension == '.pdf':
+        return b'%PDF-' in head[:1024]
+    if extension == '.docx':
+        return head.startswith(b'PK\x03\x04')
+    if extension == '.txt':
+        if b'\x00' in head:
+            return False
+        try:
+            # 開頭可能在多位元組字元中間截斷，不視為錯誤
+            codecs.getincrementaldecoder('utf-8')().decode(head, final=False)
+        except UnicodeDecodeError:
+            return False
+        return True
+    return False
+
+
+def uploaded_file_matches_extension(file_obj):
+    """
+    讀取上傳檔案的開頭判斷格式是否與副檔名相符，讀完後將讀取位置移回開頭。
+    """
+    head = file_obj.read(SNIFF_BYTES)
+    file_obj.seek(0)
+    return content_matches_extension(os.path.splitext(file_obj.name)[1].lower(), head)
+
+
+def _extract_member(zf, info, name, max_bytes):
+    """
+    將 zip 內的一個檔案逐塊解壓到暫存檔 (與 Django 處理大型上傳相同)，記憶體中只保留一個區塊，回傳 (暫存檔或 None, 略過原因)。
+    實際解壓的大小超過上限時 (zip 標頭記錄的大小可能不實) 停止解壓並略過。
+    """
+    member = TemporaryUploadedFile(name, 'application/octet-stream', info.file_size, None)
+    size = 0
+    with zf.open(info) as source:
+        while True:
+            block = source.read(_EXTRACT_CHUNK_BYTES)
+            if not block:
+                break
+            size += len(block)
+            if size > max_bytes:
+                member.close()
+                return None, 'too_large'
+            member.write(block)
+    member.size = size
+    member.seek(0)
+    if not uploaded_file_matches_extension(member):
+        member.close()
+        return None, 'invalid_content'
+    return member, None
+
+
+def _iter_zip_members(archive):
+    """
+    依序產出 zip 內的 (檔名, 暫存檔或 None, 略過原因)；目錄與 macOS 的附屬檔直接忽略。
+    """
+    max_bytes = settings.RAG_BULK_UPLOAD_MAX_MEMBER_BYTES
+    try:
+        with zipfile.ZipFile(archive) as zf:
+            for info in zf.infolist():
+                name = os.path.basename(info.filename)
+                if info.is_dir() or not name or name.startswith('.') or info.filename.startswith('__MACOSX/'):
+                    continue
+                if os.path.splitext(name)[1].lower() not in SUPPORTED_EXTENSIONS:
+                    yield name, None, 'unsupported'
+                elif info.file_size > max_bytes:
+                    yield name, None, 'too_large'
+                else:
+                    yield (name, *_extract_member(zf, info, name, max_bytes))
+    except zipfile.BadZipFile:
+        yield archive.name, None, 'bad_archive'
+
+
+def expand_uploaded_files(files):
+    """
+    展開一次批次上傳的檔案 (zip 會展開成其中的文件)，回傳 (可處理的 [(檔名, 檔案)], 略過的 [{filename, reason}])。
+    zip 內的檔案解壓成暫存檔，由呼叫端在處理完後以 close_files 刪除。
+    """
+    accepted, skipped = [], []
+    for uploaded in files:
+        ext = os.path.splitext(uploaded.name)[1].lower()
+        if ext == '.zip':
+            members = _iter_zip_members(uploaded)
+        elif ext in SUPPORTED_EXTENSIONS:
+            members = [(uploaded.name, uploaded, None if uploaded_file_matches_extension(uploaded) else 'invalid_content')]
+        else:
+            members = [(uploaded.name, None, 'unsupported')]
+        for name, file_obj, reason in members:
+            if reason is not None:
+                skipped.append({'filename': name, 'reason': reason})
+            else:
+                accepted.append((name, file_obj))
+    return accepted, skipped
+
+
+def close_files(accepted):
+    # 關閉 (並刪除) expand_uploaded_files 解壓出來的暫存檔；已搬移成文件檔案的暫存檔不受影響
+    for _, file_obj in accepted:
+        file_obj.close()
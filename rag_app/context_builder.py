@@ -0,0 +1,137 @@
+import math
+import re
+from collections import namedtuple
+
+import numpy as np
+from django.conf import settings
+
+# 中日韓文字 (含全形標點) 每個字大約就是一個 token
+_CJK_PATTERN = re.compile(r'[　-〿㐀-䶿一-鿿豈-﫿＀-￯]')
+# 兩個區塊首尾至少重疊這麼多字元才視為相鄰 (分塊時 chunk_overlap 產生的重複文字)
+_MIN_OVERLAP_CHARS = 32
+
+# blocks：[(metadata, 文字)]，依選入順序；selected：實際放進 Prompt 的檢索結果 [(區塊, 距離)]
+BuiltContext = namedtuple('BuiltContext', ['blocks', 'selected', 'tokens', 'baseline_tokens'])
+
+
+def estimate_tokens(text):
+    """
+    估計文字的 token 數 (不必載入 LLM 的 tokenizer)：中日韓文字每字算一個 token，其餘每 RAG_CONTEXT_CHARS_PER_TOKEN 個字元算一個。
+    """
+    cjk = len(_CJK_PATTERN.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / settings.RAG_CONTEXT_CHARS_PER_TOKEN)
+
+
+def _join_overlapping(first, second):
+    """
+    second 的開頭與 first 的結尾重疊時回傳串接後的文字 (重疊部分只保留一份)，否則回傳 None。
+    """
+    probe = second[:_MIN_OVERLAP_CHARS]
+    if len(probe) < _MIN_OVERLAP_CHARS:
+        return None
+    start = max(0, len(first) - len(second))
+    while True:
+        position = first.find(probe, start)
+        if position < 0 or len(first) - position < _MIN_OVERLAP_CHARS:
+            return None
+        if second.startswith(first[position:]):
+            return first + second[len(first) - position:]
+        start = position + 1
+
+
+def _page_key(chunk):
+    return chunk.metadata.get('source_file_id'), chunk.metadata.get('page')
+
+
+def assemble_blocks(chunks):
+    """
+    將區塊整理成不重複的段落：內容相同或被其他區塊包含的區塊直接略過，同一文件同一頁中首尾重疊的區塊合併成一段。
+    回傳 [(metadata, 文字)]，段落順序依各段第一個區塊在 chunks 中的順序。
+    """
+    blocks = [] # [page_key, metadata, 文字]
+    for chunk in chunks:
+        key, text = _page_key(chunk), chunk.page_content.strip()
+        if any(text in block[2] for block in blocks):
+            continue
+        current = [key, chunk.metadata, text]
+        blocks.append(current)
+        # 與同頁的段落首尾重疊 (或包含整段) 就合併；合併後可能又接上同頁的另一段，重複直到無法再合併
+        merged = True
+        while merged:
+            merged = False
+            for block in blocks:
+                if block is current or block[0] != key:
+                    continue
+                joined = _join_overlapping(block[2], current[2]) or _join_overlapping(current[2], block[2])
+                if joined is None and block[2] in current[2]:
+                    joined = current[2]
+                if joined is not None:
+                    # 合併到較早出現的段落，維持段落的順序
+                    first, second = sorted((block, current), key=lambda item: next(
+                        position for position, other in enumerate(blocks) if other is item))
+                    first[2] = joined
+                    blocks.remove(second)
+                    current, merged = first, True
+                    break
+    return [(metadata, text) for _, metadata, text in blocks]
+
+
+def format_blocks(blocks, label_sources):
+    """
+    組成 Prompt 的 Context；多文件提問時在每段前標註來源文件，讓答案可以引用。
+    """
+    if label_sources:
+        return "\n\n".join(f"[{metadata.get('source_filename')}]\n{text}" for metadata, text in blocks)
+    return "\n\n".join(text for _, text in blocks)
+
+
+def _similarity_matrix(chunks, embeddings):
+    # 區塊之間的餘弦相似度；沒有嵌入的區塊視為與其他區塊都不相似
+    dimension = next((len(vector) for vector in embeddings.values()), 0)
+    matrix = np.zeros((len(chunks), dimension), dtype=np.float32)
+    for row, chunk in enumerate(chunks):
+        vector = embeddings.get(chunk.id)
+        if vector is not None:
+            matrix[row] = vector
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    matrix = matrix / np.clip(norms, 1e-12, None)
+    return matrix @ matrix.T
+
+
+def build_context(retrieved, embeddings, label_sources, token_budget=None, mmr_lambda=None, baseline_k=None):
+    """
+    從檢索結果 (依相關性排序的 [(區塊, 距離)]) 挑選區塊填滿 token 預算：
+    以 MMR (Maximal Marginal Relevance) 依序挑選，相關性採用檢索 (含 RRF 融合) 的名次，與已選區塊的相似度 (依 embeddings) 作為懲罰；
+    每選入一個區塊就重新整理段落 (去除重複、合併同頁相鄰區塊)，只有整理後仍在預算內才保留。第一個區塊一定保留。
+    baseline_tokens 為直接貼上前 baseline_k 個區塊原文的 token 數，用來計算節省的 Prompt token。
+    """
+    token_budget = settings.RAG_CONTEXT_TOKEN_BUDGET if token_budget is None else token_budget
+    mmr_lambda = settings.RAG_CONTEXT_MMR_LAMBDA if mmr_lambda is None else mmr_lambda
+    baseline_k = settings.RAG_RETRIEVAL_TOP_K if baseline_k is None else baseline_k
+    chunks = [chunk for chunk, _ in retrieved]
+    baseline_tokens = estimate_tokens(format_blocks(
+        [(chunk.metadata, chunk.page_content) for chunk in chunks[:baseline_k]], label_sources
+    ))
+    if not chunks:
+        return BuiltContext([], [], 0, baseline_tokens)
+
+    relevance = 1.0 - np.arange(len(chunks)) / len(chunks)
+    similarity = _similarity_matrix(chunks, embeddings)
+    max_similarity = np.full(len(chunks), -np.inf)
+    remaining = set(range(len(chunks)))
+    selected, blocks, tokens = [], [], 0
+    while remaining:
+        if selected:
+            scores = {index: mmr_lambda * relevance[index] - (1 - mmr_lambda) * max_similarity[index] for index in remaining}
+            index = max(scores, key=lambda candidate: (scores[candidate], -candidate))
+        else:
+            index = min(remaining)
+        remaining.discard(index)
+        candidate_blocks = assemble_blocks([chunks[i] for i in selected + [index]])
+        candidate_tokens = estimate_tokens(format_blocks(candidate_blocks, label_sources))
+        if selected and candidate_tokens > token_budget:
+            continue
+        selected.append(index)
+        blocks, tokens = candidate_blocks, candidate_tokens
+        max_similarity = np.maximum(max_similarity, similarity[index])
+    return BuiltContext(blocks, [retrieved[index] for index in selected], tokens, baseline_tokens)
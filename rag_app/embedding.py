@@ -0,0 +1,265 @@
+import os
+from collections import deque
+
+import billiard
+import numpy as np
+from django.conf import settings
+from langchain_core.embeddings import Embeddings
+
+from .embedding_cache import EmbeddingCache, chunk_hash
+
+DEFAULT_EMBEDDING_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+
+
+class SentenceTransformerEncoder:
+    """
+    以 sentence-transformers (PyTorch) 在 CPU 上計算嵌入。
+    """
+
+    def __init__(self, model_name, num_threads=None):
+        import torch
+        from sentence_transformers import SentenceTransformer
+
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        self.model = SentenceTransformer(model_name, device='cpu')
+
+    def encode(self, texts):
+        vectors = self.model.encode(
+            texts,
+            batch_size=len(texts),
+            show_progress_bar=False,
+            convert_to_numpy=True,
+        )
+        return np.asarray(vectors, dtype=np.float32)
+
+
+class OnnxEncoder:
+    """
+    以 ONNX Runtime 在 CPU 上計算嵌入 (mean pooling + L2 正規化，與 all-MiniLM-L6-v2 的 sentence-transformers 輸出一致)。
+    """
+
+    def __init__(self, model_name, num_threads=None, max_length=256):
+        import onnxruntime as ort
+        from huggingface_hub import hf_hub_download
+        from tokenizers import Tokenizer
+
+        model_path = hf_hub_download(model_name, 'onnx/model.onnx')
+        tokenizer_path = hf_hub_download(model_name, 'tokenizer.json')
+
+        self.tokenizer = Tokenizer.from_file(tokenizer_path)
+        self.tokenizer.enable_truncation(max_length=max_length)
+        self.tokenizer.enable_padding(pad_id=0, pad_token='[PAD]')
+
+        options = ort.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+
+    def encode(self, texts):
+        encodings = self.tokenizer.encode_batch(texts)
+        input_ids = np.array([encoding.ids for encoding in encodings], dtype=np.int64)
+        attention_mask = np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64)
+
+        feeds = {'input_ids': input_ids, 'attention_mask': attention_mask}
+        if 'token_type_ids' in self.input_names:
+            feeds['token_type_ids'] = np.array([encoding.type_ids for encoding in encodings], dtype=np.int64)
+
+        token_embeddings = self.session.run(None, feeds)[0]
+        mask = attention_mask[..., np.newaxis].astype(np.float32)
+        pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        norms = np.linalg.norm(pooled, axis=1, keepdims=True)
+        return (pooled / np.clip(norms, 1e-12, None)).astype(np.float32)
+
+
+ENCODER_BACKENDS = {
+    'torch': SentenceTransformerEncoder,
+    'onnx': OnnxEncoder,
+}
+
+
+def build_encoder(model_name, backend, num_threads=None):
+    try:
+        encoder_class = ENCODER_BACKENDS[backend]
+    except KeyError:
+        raise ValueError(f"不支援的嵌入後端: {backend}")
+    return encoder_class(model_name, num_threads=num_threads)
+
+
+# 子進程內的編碼器 (由 _init_pool_worker 初始化，每個子進程只載入一次模型)
+_pool_encoder = None
+
+
+def _init_pool_worker(model_name, backend, num_threads):
+    global _pool_encoder
+    _pool_encoder = build_encoder(model_name, backend, num_threads=num_threads)
+
+
+def _encode_in_pool_worker(texts):
+    return _pool_encoder.encode(texts)
+
+
+class EmbeddingEngine(Embeddings):
+    """
+    批次化、多進程的嵌入引擎。
+
+    文本被切成固定大小的批次，分散到進程池中計算；`iter_embedding_batches` 依原始順序逐批產出結果，
+    呼叫端可以在每批完成時直接寫入向量資料庫，記憶體用量只與「批次大小 x 進行中的批次數」有關。
+    """
+
+    def __init__(self, model_name=DEFAULT_EMBEDDING_MODEL_NAME, backend='torch', batch_size=64, num_workers=1, cache=None):
+        self.model_name = model_name
+        self.backend = backend
+        self.batch_size = max(1, batch_size)
+        self.num_workers = max(1, num_workers)
+        self.cache = cache
+        self._encoder = None
+        self._pool = None
+        self._pool_unavailable = False
+
+    @property
+    def model_loaded(self):
+        # 本進程是否已載入模型 (進程池子進程內的模型不計)
+        return self._encoder is not None
+
+    def _get_encoder(self):
+        if self._encoder is None:
+            self._encoder = build_encoder(self.model_name, self.backend)
+        return self._encoder
+
+    @property
+    def pool_processes(self):
+        # 實際用來計算嵌入的進程數 (進程池無法建立時為 1)
+        return 1 if self.num_workers <= 1 or self._pool_unavailable else self.num_workers
+
+    def _get_pool(self):
+        if self.num_workers <= 1 or self._pool_unavailable:
+            return None
+        if self._pool is None:
+            threads_per_worker = max(1, (os.cpu_count() or 1) // self.num_workers)
+            # 與 PDF 並行解析相同使用 billiard (Celery 的 multiprocessing 分支)：Celery prefork 的 daemon 子進程也能再建立進程池
+            try:
+                self._pool = billiard.get_context('spawn').Pool(
+                    processes=self.num_workers,
+                    initializer=_init_pool_worker,
+                    initargs=(self.model_name, self.backend, threads_per_worker),
+                )
+            except Exception as e:
+                self._pool_unavailable = True
+                print(f"警告: 無法建立嵌入進程池 ({e})，進程 {os.getpid()} 改以單一進程計算嵌入。")
+                return None
+        return self._pool
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    @staticmethod
+    def _prepare(texts):
+        # 與 HuggingFaceEmbeddings 相同，將換行視為空白
+        return [text.replace("\n", " ") for text in texts]
+
+    def _lookup_cache(self, batch):
+        if self.cache is None:
+            return None, {}, list(range(len(batch)))
+        keys = [chunk_hash(text) for text in batch]
+        cached = self.cache.get_many(keys)
+        miss_indices = [i for i, key in enumerate(keys) if key not in cached]
+        return keys, cached, miss_indices
+
+    def _merge_batch(self, batch_size, keys, cached, miss_indices, miss_vectors):
+        if keys is None:
+            return miss_vectors
+        if miss_indices:
+            self.cache.put_many([keys[i] for i in miss_indices], miss_vectors)
+        if not cached:
+            return miss_vectors
+        dim = miss_vectors.shape[1] if miss_indices else len(next(iter(cached.values())))
+        vectors = np.empty((batch_size, dim), dtype=np.float32)
+        for i, key in enumerate(keys):
+            if key in cached:
+                vectors[i] = cached[key]
+        if miss_indices:
+            vectors[miss_indices] = miss_vectors
+        return vectors
+
+    def iter_embedding_batches(self, texts):
+        """
+        依序產出 (offset, vectors)，vectors 為 float32 的 numpy 陣列，對應 texts[offset:offset + len(vectors)]。
+        已在嵌入快取中的區塊不會重新計算。
+        """
+        texts = self._prepare(texts)
+        batches = [texts[offset:offset + self.batch_size] for offset in range(0, len(texts), self.batch_size)]
+        pool = self._get_pool() if len(batches) > 1 else None
+
+        # 只讓有限數量的批次同時在途，避免結果堆積在記憶體中
+        max_in_flight = self.num_workers * 2 if pool is not None else 1
+        pending = deque()
+        offset = 0
+        for batch in batches:
+            keys, cached, miss_indices = self._lookup_cache(batch)
+            miss_texts = [batch[i] for i in miss_indices]
+            if not miss_texts:
+                work = None
+            elif pool is not None:
+                work = pool.apply_async(_encode_in_pool_worker, (miss_texts,))
+            else:
+                work = self._get_encoder().encode(miss_texts)
+            pending.append((offset, len(batch), keys, cached, miss_indices, work))
+            offset += len(batch)
+            while len(pending) >= max_in_flight:
+                yield self._finish_pending(pending.popleft())
+        while pending:
+            yield self._finish_pending(pending.popleft())
+
+    def _finish_pending(self, item):
+        offset, batch_size, keys, cached, miss_indices, work = item
+        if work is None:
+            miss_vectors = np.empty((0, 0), dtype=np.float32)
+        elif isinstance(work, np.ndarray):
+            miss_vectors = work
+        else:
+            miss_vectors = work.get()
+        return offset, self._merge_batch(batch_size, keys, cached, miss_indices, miss_vectors)
+
+    def embed_documents(self, texts):
+        vectors = []
+        for _, batch_vectors in self.iter_embedding_batches(texts):
+            vectors.extend(batch_vectors.tolist())
+        return vectors
+
+    def embed_query(self, text):
+        prepared = self._prepare([text])
+        keys, cached, miss_indices = self._lookup_cache(prepared)
+        miss_vectors = self._get_encoder().encode(prepared) if miss_indices else None
+        return self._merge_batch(1, keys, cached, miss_indices, miss_vectors)[0].tolist()
+
+
+_embedding_engine = None
+
+
+def get_embedding_engine():
+    """
+    取得進程內共用的嵌入引擎 (依 settings 建立，模型在第一次使用時才載入)。
+    """
+    global _embedding_engine
+    if _embedding_engine is None:
+        model_name = getattr(settings, 'RAG_EMBEDDING_MODEL_NAME', DEFAULT_EMBEDDING_MODEL_NAME)
+        cache = None
+        if getattr(settings, 'RAG_EMBEDDING_CACHE_ENABLED', False):
+            cache = EmbeddingCache(
+                settings.RAG_EMBEDDING_CACHE_DIR,
+                model_name,
+                max_entries=getattr(settings, 'RAG_EMBEDDING_CACHE_MAX_ENTRIES', 200000),
+            )
+        _embedding_engine = EmbeddingEngine(
+            model_name=model_name,
+            backend=getattr(settings, 'RAG_EMBEDDING_BACKEND', 'torch'),
+            batch_size=getattr(settings, 'RAG_EMBEDDING_BATCH_SIZE', 64),
+            num_workers=getattr(settings, 'RAG_EMBEDDING_NUM_WORKERS', 1),
+            cache=cache,
+        )
+    return _embedding_engine
@@ -0,0 +1,198 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+
+import numpy as np
+
+KEY_BYTES = 16 # 每個槽位保存的鍵摘要長度，用於讀取時驗證槽位未被其他進程覆寫
+
+
+def normalize_chunk_text(text):
+    """
+    正規化區塊文字 (Unicode NFC + 合併空白)，讓僅有排版差異的區塊共用同一個快取項目。
+    """
+    return re.sub(r'\s+', ' ', unicodedata.normalize('NFC', text)).strip()
+
+
+def chunk_hash(text):
+    return hashlib.sha256(normalize_chunk_text(text).encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    以內容定址的持久化嵌入快取，鍵為 (模型名稱, 正規化區塊文字的 SHA-256)。
+
+    每個模型一個目錄：
+      - vectors.f32：固定容量的 float32 記憶體映射陣列，每個槽位存一個向量
+      - keys.u8：每個槽位對應鍵的前 16 bytes，讀取時用來確認槽位沒有被並行的淘汰覆寫
+      - index.sqlite3：鍵 → 槽位 的索引與最後使用時間
+    項目數達到 max_entries 後，以 LRU 淘汰最久未使用的槽位。
+    """
+
+    def __init__(self, cache_dir, model_name, max_entries=200000):
+        self.directory = os.path.join(cache_dir, re.sub(r'[^A-Za-z0-9_.-]+', '_', model_name))
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._arrays_lock = threading.Lock()
+        self._vectors = None
+        self._keys = None
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def _conn(self):
+        # 第一次使用時才建立目錄與索引，匯入模組或建立引擎時不會觸碰磁碟；
+        # SQLite 連線不能跨執行緒共用，因此每個執行緒各自建立一條
+        conn = getattr(self._local, 'connection', None)
+        if conn is None:
+            os.makedirs(self.directory, exist_ok=True)
+            conn = sqlite3.connect(os.path.join(self.directory, 'index.sqlite3'), timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS entries ('
+                'key TEXT PRIMARY KEY, slot INTEGER NOT NULL UNIQUE, last_used REAL NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)')
+            conn.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+            self._local.connection = conn
+        return conn
+
+    def _open_arrays(self, dim):
+        with self._arrays_lock:
+            self._open_arrays_locked(dim)
+
+    def _open_arrays_locked(self, dim):
+        if self._vectors is not None:
+            return
+        vectors_path = os.path.join(self.directory, 'vectors.f32')
+        keys_path = os.path.join(self.directory, 'keys.u8')
+        # 容量調小時保留既有檔案大小，仍可讀取舊槽位；調大時以稀疏檔方式延伸
+        rows = self.max_entries
+        if os.path.exists(vectors_path):
+            rows = max(rows, os.path.getsize(vectors_path) // (dim * 4))
+        for path, row_bytes in ((vectors_path, dim * 4), (keys_path, KEY_BYTES)):
+            with open(path, 'ab') as f:
+                if f.tell() < rows * row_bytes:
+                    f.truncate(rows * row_bytes)
+        self._vectors = np.memmap(vectors_path, dtype=np.float32, mode='r+', shape=(rows, dim))
+        self._keys = np.memmap(keys_path, dtype=np.uint8, mode='r+', shape=(rows, KEY_BYTES))
+
+    def _stored_dim(self):
+        row = self._conn.execute("SELECT value FROM meta WHERE name = 'dim'").fetchone()
+        return row[0] if row else None
+
+    def get_many(self, keys):
+        """
+        回傳 {key: vector}，只包含命中的鍵。
+        """
+        if not keys:
+            return {}
+        dim = self._stored_dim()
+        if dim is None:
+            self.misses += len(keys)
+            return {}
+        self._open_arrays(dim)
+
+        found = {}
+        unique_keys = list(dict.fromkeys(keys))
+        for start in range(0, len(unique_keys), 500):
+            part = unique_keys[start:start + 500]
+            placeholders = ','.join('?' * len(part))
+            rows = self._conn.execute(f'SELECT key, slot FROM entries WHERE key IN ({placeholders})', part).fetchall()
+            for key, slot in rows:
+                vector = np.array(self._vectors[slot])
+                if bytes(self._keys[slot]) == bytes.fromhex(key)[:KEY_BYTES]:
+                    found[key] = vector
+
+        if found:
+            now = time.time()
+            self._conn.executemany('UPDATE entries SET last_used = ? WHERE key = ?', [(now, key) for key in found])
+        self.hits += sum(1 for key in keys if key in found)
+        self.misses += sum(1 for key in keys if key not in found)
+        return found
+
+    def put_many(self, keys, vectors):
+        if not keys:
+            return
+        vectors = np.asarray(vectors, dtype=np.float32)
+        now = time.time()
+
+        self._conn.execute('BEGIN IMMEDIATE')
+        try:
+            dim = self._stored_dim()
+            if dim is None:
+                dim = vectors.shape[1]
+                self._conn.execute("INSERT INTO meta (name, value) VALUES ('dim', ?)", (dim,))
+            self._open_arrays(dim)
+
+            new_items = {}
+            for key, vector in zip(keys, vectors):
+                new_items.setdefault(key, vector)
+            existing = set()
+            pending_keys = list(new_items)
+            for start in range(0, len(pending_keys), 500):
+                part = pending_keys[start:start + 500]
+                placeholders = ','.join('?' * len(part))
+                existing.update(
+                    row[0] for row in self._conn.execute(f'SELECT key FROM entries WHERE key IN ({placeholders})', part)
+                )
+            new_keys = [key for key in pending_keys if key not in existing][:self.max_entries]
+            if not new_keys:
+                self._conn.execute('COMMIT')
+                return
+
+            slots = self._allocate_slots(len(new_keys))
+            for key, slot in zip(new_keys, slots):
+                # 先清除鍵摘要再寫入向量，讀取端才能偵測到寫入中的槽位
+                self._keys[slot] = 0
+                self._vectors[slot] = new_items[key]
+                self._keys[slot] = np.frombuffer(bytes.fromhex(key)[:KEY_BYTES], dtype=np.uint8)
+            self._vectors.flush()
+            self._keys.flush()
+
+            self._conn.executemany(
+                'INSERT INTO entries (key, slot, last_used) VALUES (?, ?, ?)',
+                [(key, slot, now) for key, slot in zip(new_keys, slots)],
+            )
+            self._conn.execute('COMMIT')
+        except Exception:
+            self._conn.execute('ROLLBACK')
+            raise
+
+    def _allocate_slots(self, count):
+        used = self._conn.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+        free = max(0, self.max_entries - used)
+        slots = []
+        if free:
+            max_slot = self._conn.execute('SELECT MAX(slot) FROM entries').fetchone()[0]
+            next_slot = 0 if max_slot is None else max_slot + 1
+            if next_slot + min(free, count) <= self.max_entries:
+                slots.extend(range(next_slot, next_slot + min(free, count)))
+            else:
+                # 槽位有空洞 (例如曾被清除)，逐一找出未使用的槽位
+                taken = {row[0] for row in self._conn.execute('SELECT slot FROM entries')}
+                slots.extend(slot for slot in range(self.max_entries) if slot not in taken)
+                slots = slots[:min(free, count)]
+
+        evict_count = count - len(slots)
+        if evict_count > 0:
+            victims = self._conn.execute(
+                'SELECT key, slot FROM entries ORDER BY last_used LIMIT ?', (evict_count,)
+            ).fetchall()
+            self._conn.executemany('DELETE FROM entries WHERE key = ?', [(key,) for key, _ in victims])
+            slots.extend(slot for _, slot in victims)
+        return slots
+
+    def stats(self):
+        used = self._conn.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+        return {
+            'entries': used,
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
@@ -0,0 +1,41 @@
+from . import quantized_index
+
+# 文件處理任務與快照匯入共用的區塊操作 (vector_db 為 registry.get_vector_store() 回傳的向量庫)
+
+
+def iter_stored_chunks(vector_db, where, include):
+    """
+    分批讀取符合 where 的已存區塊，每批為 Chroma get() 的結果。
+    """
+    offset = 0
+    while True:
+        batch = vector_db._collection.get(where=where, limit=1000, offset=offset, include=include)
+        if not batch['ids']:
+            return
+        yield batch
+        offset += len(batch['ids'])
+
+
+def delete_stale_chunks(vector_db, where, index_version):
+    """
+    刪除這次處理沒有再產生的區塊 (內容已被修改或移除)，回傳刪除數量。
+    """
+    stale_ids = [
+        chunk_id
+        for batch in iter_stored_chunks(vector_db, where, ['metadatas'])
+        for chunk_id, metadata in zip(batch['ids'], batch['metadatas'])
+        if (metadata or {}).get('index_version') != index_version
+    ]
+    for start in range(0, len(stale_ids), 1000):
+        vector_db._collection.delete(ids=stale_ids[start:start + 1000])
+    return len(stale_ids)
+
+
+def refresh_quantized_index(document_id, vector_db, where):
+    """
+    區塊寫入完成後重建文件的量化索引；未使用量化檢索時刪除舊的索引，避免之後切換後端時讀到過期的內容。
+    """
+    if quantized_index.enabled():
+        quantized_index.build_from_collection(document_id, vector_db._collection, where)
+    else:
+        quantized_index.delete_index(document_id)
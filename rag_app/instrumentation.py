@@ -0,0 +1,148 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import redis
+from django.conf import settings
+from opentelemetry import trace
+
+from .registry import get_redis
+
+METRICS_KEY_PREFIX = 'rag:metrics:stage:'
+STAGE_HISTOGRAM = 'rag_stage_duration_seconds'
+
+_tracer_lock = threading.Lock()
+_tracer_pid = None
+
+
+def get_tracer():
+    """
+    取得 OpenTelemetry tracer。設定 RAG_OTEL_EXPORTER_ENDPOINT 時，每個進程 (包括 Celery fork 出來的子進程) 第一次使用時
+    各自建立 TracerProvider 與 OTLP 匯出器；未設定時為不產生任何資料的 no-op tracer。
+    """
+    global _tracer_pid
+    endpoint = settings.RAG_OTEL_EXPORTER_ENDPOINT
+    if endpoint and _tracer_pid != os.getpid():
+        with _tracer_lock:
+            if _tracer_pid != os.getpid():
+                from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+                from opentelemetry.sdk.resources import Resource
+                from opentelemetry.sdk.trace import TracerProvider
+                from opentelemetry.sdk.trace.export import BatchSpanProcessor
+
+                provider = TracerProvider(resource=Resource.create({'service.name': settings.RAG_OTEL_SERVICE_NAME}))
+                provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter(endpoint=endpoint, insecure=True)))
+                trace.set_tracer_provider(provider)
+                _tracer_pid = os.getpid()
+    return trace.get_tracer('rag_app')
+
+
+class StageTimings:
+    """
+    記錄一次處理 (文件向量化或問答) 各階段的累計秒數。
+
+    同一階段可以多次計時 (例如每批嵌入)，秒數會累加；finish() 時以根 span 加上每個階段一個子 span
+    (涵蓋該階段第一次開始到最後一次結束) 送出 OpenTelemetry，並可選擇寫入 Prometheus 直方圖。
+    """
+
+    def __init__(self, pipeline, initial=None):
+        self.pipeline = pipeline
+        self.seconds = {stage: float(value) for stage, value in (initial or {}).items()}
+        self._bounds = {}
+        self._started_ns = time.time_ns()
+
+    def add(self, stage, seconds, start_ns=None, end_ns=None):
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+        if start_ns is not None:
+            first, last = self._bounds.get(stage, (start_ns, end_ns))
+            self._bounds[stage] = (min(first, start_ns), max(last, end_ns))
+
+    @contextmanager
+    def stage(self, name):
+        start_ns = time.time_ns()
+        try:
+            yield
+        finally:
+            end_ns = time.time_ns()
+            self.add(name, (end_ns - start_ns) / 1e9, start_ns, end_ns)
+
+    def iterate(self, name, iterable):
+        """
+        逐一產出 iterable 的項目，並把每次取得下一個項目所花的時間計入指定階段 (例如逐頁解析)。
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                item = next(iterator, StopIteration)
+            if item is StopIteration:
+                return
+            yield item
+
+    def as_dict(self):
+        return {stage: round(seconds, 4) for stage, seconds in self.seconds.items()}
+
+    def finish(self, attributes=None, observe=True):
+        """
+        送出這次處理的 span；observe 為 True 時將各階段的累計秒數寫入直方圖。回傳四捨五入後的各階段秒數。
+        """
+        end_ns = time.time_ns()
+        try:
+            tracer = get_tracer()
+            root = tracer.start_span(f'rag.{self.pipeline}', start_time=self._started_ns, attributes=attributes or {})
+            context = trace.set_span_in_context(root)
+            for stage, (start_ns, stage_end_ns) in self._bounds.items():
+                span = tracer.start_span(
+                    f'rag.{self.pipeline}.{stage}', context=context, start_time=start_ns,
+                    attributes={'rag.stage.seconds': self.seconds[stage]},
+                )
+                span.end(end_time=stage_end_ns)
+            for stage, seconds in self.seconds.items():
+                root.set_attribute(f'rag.stage.{stage}_seconds', seconds)
+            root.end(end_time=end_ns)
+        except Exception as e:
+            print(f"警告: 送出 OpenTelemetry span 失敗: {e}")
+        if observe:
+            observe_stages(self.pipeline, self.seconds)
+        return self.as_dict()
+
+
+def observe_stages(pipeline, seconds_by_stage):
+    """
+    將各階段秒數寫入 Redis 中的直方圖 (所有 Web/Worker 進程共用)，由 /metrics 端點以 Prometheus 文字格式輸出。
+    """
+    buckets = settings.RAG_METRICS_BUCKETS
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        for stage, seconds in seconds_by_stage.items():
+            key = f"{METRICS_KEY_PREFIX}{pipeline}:{stage}"
+            for bound in buckets:
+                if seconds <= bound:
+                    pipe.hincrby(key, f"le:{bound}", 1)
+            pipe.hincrby(key, 'count', 1)
+            pipe.hincrbyfloat(key, 'sum', seconds)
+        pipe.execute()
+    except redis.RedisError as e:
+        print(f"警告: 寫入階段延遲統計失敗: {e}")
+
+
+def render_metrics():
+    """
+    以 Prometheus 文字格式輸出各流程、各階段的延遲直方圖 (累計 bucket、sum、count)。
+    """
+    client = get_redis()
+    keys = sorted(key.decode() for key in client.scan_iter(match=f"{METRICS_KEY_PREFIX}*"))
+    lines = [
+        f"# HELP {STAGE_HISTOGRAM} Duration of ingest and answer pipeline stages in seconds.",
+        f"# TYPE {STAGE_HISTOGRAM} histogram",
+    ]
+    for key in keys:
+        pipeline, stage = key[len(METRICS_KEY_PREFIX):].split(':', 1)
+        values = {field.decode(): value.decode() for field, value in client.hgetall(key).items()}
+        labels = f'pipeline="{pipeline}",stage="{stage}"'
+        for bound in settings.RAG_METRICS_BUCKETS:
+            lines.append(f'{STAGE_HISTOGRAM}_bucket{{{labels},le="{bound}"}} {values.get(f"le:{bound}", 0)}')
+        lines.append(f'{STAGE_HISTOGRAM}_bucket{{{labels},le="+Inf"}} {values.get("count", 0)}')
+        lines.append(f'{STAGE_HISTOGRAM}_sum{{{labels}}} {values.get("sum", 0)}')
+        lines.append(f'{STAGE_HISTOGRAM}_count{{{labels}}} {values.get("count", 0)}')
+    return "\n".join(lines) + "\n"
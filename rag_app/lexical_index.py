@@ -0,0 +1,207 @@
+import os
+import re
+import threading
+import unicodedata
+from collections import Counter, OrderedDict, defaultdict
+
+import numpy as np
+from django.conf import settings
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+MAX_TERM_LENGTH = 64 # 過長的字串 (例如 base64、網址) 不建索引，避免詞彙表膨脹
+
+# 英數字詞可包含 - _ . / : 等連接符號，保留料號、條款編號 (例如 ISO-9001、3.2.1) 的完整形式
+_WORD_RE = re.compile(r'[a-z0-9]+(?:[-_./:][a-z0-9]+)*')
+_CJK_RE = re.compile(r'[぀-ヿ㐀-䶿一-鿿가-힯豈-﫿]+')
+_SPLIT_RE = re.compile(r'[-_./:]')
+
+
+def tokenize(text):
+    """
+    將文字切成檢索用的詞：英數字詞 (含連接符號的完整形式與各段)，中日韓文字則取相鄰兩字 (bigram)。
+    """
+    text = unicodedata.normalize('NFKC', text).lower()
+    tokens = []
+    for word in _WORD_RE.findall(text):
+        if len(word) <= MAX_TERM_LENGTH:
+            tokens.append(word)
+        if _SPLIT_RE.search(word):
+            tokens.extend(part for part in _SPLIT_RE.split(word) if part and len(part) <= MAX_TERM_LENGTH)
+    for run in _CJK_RE.findall(text):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+def index_path(document_id):
+    return os.path.join(settings.RAG_LEXICAL_INDEX_DIR, f"{document_id}.npz")
+
+
+class LexicalIndexWriter:
+    """
+    在文件向量化的同時逐批累積倒排索引，最後一次寫入磁碟。
+    """
+
+    def __init__(self, document_id):
+        self.document_id = str(document_id)
+        self._ids = []
+        self._lengths = []
+        self._postings = defaultdict(list) # term -> [(row, tf)]
+
+    def add(self, chunk_ids, texts):
+        for chunk_id, text in zip(chunk_ids, texts):
+            row = len(self._ids)
+            counts = Counter(tokenize(text))
+            self._ids.append(chunk_id)
+            self._lengths.append(sum(counts.values()))
+            for term, tf in counts.items():
+                self._postings[term].append((row, min(tf, 65535)))
+
+    def commit(self):
+        """
+        以緊湊格式寫出：排序後的詞彙表、每個詞在 postings 中的起訖位置，以及 (區塊列號 uint32, 詞頻 uint16) 陣列。
+        先寫暫存檔再原子替換，查詢端不會讀到寫到一半的索引。
+        """
+        terms = sorted(self._postings)
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        rows = np.empty(sum(len(postings) for postings in self._postings.values()), dtype=np.uint32)
+        tfs = np.empty(len(rows), dtype=np.uint16)
+        position = 0
+        for i, term in enumerate(terms):
+            postings = self._postings[term]
+            rows[position:position + len(postings)] = [row for row, _ in postings]
+            tfs[position:position + len(postings)] = [tf for _, tf in postings]
+            position += len(postings)
+            offsets[i + 1] = position
+
+        path = index_path(self.document_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez(
+                f,
+                terms=np.array(terms, dtype=str),
+                offsets=offsets,
+                rows=rows,
+                tfs=tfs,
+                lengths=np.array(self._lengths, dtype=np.uint32),
+                ids=np.array(self._ids, dtype=str),
+            )
+        os.replace(tmp_path, path)
+        _forget(self.document_id)
+        return len(self._ids)
+
+
+class LexicalIndex:
+    """
+    單一文件的 BM25 倒排索引 (唯讀，整份載入記憶體)。
+    """
+
+    def __init__(self, terms, offsets, rows, tfs, lengths, ids):
+        self.terms = terms
+        self.offsets = offsets
+        self.rows = rows
+        self.tfs = tfs.astype(np.float32)
+        self.ids = ids
+        avgdl = float(lengths.mean()) if len(lengths) else 0.0
+        # BM25 分母中與查詢無關的部分預先算好
+        self._length_norm = (BM25_K1 * (1 - BM25_B + BM25_B * lengths / avgdl)).astype(np.float32) if avgdl else \
+            np.full(len(lengths), BM25_K1, dtype=np.float32)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['terms'], data['offsets'], data['rows'], data['tfs'], data['lengths'], data['ids'])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def search(self, query_terms, k):
+        """
+        回傳 [(chunk_id, bm25 分數)]，依分數由高到低。
+        """
+        count = len(self.ids)
+        if not count or not len(self.terms):
+            return []
+        scores = np.zeros(count, dtype=np.float32)
+        for term in query_terms:
+            i = int(np.searchsorted(self.terms, term))
+            if i >= len(self.terms) or self.terms[i] != term:
+                continue
+            start, end = self.offsets[i], self.offsets[i + 1]
+            rows = self.rows[start:end]
+            tf = self.tfs[start:end]
+            df = end - start
+            idf = np.log(1 + (count - df + 0.5) / (df + 0.5))
+            scores[rows] += idf * tf * (BM25_K1 + 1) / (tf + self._length_norm[rows])
+
+        matched = np.flatnonzero(scores)
+        if not len(matched):
+            return []
+        if len(matched) > k:
+            matched = matched[np.argpartition(-scores[matched], k - 1)[:k]]
+        matched = matched[np.argsort(-scores[matched], kind='stable')]
+        return [(str(self.ids[row]), float(scores[row])) for row in matched]
+
+
+_loaded = OrderedDict() # document_id -> (mtime, LexicalIndex)
+_loaded_lock = threading.Lock()
+
+
+def _forget(document_id):
+    with _loaded_lock:
+        _loaded.pop(str(document_id), None)
+
+
+def get_index(document_id):
+    """
+    取得文件的倒排索引 (進程內以 LRU 快取，檔案更新後自動重新載入)；尚未建立時回傳 None。
+    """
+    document_id = str(document_id)
+    try:
+        mtime = os.stat(index_path(document_id)).st_mtime_ns
+    except FileNotFoundError:
+        _forget(document_id)
+        return None
+
+    with _loaded_lock:
+        cached = _loaded.get(document_id)
+        if cached is not None and cached[0] == mtime:
+            _loaded.move_to_end(document_id)
+            return cached[1]
+
+    index = LexicalIndex.load(index_path(document_id))
+    with _loaded_lock:
+        _loaded[document_id] = (mtime, index)
+        _loaded.move_to_end(document_id)
+        while len(_loaded) > settings.RAG_LEXICAL_INDEX_CACHE_SIZE:
+            _loaded.popitem(last=False)
+    return index
+
+
+def delete_index(document_id):
+    _forget(document_id)
+    try:
+        os.remove(index_path(document_id))
+    except FileNotFoundError:
+        pass
+
+
+def search_documents(documents, query, k):
+    """
+    在多個文件的倒排索引中以 BM25 檢索，回傳 [(chunk_id, 分數, 文件)]，依分數由高到低取前 k 個。
+    """
+    query_terms = set(tokenize(query))
+    if not query_terms:
+        return []
+    hits = []
+    for document in documents:
+        index = get_index(document.id)
+        if index is None:
+            continue
+        hits.extend((chunk_id, score, document) for chunk_id, score in index.search(query_terms, k))
+    hits.sort(key=lambda hit: -hit[1])
+    return hits[:k]
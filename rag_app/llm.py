@@ -0,0 +1,107 @@
+import json
+import threading
+import time
+
+import httpx
+
+QA_PROMPT_TEMPLATE = """
+        Use the following pieces of context to answer the user's question.
+        If you don't know the answer, just say that you don't know, don't try to make up an answer.
+        ----------------
+        Context: {context}
+        ----------------
+        Question: {question}
+        ----------------
+        Helpful Answer:"""
+
+
+class OllamaClient:
+    """
+    Ollama /api/generate 的輕量客戶端。
+
+    使用單一 httpx.Client 保持 HTTP keep-alive 連線，並以 keep_alive 參數讓 Ollama 將模型常駐記憶體，
+    避免每個問題都重新建立連線與載入模型。
+    同時進行的生成請求數以 max_parallel 限制 (應與 Ollama 的 OLLAMA_NUM_PARALLEL 一致)，多出的請求在進程內排隊，
+    不會在 Ollama 端堆積成逾時。
+    """
+
+    def __init__(self, base_url, model, keep_alive='30m', timeout=300, max_parallel=4):
+        self.base_url = base_url
+        self.model = model
+        self.keep_alive = keep_alive
+        self.timeout = timeout
+        self._http = httpx.Client(
+            base_url=base_url,
+            timeout=httpx.Timeout(timeout, connect=10),
+            limits=httpx.Limits(max_connections=max_parallel, max_keepalive_connections=max_parallel),
+        )
+        self.max_parallel = max_parallel
+        self._slots = threading.BoundedSemaphore(max_parallel)
+        self.request_count = 0
+        self.total_seconds = 0.0
+        self.slot_wait_seconds = 0.0 # 等待生成名額的累計時間
+
+    def _payload(self, prompt, stream):
+        return {
+            'model': self.model,
+            'prompt': prompt,
+            'stream': stream,
+            'keep_alive': self.keep_alive,
+        }
+
+    def _acquire_slot(self, deadline=None):
+        started = time.perf_counter()
+        acquired = self._slots.acquire(timeout=None if deadline is None else max(0, deadline - time.monotonic()))
+        self.slot_wait_seconds += time.perf_counter() - started
+        if not acquired:
+            raise TimeoutError("等待 Ollama 生成名額逾時。")
+
+    def _request_timeout(self, deadline):
+        # 有期限時，連線與每次讀取的等待都不超過剩餘時間
+        if deadline is None:
+            return httpx.USE_CLIENT_DEFAULT
+        remaining = max(0.001, deadline - time.monotonic())
+        return httpx.Timeout(min(self.timeout, remaining), connect=min(10, remaining))
+
+    def generate(self, prompt):
+        self._acquire_slot()
+        started = time.perf_counter()
+        try:
+            response = self._http.post('/api/generate', json=self._payload(prompt, stream=False))
+            response.raise_for_status()
+            return response.json().get('response', '')
+        finally:
+            self._slots.release()
+            self.request_count += 1
+            self.total_seconds += time.perf_counter() - started
+
+    def stream(self, prompt, deadline=None):
+        """
+        逐一產出 Ollama 生成的 token 片段 (生成名額保留到串流結束)。
+        deadline 為 time.monotonic() 的期限：等待生成名額、連線與讀取都受剩餘時間限制，超過期限時拋出 TimeoutError。
+        """
+        self._acquire_slot(deadline)
+        started = time.perf_counter()
+        try:
+            with self._http.stream('POST', '/api/generate', json=self._payload(prompt, stream=True),
+                                   timeout=self._request_timeout(deadline)) as response:
+                response.raise_for_status()
+                for line in response.iter_lines():
+                    if deadline is not None and time.monotonic() > deadline:
+                        raise TimeoutError("Ollama 生成超過時間限制。")
+                    if not line:
+                        continue
+                    data = json.loads(line)
+                    if data.get('error'):
+                        raise RuntimeError(data['error'])
+                    if data.get('response'):
+                        yield data['response']
+                    if data.get('done'):
+                        break
+        finally:
+            self._slots.release()
+            self.request_count += 1
+            self.total_seconds += time.perf_counter() - started
+
+    def close(self):
+        self._http.close()
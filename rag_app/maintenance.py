@@ -0,0 +1,420 @@
+import json
+import os
+import shutil
+import sqlite3
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.utils import timezone
+
+from . import lexical_index, quantized_index
+from .models import Document
+from .registry import get_redis
+from .vector_layout import LAYOUT_PER_DOCUMENT, LAYOUT_SHARED
+
+MAINTENANCE_LOCK_KEY = 'rag:maintenance:lock'
+MAINTENANCE_REPORT_KEY = 'rag:maintenance:report'
+MAINTENANCE_ORPHANS_KEY = 'rag:maintenance:orphans' # ChromaDB 中沒有檔案時間可依據的孤兒第一次被發現的時間
+CHROMA_SQLITE_FILENAME = 'chroma.sqlite3'
+
+
+class MaintenanceRunning(Exception):
+    pass
+
+
+@contextmanager
+def exclusive_run(timeout):
+    """
+    以 Redis 鎖確保同一時間只有一次維護 (Celery beat 排程與管理命令不會同時清理)；已有維護在執行時拋出 MaintenanceRunning。
+    """
+    lock = get_redis().lock(MAINTENANCE_LOCK_KEY, timeout=timeout)
+    if not lock.acquire(blocking=False):
+        raise MaintenanceRunning("已有向量庫維護正在執行。")
+    try:
+        yield
+    finally:
+        try:
+            lock.release()
+        except Exception:
+            pass # 鎖已逾時釋放
+
+
+def store_report(report):
+    get_redis().set(MAINTENANCE_REPORT_KEY, json.dumps(report))
+
+
+def read_report():
+    raw = get_redis().get(MAINTENANCE_REPORT_KEY)
+    return json.loads(raw) if raw else None
+
+
+def _load_first_seen():
+    return {
+        (key.decode() if isinstance(key, bytes) else key): float(value)
+        for key, value in get_redis().hgetall(MAINTENANCE_ORPHANS_KEY).items()
+    }
+
+
+def _store_first_seen(first_seen):
+    pipeline = get_redis().pipeline()
+    pipeline.delete(MAINTENANCE_ORPHANS_KEY)
+    if first_seen:
+        pipeline.hset(MAINTENANCE_ORPHANS_KEY, mapping=first_seen)
+    pipeline.execute()
+
+
+def _path_bytes(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def _remove_path(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _older_than(path, seconds):
+    try:
+        return time.time() - os.path.getmtime(path) >= seconds
+    except OSError:
+        return False
+
+
+def _parse_uuid(value):
+    try:
+        return str(uuid.UUID(value))
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+
+def _read_chroma_segments(chroma_path):
+    """
+    從 chroma.sqlite3 讀取每個 Collection 的 segment ID，回傳 {Collection 名稱: [segment ID]}。
+    向量 (HNSW) segment 以 segment ID 為目錄名稱存放在 chroma_db/ 下；讀取失敗 (例如 Chroma 版本的結構不同) 時回傳 None，
+    此時不回收 segment 目錄，只依 Collection 回報大小。
+    """
+    path = os.path.join(chroma_path, CHROMA_SQLITE_FILENAME)
+    if not os.path.exists(path):
+        return None
+    try:
+        connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=30)
+        try:
+            rows = connection.execute(
+                "SELECT c.name, s.id FROM segments s JOIN collections c ON c.id = s.collection"
+            ).fetchall()
+        finally:
+            connection.close()
+    except sqlite3.Error as e:
+        print(f"警告: 無法讀取 Chroma 的 segment 資訊: {e}")
+        return None
+    segments = {}
+    for name, segment_id in rows:
+        segments.setdefault(name, []).append(str(segment_id))
+    return segments
+
+
+def _sqlite_stats(path):
+    # (檔案大小, 可由 VACUUM 回收的空頁大小)
+    connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=30)
+    try:
+        page_size = connection.execute("PRAGMA page_size").fetchone()[0]
+        free_pages = connection.execute("PRAGMA freelist_count").fetchone()[0]
+    finally:
+        connection.close()
+    return os.path.getsize(path), page_size * free_pages
+
+
+def vacuum_chroma(chroma_path):
+    """
+    VACUUM chroma.sqlite3 以回收刪除區塊後留下的空頁，回傳秒數。VACUUM 期間資料庫被鎖定，寫入會等待。
+    """
+    started = time.perf_counter()
+    connection = sqlite3.connect(os.path.join(chroma_path, CHROMA_SQLITE_FILENAME), timeout=300)
+    try:
+        connection.execute("VACUUM")
+    finally:
+        connection.close()
+    return time.perf_counter() - started
+
+
+def _collection_names(client):
+    # 不同版本的 chromadb 回傳 Collection 物件或名稱
+    return [getattr(collection, 'name', collection) for collection in client.list_collections()]
+
+
+def _is_shard(name):
+    return name.startswith(f"{settings.RAG_SHARED_COLLECTION_PREFIX}_")
+
+
+def _scan_shard_sources(collection, batch_size):
+    # 共用分片中每個 source_file_id 的區塊數
+    counts = Counter()
+    offset = 0
+    while True:
+        batch = collection.get(include=['metadatas'], limit=batch_size, offset=offset)
+        if not batch['ids']:
+            break
+        counts.update((metadata or {}).get('source_file_id') for metadata in batch['metadatas'])
+        offset += len(batch['ids'])
+    return counts
+
+
+def _is_orphan(document, layout):
+    """
+    資料表中沒有對應文件，或文件已完成向量化但存放在另一種配置 (例如搬移配置時沒有清除的來源) 的向量視為孤兒。
+    處理中或失敗的文件保留既有向量，續傳與重試時可以沿用。
+    """
+    if document is None:
+        return True
+    return document['status'] == 'COMPLETED' and document['index_layout'] != layout
+
+
+def _still_orphan(document_id, layout):
+    # 刪除前重新讀取文件：掃描開始後才建立 (或搬移配置) 的文件不能依開始時的快照刪除
+    return _is_orphan(Document.objects.filter(id=document_id).values('status', 'index_layout').first(), layout)
+
+
+def run_maintenance(registry, reclaim=True, vacuum=None, grace_seconds=None, batch_size=None):
+    """
+    比對 Document 與 ChromaDB、倒排/量化索引及 media 檔案，回收孤兒資料並回報每個文件的索引大小。
+
+    - reclaim：False 時只回報 (dry run)。
+    - vacuum：None 表示可回收空間超過 RAG_MAINTENANCE_VACUUM_MIN_FREE_BYTES 時才 VACUUM chroma.sqlite3；True/False 強制執行/略過。
+    - grace_seconds：孤兒至少存在這麼久才回收，避免清掉正在上傳或寫入的資料。檔案與目錄依修改時間；
+      每文件 Collection 依 segment 目錄的修改時間，沒有 segment 目錄可依據時 (以及共用分片中的區塊) 依第一次被維護發現的時間
+      (記錄在 Redis)，因此這類孤兒最早在發現後的下一次維護才回收。
+    刪除任何資料前都會重新查詢文件是否存在，掃描開始後才建立的文件不受影響。
+    """
+    started = time.perf_counter()
+    grace_seconds = settings.RAG_MAINTENANCE_ORPHAN_GRACE_SECONDS if grace_seconds is None else grace_seconds
+    batch_size = batch_size or settings.RAG_MAINTENANCE_SCAN_BATCH_SIZE
+    chroma_path = registry.chroma_path
+
+    documents = {
+        str(row['id']): row
+        for row in Document.objects.values('id', 'filename', 'status', 'index_layout', 'file')
+    }
+    orphans = {key: [] for key in (
+        'collections', 'shared_chunks', 'segments', 'lexical_indexes', 'quantized_indexes', 'media_files', 'partial_uploads',
+    )}
+    reclaimed_bytes = 0
+    missing_indexes, missing_files = [], []
+    now = time.time()
+    previous_seen, first_seen = _load_first_seen(), {}
+
+    def grace_passed(key):
+        # 依第一次被發現的時間判斷；只保留本次仍被發現且未回收的孤兒，下一次維護沿用
+        first_seen[key] = previous_seen.get(key, now)
+        return now - first_seen[key] >= grace_seconds
+
+    def reclaim_path(kind, path, label=None):
+        nonlocal reclaimed_bytes
+        size = _path_bytes(path)
+        orphans[kind].append({'name': label or os.path.basename(path), 'bytes': size})
+        if reclaim:
+            _remove_path(path)
+            reclaimed_bytes += size
+
+    # 1. ChromaDB：每文件 Collection 與共用分片中的區塊
+    client = registry.get_chroma_client()
+    segments = _read_chroma_segments(chroma_path)
+    collection_chunks = {}
+    shard_sources = {}
+    for name in _collection_names(client):
+        collection = client.get_collection(name=name)
+        if _is_shard(name):
+            sources = _scan_shard_sources(collection, batch_size)
+            collection_chunks[name] = sum(sources.values())
+            for source, count in sources.items():
+                source_id = _parse_uuid(source)
+                if source_id is None or not _is_orphan(documents.get(source_id), LAYOUT_SHARED):
+                    continue
+                key = f"shard:{name}:{source_id}"
+                if not grace_passed(key) or not _still_orphan(source_id, LAYOUT_SHARED):
+                    continue
+                orphans['shared_chunks'].append({'name': name, 'document': source_id, 'chunks': count})
+                if reclaim:
+                    collection.delete(where={'source_file_id': source})
+                    collection_chunks[name] -= count
+                    del first_seen[key]
+            shard_sources[name] = sources
+            continue
+        document_id = _parse_uuid(name)
+        if document_id is None:
+            continue # 不是本專案建立的 Collection，不處理
+        if _is_orphan(documents.get(document_id), LAYOUT_PER_DOCUMENT):
+            segment_paths = [os.path.join(chroma_path, segment) for segment in (segments or {}).get(name, ())]
+            existing_paths = [path for path in segment_paths if os.path.exists(path)]
+            key = f"collection:{name}"
+            if existing_paths:
+                old_enough = all(_older_than(path, grace_seconds) for path in existing_paths)
+            else:
+                old_enough = grace_passed(key)
+            if old_enough and _still_orphan(document_id, LAYOUT_PER_DOCUMENT):
+                size = sum(_path_bytes(path) for path in segment_paths)
+                orphans['collections'].append({'name': name, 'chunks': collection.count(), 'bytes': size})
+                if reclaim:
+                    registry.evict_vector_store(name)
+                    client.delete_collection(name=name)
+                    for path in segment_paths:
+                        _remove_path(path) # 部分 chromadb 版本刪除 Collection 時不會刪除 segment 目錄
+                    reclaimed_bytes += size
+                    first_seen.pop(key, None)
+                    continue
+            collection_chunks[name] = collection.count()
+            continue
+        collection_chunks[name] = collection.count()
+
+    # 刪除 Collection 後仍留在磁碟上的向量 segment 目錄
+    if segments is not None:
+        known_segments = {segment for ids in segments.values() for segment in ids}
+        for entry in os.listdir(chroma_path):
+            path = os.path.join(chroma_path, entry)
+            if (os.path.isdir(path) and _parse_uuid(entry) and entry not in known_segments
+                    and _older_than(path, grace_seconds)):
+                reclaim_path('segments', path)
+
+    for document_id, document in documents.items():
+        if document['status'] != 'COMPLETED':
+            continue
+        if document['index_layout'] == LAYOUT_SHARED:
+            indexed = any(sources.get(document_id) for sources in shard_sources.values())
+        else:
+            indexed = bool(collection_chunks.get(document_id))
+        if not indexed:
+            missing_indexes.append(document_id)
+
+    # 2. 倒排索引、量化索引與寫到一半的暫存檔
+    for directory, kind, delete_index in (
+        (settings.RAG_LEXICAL_INDEX_DIR, 'lexical_indexes', lexical_index.delete_index),
+        (settings.RAG_QUANTIZED_INDEX_DIR, 'quantized_indexes', quantized_index.delete_index),
+    ):
+        if not os.path.isdir(directory):
+            continue
+        for entry in os.listdir(directory):
+            path = os.path.join(directory, entry)
+            if entry.endswith(('.tmp', '.old')):
+                if _older_than(path, grace_seconds):
+                    reclaim_path(kind, path)
+                continue
+            document_id = _parse_uuid(entry.split('.', 1)[0])
+            if (document_id is None or document_id in documents or not _older_than(path, grace_seconds)
+                    or Document.objects.filter(id=document_id).exists()):
+                continue
+            size = _path_bytes(path)
+            orphans[kind].append({'name': entry, 'bytes': size})
+            if reclaim:
+                delete_index(document_id)
+                reclaimed_bytes += size
+
+    # 3. media 檔案：沒有文件引用的上傳檔案與中斷的串流上傳
+    referenced = {os.path.normpath(document['file']) for document in documents.values() if document['file']}
+    media_dir = os.path.join(settings.MEDIA_ROOT, 'documents')
+    if os.path.isdir(media_dir):
+        for entry in os.listdir(media_dir):
+            path = os.path.join(media_dir, entry)
+            relative = os.path.normpath(os.path.relpath(path, settings.MEDIA_ROOT))
+            if (os.path.isfile(path) and relative not in referenced and _older_than(path, grace_seconds)
+                    and not Document.objects.filter(file=relative).exists()):
+                reclaim_path('media_files', path, relative)
+    if os.path.isdir(settings.RAG_STREAM_UPLOAD_TMP_DIR):
+        for entry in os.listdir(settings.RAG_STREAM_UPLOAD_TMP_DIR):
+            path = os.path.join(settings.RAG_STREAM_UPLOAD_TMP_DIR, entry)
+            if _older_than(path, grace_seconds):
+                reclaim_path('partial_uploads', path)
+    for document_id, document in documents.items():
+        if not document['file'] or not os.path.exists(os.path.join(settings.MEDIA_ROOT, document['file'])):
+            missing_files.append(document_id)
+
+    _store_first_seen(first_seen)
+
+    # 4. 壓縮 chroma.sqlite3
+    chroma_stats = {'collections': len(collection_chunks), 'vacuumed': False}
+    sqlite_path = os.path.join(chroma_path, CHROMA_SQLITE_FILENAME)
+    if os.path.exists(sqlite_path):
+        try:
+            sqlite_bytes, free_bytes = _sqlite_stats(sqlite_path)
+            if vacuum is None:
+                threshold = settings.RAG_MAINTENANCE_VACUUM_MIN_FREE_BYTES
+                vacuum = threshold is not None and free_bytes >= threshold
+            if vacuum and reclaim:
+                chroma_stats['vacuum_seconds'] = round(vacuum_chroma(chroma_path), 3)
+                chroma_stats['vacuumed'] = True
+                new_bytes, _ = _sqlite_stats(sqlite_path)
+                reclaimed_bytes += max(0, sqlite_bytes - new_bytes)
+                sqlite_bytes, free_bytes = new_bytes, 0
+            chroma_stats.update({'sqlite_bytes': sqlite_bytes, 'free_bytes': free_bytes})
+        except sqlite3.Error as e:
+            chroma_stats['error'] = str(e)
+            print(f"警告: 壓縮 chroma.sqlite3 失敗: {e}")
+
+    # 5. 每個文件的索引大小：每文件 Collection 直接計算 segment 目錄；共用分片依區塊數分攤，
+    # chroma.sqlite3 (區塊文字與 metadata) 也依區塊數分攤
+    collection_bytes = {
+        name: sum(_path_bytes(os.path.join(chroma_path, segment)) for segment in (segments or {}).get(name, ()))
+        for name in collection_chunks
+    }
+    total_chunks = sum(collection_chunks.values())
+    sqlite_used = chroma_stats.get('sqlite_bytes', 0) - chroma_stats.get('free_bytes', 0)
+    document_sizes = []
+    for document_id, document in documents.items():
+        if document['index_layout'] == LAYOUT_SHARED:
+            shard, chunks = next(
+                ((name, sources[document_id]) for name, sources in shard_sources.items() if sources.get(document_id)), (None, 0)
+            )
+            vector_bytes = collection_bytes[shard] * chunks // collection_chunks[shard] if shard and collection_chunks[shard] else 0
+        else:
+            chunks = collection_chunks.get(document_id, 0)
+            vector_bytes = collection_bytes.get(document_id, 0)
+        chroma_bytes = vector_bytes + (sqlite_used * chunks // total_chunks if total_chunks else 0)
+        sizes = {
+            'chroma_bytes': chroma_bytes,
+            'lexical_bytes': _path_bytes(lexical_index.index_path(document_id)),
+            'quantized_bytes': _path_bytes(quantized_index.index_path(document_id)),
+            'file_bytes': _path_bytes(os.path.join(settings.MEDIA_ROOT, document['file'])) if document['file'] else 0,
+        }
+        document_sizes.append({
+            'id': document_id,
+            'filename': document['filename'],
+            'status': document['status'],
+            'layout': document['index_layout'],
+            'chunks': chunks,
+            **sizes,
+            'total_bytes': sum(sizes.values()),
+        })
+    document_sizes.sort(key=lambda item: -item['total_bytes'])
+    chroma_stats['bytes'] = _path_bytes(chroma_path) if os.path.isdir(chroma_path) else 0
+
+    return {
+        'finished_at': timezone.now().isoformat(),
+        'seconds': round(time.perf_counter() - started, 3),
+        'reclaim': reclaim,
+        'orphans': orphans,
+        'reclaimed_bytes': reclaimed_bytes,
+        'missing_indexes': missing_indexes,
+        'missing_files': missing_files,
+        'chroma': chroma_stats,
+        'totals': {
+            'documents': len(documents),
+            'chunks': total_chunks,
+            **{key: sum(item[key] for item in document_sizes)
+               for key in ('chroma_bytes', 'lexical_bytes', 'quantized_bytes', 'file_bytes', 'total_bytes')},
+        },
+        'documents': document_sizes,
+    }
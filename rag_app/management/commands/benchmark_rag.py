@@ -0,0 +1,162 @@
+import os
+import re
+import shutil
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from rag_app.benchmark import (
+    BenchmarkRun, ExtractiveLLM, SyntheticCorpus, compare_results, environment_info, facts_per_document,
+    isolated_environment, load_results, save_results,
+)
+
+DEFAULT_CORPORA = ['1x10', '100x10', '10x100']
+
+
+def _parse_corpus(value):
+    match = re.fullmatch(r'(\d+)x(\d+)', value)
+    if not match or int(match.group(1)) < 1 or int(match.group(2)) < 1:
+        raise CommandError(f"語料規模格式應為 <文件數>x<每份頁數>，例如 100x10: {value}")
+    return int(match.group(1)), int(match.group(2))
+
+
+class Command(BaseCommand):
+    help = (
+        "離線基準測試：產生合成 PDF 語料，以 eager 模式執行實際的匯入與問答任務 (LLM 換成決定性的替身，不需要 Ollama)，"
+        "輸出區塊/嵌入吞吐量、檢索延遲百分位數、峰值 RSS 與索引磁碟大小，並存成 JSON 供不同 commit 比較。"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--corpus', action='append', dest='corpora',
+                            help=f"語料規模 <文件數>x<每份頁數> (可重複，預設 {' '.join(DEFAULT_CORPORA)})")
+        parser.add_argument('--questions', type=int, default=50, help="每個語料的提問數")
+        parser.add_argument('--words-per-page', type=int, default=300, help="每頁的詞數")
+        parser.add_argument('--seed', type=int, default=0, help="語料與提問順序的亂數種子")
+        parser.add_argument('--ingest-mode', choices=['document', 'bulk'], default='document',
+                            help="document：每個文件一個匯入任務；bulk：與批次上傳相同的分派方式")
+        parser.add_argument('--scope', choices=['DOCUMENT', 'CORPUS'], default='DOCUMENT', help="提問範圍")
+        parser.add_argument('--qa-concurrency', type=int, default=1, help="同時進行的問答數 (以執行緒模擬 threads pool)")
+        parser.add_argument('--search-queries', type=int, default=100,
+                            help="語意搜尋 API (單一文件與跨文件) 各量測的請求數，0 表示略過")
+        parser.add_argument('--require-search-target', action='store_true',
+                            help=f"單一文件搜尋的 p95 延遲超過 RAG_SEARCH_LATENCY_TARGET_MS ({settings.RAG_SEARCH_LATENCY_TARGET_MS} 毫秒) 時以錯誤結束")
+        parser.add_argument('--llm-token-delay-ms', type=float, default=0.0, help="LLM 替身每個詞的生成延遲")
+        parser.add_argument('--with-embedding-cache', action='store_true', help="使用嵌入快取 (預設停用，每次都實際計算嵌入)")
+        parser.add_argument('--redis-url', help="答案串流與統計使用的 Redis (預設 RAG_REDIS_URL)")
+        parser.add_argument('--workdir', help="資料庫、文件與索引的工作目錄 (預設為暫存目錄)")
+        parser.add_argument('--keep-workdir', action='store_true', help="結束後保留工作目錄")
+        parser.add_argument('--output', help="結果 JSON 的路徑 (預設 benchmark_results/<commit>-<時間>.json)")
+        parser.add_argument('--compare', help="與先前的結果 JSON 比較")
+        parser.add_argument('--max-regression', type=float,
+                            help="與 --compare 一起使用：任一指標退步超過此百分比時以錯誤結束")
+
+    def handle(self, *args, **options):
+        corpora = [_parse_corpus(value) for value in options['corpora'] or DEFAULT_CORPORA]
+        if options['questions'] < 0 or options['search_queries'] < 0 or options['words_per_page'] < 1:
+            raise CommandError("--questions 與 --search-queries 不可為負數，--words-per-page 必須大於 0。")
+        if options['require_search_target'] and not options['search_queries']:
+            raise CommandError("--require-search-target 需要 --search-queries 大於 0。")
+        if options['max_regression'] is not None and not options['compare']:
+            raise CommandError("--max-regression 需要與 --compare 一起使用。")
+        baseline = load_results(options['compare']) if options['compare'] else None
+
+        results = {
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'environment': environment_info(),
+            'options': {
+                key: options[key] for key in (
+                    'questions', 'words_per_page', 'seed', 'ingest_mode', 'scope', 'qa_concurrency',
+                    'search_queries', 'llm_token_delay_ms', 'with_embedding_cache',
+                )
+            },
+            'runs': [],
+        }
+        root = options['workdir'] or tempfile.mkdtemp(prefix='rag-benchmark-')
+        try:
+            for documents, pages in corpora:
+                self.stdout.write(f"語料 {documents}x{pages}：產生文件並執行匯入與問答...")
+                workdir = os.path.join(root, f"{documents}x{pages}")
+                shutil.rmtree(workdir, ignore_errors=True)
+                os.makedirs(workdir)
+                corpus = SyntheticCorpus(
+                    documents, pages, words_per_page=options['words_per_page'],
+                    facts_per_document=facts_per_document(documents, options['questions']), seed=options['seed'],
+                )
+                run = BenchmarkRun(
+                    corpus, questions=options['questions'], ingest_mode=options['ingest_mode'],
+                    scope=options['scope'], qa_concurrency=options['qa_concurrency'],
+                    search_queries=options['search_queries'],
+                )
+                llm = ExtractiveLLM(token_delay=options['llm_token_delay_ms'] / 1000,
+                                    max_parallel=settings.RAG_OLLAMA_NUM_PARALLEL)
+                with isolated_environment(workdir, llm, redis_url=options['redis_url'],
+                                          embedding_cache=options['with_embedding_cache']) as registry:
+                    result = run.run(registry)
+                results['runs'].append(result)
+                self._report(result)
+        finally:
+            if not options['keep_workdir'] and not options['workdir']:
+                shutil.rmtree(root, ignore_errors=True)
+
+        output = options['output'] or os.path.join(
+            settings.BASE_DIR, 'benchmark_results',
+            f"{(results['environment']['git_commit'] or 'unknown')[:12]}-{time.strftime('%Y%m%d-%H%M%S')}.json",
+        )
+        save_results(output, results)
+        self.stdout.write(self.style.SUCCESS(f"結果已寫入 {output}"))
+
+        if baseline is not None:
+            self._compare(baseline, results, options['max_regression'])
+        if options['require_search_target']:
+            missed = [
+                f"{result['corpus']['documents']}x{result['corpus']['pages_per_document']}"
+                for result in results['runs'] if not result['search']['document_within_target']
+            ]
+            if missed:
+                raise CommandError(
+                    f"語料 {', '.join(missed)} 的單一文件搜尋 p95 延遲超過 {settings.RAG_SEARCH_LATENCY_TARGET_MS} 毫秒。"
+                )
+
+    def _report(self, result):
+        ingest, qa, resources = result['ingest'], result['qa'], result['resources']
+        retrieve = qa.get('retrieve_seconds', {})
+        self.stdout.write(
+            f"  匯入 {ingest['documents_completed']} 個文件 ({ingest['documents_failed']} 個失敗)、"
+            f"{ingest['pages']} 頁、{ingest['chunks']} 個區塊，耗時 {ingest['seconds']} 秒："
+            f"{ingest['chunks_per_second']} 區塊/秒，{ingest['embeddings_per_second']} 嵌入/秒"
+        )
+        self.stdout.write(
+            f"  問答 {qa['completed']}/{qa['questions']}：{qa['answers_per_second']} 題/秒，"
+            f"檢索 p50/p95/p99 = {retrieve.get('p50')}/{retrieve.get('p95')}/{retrieve.get('p99')} 秒，"
+            f"命中率 {qa['retrieval_hit_rate']}"
+        )
+        search = result.get('search')
+        if search:
+            for name, label in (('document', '單一文件'), ('corpus', '跨文件')):
+                latency = {key: None if value is None else round(value * 1000, 1)
+                           for key, value in search[name]['latency_seconds'].items()}
+                line = (
+                    f"  {label}搜尋 {search[name]['completed']}/{search[name]['queries']}："
+                    f"p50/p95/p99 = {latency['p50']}/{latency['p95']}/{latency['p99']} 毫秒 "
+                    f"(目標 p95 ≤ {search['target_ms']})，命中率 {search[name]['hit_rate']}"
+                )
+                within = search[f'{name}_within_target']
+                self.stdout.write(line if within is not False else self.style.WARNING(line))
+        self.stdout.write(f"  峰值 RSS {resources['peak_rss_mb']} MB，索引 {resources['index_disk_mb']} MB")
+
+    def _compare(self, baseline, results, max_regression):
+        rows = compare_results(baseline, results)
+        if not rows:
+            self.stdout.write(self.style.WARNING("基準結果中沒有相同規模的語料，無法比較。"))
+            return
+        commit = (baseline.get('environment', {}).get('git_commit') or 'unknown')[:12]
+        self.stdout.write(f"與 {commit} 的結果比較 (正值表示改善)：")
+        worst = 0.0
+        for corpus, metric, before, after, change, regressed in rows:
+            line = f"  {corpus:>10} {metric:<32} {before:>12} -> {after:<12} {change:+.1f}%"
+            self.stdout.write(self.style.ERROR(line) if regressed else line)
+            worst = min(worst, change)
+        if max_regression is not None and -worst > max_regression:
+            raise CommandError(f"效能退步 {-worst:.1f}% 超過容許的 {max_regression}%。")
@@ -0,0 +1,54 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from rag_app import lexical_index
+from rag_app.models import Document
+from rag_app.registry import get_registry
+from rag_app.vector_layout import index_target
+
+
+class Command(BaseCommand):
+    help = "從 ChromaDB 中已存的區塊為文件建立 BM25 關鍵字倒排索引 (不重新解析文件或計算嵌入)。"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help="每次從 Collection 讀取的區塊數")
+        parser.add_argument('--document', action='append', dest='documents', help="只處理指定的文件ID (可重複)")
+        parser.add_argument('--rebuild', action='store_true', help="已有倒排索引的文件也重新建立")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if batch_size <= 0:
+            raise CommandError("--batch-size 必須大於 0。")
+
+        documents = Document.objects.filter(status='COMPLETED')
+        if options['documents']:
+            documents = documents.filter(id__in=options['documents'])
+
+        registry = get_registry()
+        built = 0
+        for document in documents.order_by('uploaded_at'):
+            if not options['rebuild'] and os.path.exists(lexical_index.index_path(document.id)):
+                continue
+            try:
+                count = self._build(registry, document, batch_size)
+            except Exception as e:
+                self.stderr.write(self.style.ERROR(f"文件 {document.id} 建立倒排索引失敗: {e}"))
+                continue
+            built += 1
+            self.stdout.write(f"文件 {document.filename} (ID: {document.id}) 已建立倒排索引，共 {count} 個區塊。")
+
+        self.stdout.write(self.style.SUCCESS(f"完成，共處理 {built} 個文件。"))
+
+    def _build(self, registry, document, batch_size):
+        target = index_target(document.id, document.index_layout)
+        collection = registry.get_vector_store(target.collection_name)._collection
+        writer = lexical_index.LexicalIndexWriter(document.id)
+        offset = 0
+        while True:
+            batch = collection.get(where=target.where, limit=batch_size, offset=offset, include=['documents'])
+            if not batch['ids']:
+                break
+            writer.add(batch['ids'], batch['documents'])
+            offset += len(batch['ids'])
+        return writer.commit()
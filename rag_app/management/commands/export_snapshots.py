@@ -0,0 +1,55 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from rag_app.models import Document
+from rag_app.registry import get_registry
+from rag_app.snapshots import SnapshotError, export_snapshot, snapshot_filename
+
+
+class Command(BaseCommand):
+    help = (
+        "將已完成向量化的文件 (區塊、metadata 與嵌入) 匯出成每個文件一個的快照檔 (.ragsnap)，"
+        "其他節點以 import_snapshots 直接載入向量庫，不必重新解析與計算嵌入。"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output-dir', default=settings.RAG_SNAPSHOT_DIR,
+                            help=f"快照輸出目錄 (預設 RAG_SNAPSHOT_DIR={settings.RAG_SNAPSHOT_DIR})")
+        parser.add_argument('--document', action='append', dest='documents', help="只匯出指定的文件ID (可重複)")
+        parser.add_argument('--without-file', action='store_true', help="不包含原始上傳檔案 (快照較小，但匯入端無法替換或重新處理文件)")
+        parser.add_argument('--skip-existing', action='store_true', help="輸出目錄中已有較新快照的文件略過")
+
+    def handle(self, *args, **options):
+        output_dir = options['output_dir']
+        os.makedirs(output_dir, exist_ok=True)
+        documents = Document.objects.filter(status='COMPLETED')
+        if options['documents']:
+            documents = documents.filter(id__in=options['documents'])
+            if documents.count() != len(set(options['documents'])):
+                raise CommandError("部分文件不存在或尚未完成向量化。")
+
+        registry = get_registry()
+        exported = failed = 0
+        total_bytes = 0
+        for document in documents.order_by('uploaded_at'):
+            path = os.path.join(output_dir, snapshot_filename(document.id))
+            if (options['skip_existing'] and os.path.exists(path)
+                    and os.path.getmtime(path) >= document.updated_at.timestamp()):
+                continue
+            try:
+                chunks = export_snapshot(registry, document, path, include_file=not options['without_file'])
+            except SnapshotError as e:
+                failed += 1
+                self.stderr.write(self.style.ERROR(f"文件 {document.id} 匯出失敗: {e}"))
+                continue
+            exported += 1
+            size = os.path.getsize(path)
+            total_bytes += size
+            self.stdout.write(f"{document.filename} (ID: {document.id}): {chunks} 個區塊，{size / 1024 / 1024:.1f} MB")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"完成，匯出 {exported} 個文件 (共 {total_bytes / 1024 / 1024:.1f} MB) 到 {output_dir}"
+            + (f"，{failed} 個失敗。" if failed else "。")
+        ))
@@ -0,0 +1,57 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from rag_app.registry import get_registry
+from rag_app.snapshots import SNAPSHOT_EXTENSION, SnapshotError, import_snapshot
+
+
+class Command(BaseCommand):
+    help = (
+        "將 export_snapshots 產生的快照直接批次寫入本節點的向量庫 (不計算嵌入)，並重建關鍵字倒排索引與量化索引。"
+        "資料表中沒有的文件會以快照的資訊建立。"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+', help=f"快照檔或包含 {SNAPSHOT_EXTENSION} 檔的目錄")
+        parser.add_argument('--skip-existing', action='store_true', help="向量庫中已有相同區塊數的文件略過")
+        parser.add_argument('--force', action='store_true', help="內容雜湊與資料表中的文件不同時仍然覆寫")
+
+    def handle(self, *args, **options):
+        paths = []
+        for path in options['paths']:
+            if os.path.isdir(path):
+                paths.extend(sorted(
+                    os.path.join(path, name) for name in os.listdir(path) if name.endswith(SNAPSHOT_EXTENSION)
+                ))
+            elif os.path.isfile(path):
+                paths.append(path)
+            else:
+                raise CommandError(f"找不到 {path}")
+
+        registry = get_registry()
+        started = time.perf_counter()
+        imported = skipped = failed = chunks = 0
+        for path in paths:
+            try:
+                result = import_snapshot(registry, path, force=options['force'], skip_existing=options['skip_existing'])
+            except SnapshotError as e:
+                failed += 1
+                self.stderr.write(self.style.ERROR(f"{path} 匯入失敗: {e}"))
+                continue
+            if result is None:
+                skipped += 1
+                continue
+            imported += 1
+            chunks += result.chunks
+            action = "新建" if result.created else "更新"
+            self.stdout.write(
+                f"{action} {result.document.filename} (ID: {result.document.id}): {result.chunks} 個區塊，{result.seconds:.2f} 秒"
+            )
+
+        elapsed = time.perf_counter() - started
+        rate = f"，{chunks / elapsed:.0f} 區塊/秒" if elapsed > 0 and chunks else ""
+        self.stdout.write(self.style.SUCCESS(
+            f"完成，匯入 {imported} 個文件 ({chunks} 個區塊，{elapsed:.1f} 秒{rate})，略過 {skipped} 個，失敗 {failed} 個。"
+        ))
@@ -0,0 +1,150 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# 在全新的直譯器中模擬各角色的啟動流程，輸出各步驟秒數、RSS 與已載入的重量級套件 (JSON 寫在最後一行)
+_PROBE = r'''
+import json, sys, time
+timings = {}
+started = time.perf_counter()
+import django
+django.setup()
+timings['django_setup'] = time.perf_counter() - started
+
+role, profile, warm_up = sys.argv[1], sys.argv[2] or None, sys.argv[3] == '1'
+step = time.perf_counter()
+if role == 'web':
+    # 與 gunicorn 相同：匯入 rag_qa_project.wsgi (建立 WSGI application，並依 RAG_SEARCH_WARM_UP_IN_WEB 預熱)，
+    # 再載入 URLconf (會匯入 views 與 tasks)
+    from django.conf import settings
+    from django.urls import get_resolver
+    import rag_qa_project.wsgi
+    get_resolver(settings.ROOT_URLCONF).url_patterns
+    timings['import_app'] = time.perf_counter() - step
+else:
+    from rag_qa_project.celery import app
+    from rag_app.registry import get_registry, preload_modules, worker_warm_up_components
+    app.loader.import_default_modules()
+    timings['import_tasks'] = time.perf_counter() - step
+    components = worker_warm_up_components(profile)
+    step = time.perf_counter()
+    preload_modules(components)
+    timings['preload'] = time.perf_counter() - step
+    if warm_up:
+        step = time.perf_counter()
+        get_registry().warm_up(components)
+        timings['warm_up'] = time.perf_counter() - step
+timings['total'] = time.perf_counter() - started
+
+from rag_app.registry import process_memory
+heavy = ('torch', 'sentence_transformers', 'transformers', 'onnxruntime', 'chromadb', 'langchain',
+         'langchain_community', 'langchain_text_splitters')
+print(json.dumps({
+    'timings': timings,
+    'memory': process_memory(),
+    'modules': len(sys.modules),
+    'heavy_modules': [name for name in heavy if name in sys.modules],
+}))
+'''
+
+
+class Command(BaseCommand):
+    help = (
+        "量測 Web 與 Worker 進程的冷啟動時間與 RSS：每次都在全新的 Python 進程中執行 django.setup() 與各角色的啟動流程，"
+        "並列出已載入的重量級套件 (torch、chromadb、LangChain 等)，用來確認 Web 進程沒有載入模型相關的套件。"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--role', action='append', dest='roles', choices=['web', 'worker'],
+                            help="要量測的角色 (可重複，預設兩者都量測)")
+        parser.add_argument('--profile', help="Worker 設定檔 (決定預熱的資源，預設為全部資源)")
+        parser.add_argument('--no-warm-up', action='store_true', help="Worker 只匯入任務與套件，不建立資源也不載入模型")
+        parser.add_argument('--repeat', type=int, default=3, help="每個角色重複量測的次數 (取中位數)")
+        parser.add_argument('--import-time', type=int, default=0, metavar='N',
+                            help="另以 python -X importtime 列出各角色匯入時間最長的 N 個頂層模組")
+        parser.add_argument('--output', help="將結果寫成 JSON")
+
+    def handle(self, *args, **options):
+        if options['repeat'] < 1:
+            raise CommandError("--repeat 必須大於 0。")
+        profile = options['profile']
+        if profile and profile not in settings.RAG_CELERY_QUEUE_PROFILES:
+            raise CommandError(f"不支援的 Worker 設定檔: {profile}")
+
+        results = {}
+        for role in options['roles'] or ['web', 'worker']:
+            label = f"worker:{profile}" if role == 'worker' and profile else role
+            runs = [self._probe(role, profile, not options['no_warm_up']) for _ in range(options['repeat'])]
+            results[label] = self._summarize(runs)
+            self._report(label, results[label])
+            if options['import_time']:
+                results[label]['slowest_imports'] = self._slowest_imports(
+                    role, profile, not options['no_warm_up'], options['import_time']
+                )
+                for name, seconds in results[label]['slowest_imports']:
+                    self.stdout.write(f"    {seconds:8.3f} 秒  {name}")
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(results, f, ensure_ascii=False, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"結果已寫入 {options['output']}"))
+
+    def _run(self, role, profile, warm_up, extra_args=()):
+        started = time.perf_counter()
+        completed = subprocess.run(
+            [sys.executable, *extra_args, '-c', _PROBE, role, profile or '', '1' if warm_up else '0'],
+            cwd=settings.BASE_DIR,
+            env={**os.environ, 'DJANGO_SETTINGS_MODULE': os.environ.get('DJANGO_SETTINGS_MODULE', 'rag_qa_project.settings')},
+            capture_output=True,
+            text=True,
+        )
+        wall_seconds = time.perf_counter() - started
+        if completed.returncode != 0:
+            raise CommandError(f"{role} 啟動失敗:\n{completed.stderr.strip()}")
+        return completed, wall_seconds
+
+    def _probe(self, role, profile, warm_up):
+        completed, wall_seconds = self._run(role, profile, warm_up)
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+        result['timings']['wall'] = wall_seconds # 含直譯器啟動
+        return result
+
+    @staticmethod
+    def _summarize(runs):
+        steps = runs[0]['timings'].keys()
+        return {
+            'runs': len(runs),
+            'seconds': {step: round(statistics.median(run['timings'][step] for run in runs), 3) for step in steps},
+            'rss_mb': max(run['memory']['rss_mb'] or 0 for run in runs) or None,
+            'peak_rss_mb': max(run['memory']['peak_rss_mb'] for run in runs),
+            'modules': runs[0]['modules'],
+            'heavy_modules': runs[0]['heavy_modules'],
+        }
+
+    def _report(self, label, summary):
+        seconds = ', '.join(f"{step} {value}" for step, value in summary['seconds'].items())
+        self.stdout.write(f"{label}: {seconds} 秒 (中位數，{summary['runs']} 次)")
+        self.stdout.write(
+            f"  RSS {summary['rss_mb']} MB (峰值 {summary['peak_rss_mb']} MB)，已載入 {summary['modules']} 個模組，"
+            f"重量級套件：{', '.join(summary['heavy_modules']) or '無'}"
+        )
+
+    def _slowest_imports(self, role, profile, warm_up, limit):
+        # -X importtime 寫到 stderr：「import time: self [us] | cumulative | imported package」，頂層模組的名稱前沒有縮排
+        completed, _ = self._run(role, profile, warm_up, extra_args=('-X', 'importtime'))
+        top_level = []
+        for line in completed.stderr.splitlines():
+            if not line.startswith('import time:') or '|' not in line:
+                continue
+            _, cumulative, name = line.split('|', 2)
+            if name.startswith('  ') or not cumulative.strip().isdigit():
+                continue
+            top_level.append((name.strip(), int(cumulative) / 1e6))
+        top_level.sort(key=lambda item: -item[1])
+        return [(name, round(seconds, 3)) for name, seconds in top_level[:limit]]
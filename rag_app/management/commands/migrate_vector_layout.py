@@ -0,0 +1,82 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from rag_app.models import Document
+from rag_app.registry import get_registry
+from rag_app.vector_layout import LAYOUT_PER_DOCUMENT, LAYOUT_SHARED, delete_document_vectors, index_target
+
+
+class Command(BaseCommand):
+    help = "在「每文件一個 Collection」與「共用分片 Collection」兩種向量庫配置之間搬移既有文件的向量 (不重新計算嵌入)。"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--to', required=True, choices=[LAYOUT_PER_DOCUMENT, LAYOUT_SHARED], help="目標配置")
+        parser.add_argument('--batch-size', type=int, default=1000, help="每次從來源 Collection 讀取的區塊數")
+        parser.add_argument('--document', action='append', dest='documents', help="只搬移指定的文件ID (可重複)")
+        parser.add_argument('--dry-run', action='store_true', help="只列出需要搬移的文件")
+
+    def handle(self, *args, **options):
+        target_layout = options['to']
+        batch_size = options['batch_size']
+        if batch_size <= 0:
+            raise CommandError("--batch-size 必須大於 0。")
+
+        documents = Document.objects.filter(status='COMPLETED').exclude(index_layout=target_layout)
+        if options['documents']:
+            documents = documents.filter(id__in=options['documents'])
+
+        registry = get_registry()
+        migrated = 0
+        for document in documents.order_by('uploaded_at'):
+            if options['dry_run']:
+                self.stdout.write(f"{document.id} ({document.filename}): {document.index_layout} -> {target_layout}")
+                continue
+            try:
+                moved = self._migrate_document(registry, document, target_layout, batch_size)
+            except Exception as e:
+                self.stderr.write(self.style.ERROR(f"文件 {document.id} 搬移失敗: {e}"))
+                continue
+            migrated += 1
+            self.stdout.write(f"文件 {document.filename} (ID: {document.id}) 已搬移 {moved} 個區塊到 {target_layout}。")
+
+        self.stdout.write(self.style.SUCCESS(f"完成，共搬移 {migrated} 個文件。"))
+
+    def _migrate_document(self, registry, document, target_layout, batch_size):
+        source_layout = document.index_layout
+        source = index_target(document.id, source_layout)
+        destination = index_target(document.id, target_layout)
+        source_collection = registry.get_vector_store(source.collection_name)._collection
+        destination_collection = registry.get_vector_store(destination.collection_name)._collection
+
+        moved = 0
+        offset = 0
+        while True:
+            batch = source_collection.get(
+                where=source.where,
+                limit=batch_size,
+                offset=offset,
+                include=['embeddings', 'documents', 'metadatas'],
+            )
+            if not batch['ids']:
+                break
+            metadatas = [dict(metadata or {}, source_file_id=str(document.id)) for metadata in batch['metadatas']]
+            destination_collection.upsert(
+                ids=batch['ids'],
+                embeddings=batch['embeddings'],
+                documents=batch['documents'],
+                metadatas=metadatas,
+            )
+            moved += len(batch['ids'])
+            offset += len(batch['ids'])
+
+        if destination.where is None:
+            copied = destination_collection.count()
+        else:
+            copied = len(destination_collection.get(where=destination.where, include=[])['ids'])
+        if copied < moved:
+            raise CommandError(f"目標只寫入 {copied}/{moved} 個區塊，保留來源資料。")
+
+        # 確認寫入完整後才切換配置並清除來源
+        document.index_layout = target_layout
+        document.save(update_fields=['index_layout'])
+        delete_document_vectors(registry, document.id, source_layout)
+        return moved
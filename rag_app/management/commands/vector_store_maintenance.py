@@ -0,0 +1,100 @@
+import json
+
+import redis
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from rag_app.maintenance import MaintenanceRunning, exclusive_run, run_maintenance, store_report
+from rag_app.registry import get_registry
+
+
+def _mb(value):
+    return f"{value / 1024 / 1024:,.1f} MB"
+
+
+class Command(BaseCommand):
+    help = (
+        "比對 Document 與 ChromaDB、倒排/量化索引及 media 檔案：回收孤兒 Collection、共用分片中的區塊、segment 目錄與檔案，"
+        "必要時 VACUUM chroma.sqlite3，並列出每個文件的索引大小 (與 Celery beat 排程的 vector_store_maintenance_task 相同)。"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="只回報孤兒資料與大小，不刪除也不 VACUUM")
+        vacuum = parser.add_mutually_exclusive_group()
+        vacuum.add_argument('--vacuum', action='store_true', dest='force_vacuum', help="不論可回收空間大小都 VACUUM chroma.sqlite3")
+        vacuum.add_argument('--no-vacuum', action='store_true', help="不 VACUUM")
+        parser.add_argument('--grace-seconds', type=int,
+                            help=f"孤兒檔案至少存在的秒數 (預設 RAG_MAINTENANCE_ORPHAN_GRACE_SECONDS={settings.RAG_MAINTENANCE_ORPHAN_GRACE_SECONDS})")
+        parser.add_argument('--top', type=int, default=20, help="列出索引最大的前 N 個文件")
+        parser.add_argument('--output', help="將完整報告寫成 JSON")
+
+    def handle(self, *args, **options):
+        if options['grace_seconds'] is not None and options['grace_seconds'] < 0:
+            raise CommandError("--grace-seconds 不可小於 0。")
+        vacuum = True if options['force_vacuum'] else (False if options['no_vacuum'] else None)
+        reclaim = not options['dry_run']
+
+        try:
+            with exclusive_run(settings.RAG_MAINTENANCE_TIME_LIMIT):
+                report = run_maintenance(
+                    get_registry(), reclaim=reclaim, vacuum=vacuum, grace_seconds=options['grace_seconds'],
+                )
+        except MaintenanceRunning as e:
+            raise CommandError(str(e))
+        if reclaim:
+            try:
+                store_report(report)
+            except redis.RedisError as e:
+                self.stderr.write(self.style.WARNING(f"維護報告未寫入 Redis: {e}"))
+
+        self._report(report, options['top'])
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"報告已寫入 {options['output']}"))
+
+    def _report(self, report, top):
+        action = "已回收" if report['reclaim'] else "可回收 (dry run)"
+        for kind, items in report['orphans'].items():
+            if not items:
+                continue
+            size = sum(item.get('bytes', 0) for item in items)
+            chunks = sum(item.get('chunks', 0) for item in items)
+            detail = f"{_mb(size)}" + (f"，{chunks} 個區塊" if chunks else "")
+            self.stdout.write(f"{action} {kind}: {len(items)} 項 ({detail})")
+            for item in items[:10]:
+                self.stdout.write(f"    {item.get('document') or item['name']}")
+        if report['missing_indexes']:
+            self.stdout.write(self.style.WARNING(
+                f"{len(report['missing_indexes'])} 個已完成的文件沒有向量 (需重新上傳或替換檔案): "
+                f"{', '.join(report['missing_indexes'][:10])}"
+            ))
+        if report['missing_files']:
+            self.stdout.write(self.style.WARNING(
+                f"{len(report['missing_files'])} 個文件的上傳檔案不存在: {', '.join(report['missing_files'][:10])}"
+            ))
+
+        chroma = report['chroma']
+        if 'sqlite_bytes' in chroma:
+            vacuumed = f"，VACUUM {chroma['vacuum_seconds']} 秒" if chroma['vacuumed'] else ''
+            self.stdout.write(
+                f"ChromaDB: {chroma['collections']} 個 Collection，共 {_mb(chroma['bytes'])}；"
+                f"chroma.sqlite3 {_mb(chroma['sqlite_bytes'])} (可回收 {_mb(chroma['free_bytes'])}){vacuumed}"
+            )
+
+        totals = report['totals']
+        self.stdout.write(
+            f"{totals['documents']} 個文件、{totals['chunks']} 個區塊：向量 {_mb(totals['chroma_bytes'])}、"
+            f"倒排索引 {_mb(totals['lexical_bytes'])}、量化索引 {_mb(totals['quantized_bytes'])}、上傳檔案 {_mb(totals['file_bytes'])}"
+        )
+        if top > 0 and report['documents']:
+            self.stdout.write(f"索引最大的 {min(top, len(report['documents']))} 個文件：")
+            for item in report['documents'][:top]:
+                self.stdout.write(
+                    f"  {_mb(item['total_bytes']):>12}  {item['chunks']:>8} 區塊  "
+                    f"向量 {_mb(item['chroma_bytes'])}  {item['filename']} ({item['id']}, {item['layout']})"
+                )
+        reclaimable = report['reclaimed_bytes'] if report['reclaim'] else sum(
+            item.get('bytes', 0) for items in report['orphans'].values() for item in items
+        )
+        self.stdout.write(self.style.SUCCESS(f"完成，{action} {_mb(reclaimable)}，耗時 {report['seconds']} 秒。"))
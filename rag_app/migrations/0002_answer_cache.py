@@ -0,0 +1,43 @@
+# Generated by Django 5.2.3 on 2026-10-17 16:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rag_app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='index_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='questionanswer',
+            name='cache_hit',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.CreateModel(
+            name='AnswerCacheEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index_version', models.PositiveIntegerField()),
+                ('normalized_question', models.TextField()),
+                ('question_hash', models.CharField(max_length=64)),
+                ('question_embedding', models.BinaryField(blank=True, null=True)),
+                ('answer', models.TextField()),
+                ('source_documents', models.JSONField(blank=True, null=True)),
+                ('hit_count', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_hit_at', models.DateTimeField(blank=True, null=True)),
+                ('document', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='answer_cache_entries', to='rag_app.document')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['document', 'index_version', 'question_hash'], name='rag_app_ans_documen_8f6c79_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.3 on 2026-10-17 16:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rag_app', '0002_answer_cache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='index_layout',
+            field=models.CharField(choices=[('PER_DOCUMENT', '每文件一個 Collection'), ('SHARED', '共用 Collection')], default='PER_DOCUMENT', max_length=20),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.3 on 2026-10-17 17:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rag_app', '0003_document_index_layout'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='questionanswer',
+            name='documents',
+            field=models.ManyToManyField(blank=True, related_name='scoped_qa_pairs', to='rag_app.document'),
+        ),
+        migrations.AddField(
+            model_name='questionanswer',
+            name='scope',
+            field=models.CharField(choices=[('DOCUMENT', '單一文件'), ('DOCUMENTS', '多個文件'), ('CORPUS', '全部文件')], default='DOCUMENT', max_length=20),
+        ),
+        migrations.AlterField(
+            model_name='questionanswer',
+            name='document',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='qa_pairs', to='rag_app.document'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.3 on 2026-10-17 16:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rag_app', '0004_question_scope'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='processed_chunks',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='processed_pages',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='total_pages',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
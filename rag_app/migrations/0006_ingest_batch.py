@@ -0,0 +1,40 @@
+# Generated by Django 5.2.3 on 2026-10-17 16:30
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rag_app', '0005_document_progress'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestBatch',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('total_documents', models.PositiveIntegerField(default=0)),
+                ('duplicate_files', models.PositiveIntegerField(default=0)),
+                ('skipped_files', models.JSONField(blank=True, null=True)),
+                ('embedded_chunks', models.PositiveIntegerField(default=0)),
+                ('reused_chunks', models.PositiveIntegerField(default=0)),
+                ('embedding_batches', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='ingest_batch',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='documents', to='rag_app.ingestbatch'),
+        ),
+    ]
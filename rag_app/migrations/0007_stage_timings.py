@@ -0,0 +1,23 @@
+# Generated by Django 5.2.3 on 2026-10-17 16:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rag_app', '0006_ingest_batch'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='stage_timings',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='questionanswer',
+            name='stage_timings',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
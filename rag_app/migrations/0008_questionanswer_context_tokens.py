@@ -0,0 +1,23 @@
+# Generated by Django 5.2.3 on 2026-10-17 18:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rag_app', '0007_stage_timings'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='questionanswer',
+            name='context_tokens',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='questionanswer',
+            name='context_tokens_saved',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
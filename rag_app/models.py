@@ -1,6 +1,22 @@
 from django.db import models
 import uuid
 
+class IngestBatch(models.Model):
+    # 批次上傳：一次上傳的多個檔案 (或 zip 內的檔案) 共用一個批次，彙整處理量統計
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(blank=True, null=True) # 第一個匯入任務開始的時間
+    finished_at = models.DateTimeField(blank=True, null=True) # 批次內所有文件都已完成或失敗的時間
+    total_documents = models.PositiveIntegerField(default=0) # 實際建立的文件數 (不含略過的檔案)
+    duplicate_files = models.PositiveIntegerField(default=0) # 內容與既有文件相同而略過的檔案數
+    skipped_files = models.JSONField(blank=True, null=True) # 略過的檔案與原因 (重複、不支援的格式等)
+    embedded_chunks = models.PositiveIntegerField(default=0)
+    reused_chunks = models.PositiveIntegerField(default=0)
+    embedding_batches = models.PositiveIntegerField(default=0) # 合併多個文件後送入模型的批次數
+
+    def __str__(self):
+        return f"IngestBatch {self.id} ({self.total_documents} 個文件)"
+
 class Document(models.Model):
     # 文件的狀態
     STATUS_CHOICES = (
@@ -16,6 +32,27 @@ class Document(models.Model):
     uploaded_at = models.DateTimeField(auto_now_add=True)
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='UPLOADED')
     processing_message = models.TextField(blank=True, null=True) # 處理訊息或錯誤
+    index_version = models.PositiveIntegerField(default=0) # 每次重新向量化完成時遞增，用於讓答案快取失效
+    # 向量的存放配置：每文件一個 Collection，或共用 (分片) Collection 以 source_file_id 過濾
+    INDEX_LAYOUT_CHOICES = (
+        ('PER_DOCUMENT', '每文件一個 Collection'),
+        ('SHARED', '共用 Collection'),
+    )
+    index_layout = models.CharField(max_length=20, choices=INDEX_LAYOUT_CHOICES, default='PER_DOCUMENT')
+    # 向量化進度：逐頁處理，每寫入一批區塊後更新，Worker 中斷時從 processed_pages 繼續
+    total_pages = models.PositiveIntegerField(blank=True, null=True)
+    processed_pages = models.PositiveIntegerField(default=0)
+    processed_chunks = models.PositiveIntegerField(default=0)
+    content_hash = models.CharField(max_length=64, blank=True, db_index=True) # 檔案內容的 SHA-256，批次上傳時用來略過重複的檔案
+    ingest_batch = models.ForeignKey(IngestBatch, on_delete=models.SET_NULL, related_name='documents', blank=True, null=True)
+    stage_timings = models.JSONField(blank=True, null=True) # 向量化各階段的累計秒數 (load / split / embed / persist / total)
+    # 最後修改時間，列表 API 以它計算 ETag (以 QuerySet.update() 更新時需一併設定)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status']),
+        ]
 
     def save(self, *args, **kwargs):
         # 如果是新文件且沒有 filename，則從 file 取得
@@ -27,7 +64,16 @@ class Document(models.Model):
         return self.filename if self.filename else str(self.id)
 
 class QuestionAnswer(models.Model):
-    document = models.ForeignKey(Document, on_delete=models.CASCADE, related_name='qa_pairs')
+    # 單一文件提問時為該文件；多文件提問時為第一個文件；全庫提問時為空
+    document = models.ForeignKey(Document, on_delete=models.CASCADE, related_name='qa_pairs', blank=True, null=True)
+    # 提問範圍：單一文件、指定的多個文件或所有已完成的文件
+    SCOPE_CHOICES = (
+        ('DOCUMENT', '單一文件'),
+        ('DOCUMENTS', '多個文件'),
+        ('CORPUS', '全部文件'),
+    )
+    scope = models.CharField(max_length=20, choices=SCOPE_CHOICES, default='DOCUMENT')
+    documents = models.ManyToManyField(Document, related_name='scoped_qa_pairs', blank=True) # 多文件提問的範圍
     question = models.TextField()
     answer = models.TextField(blank=True, null=True)
     # 儲存參考來源，可以是 JSON 格式的列表
@@ -42,6 +88,38 @@ class QuestionAnswer(models.Model):
     )
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='PENDING')
     error_message = models.TextField(blank=True, null=True)
+    cache_hit = models.BooleanField(default=False) # 答案是否直接取自答案快取
+    stage_timings = models.JSONField(blank=True, null=True) # 問答各階段的秒數 (queue_wait / retrieve / first_token / generate / save / total)
+    context_tokens = models.PositiveIntegerField(blank=True, null=True) # Prompt 中 Context 的估計 token 數 (命中答案快取時為空)
+    context_tokens_saved = models.IntegerField(blank=True, null=True) # 相較於直接貼上前 RAG_RETRIEVAL_TOP_K 個區塊原文所節省的 token 數
+    updated_at = models.DateTimeField(auto_now=True) # 最後修改時間，列表 API 以它計算 ETag
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['document', 'created_at']),
+            models.Index(fields=['status']),
+        ]
+
+    def __str__(self):
+        return f"Q: {self.question[:50]}... A: {self.answer[:50]}..."
+
+class AnswerCacheEntry(models.Model):
+    # 以文件為範圍的答案快取：精確比對正規化問題，或以問題嵌入做語意比對
+    document = models.ForeignKey(Document, on_delete=models.CASCADE, related_name='answer_cache_entries')
+    index_version = models.PositiveIntegerField() # 建立時文件的 index_version，不一致即視為失效
+    normalized_question = models.TextField()
+    question_hash = models.CharField(max_length=64)
+    question_embedding = models.BinaryField(blank=True, null=True) # float32 向量
+    answer = models.TextField()
+    source_documents = models.JSONField(blank=True, null=True)
+    hit_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_hit_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['document', 'index_version', 'question_hash']),
+        ]
 
     def __str__(self):
-        return f"Q: {self.question[:50]}... A: {self.answer[:50]}..."
\ No newline at end of file
+        return f"{self.document_id}: {self.normalized_question[:50]}"
\ No newline at end of file
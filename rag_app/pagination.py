@@ -0,0 +1,126 @@
+import hashlib
+
+from django.conf import settings
+from django.db.models import F
+from django.utils.cache import get_conditional_response, patch_cache_control
+from rest_framework.pagination import CursorPagination
+from rest_framework.response import Response
+
+FIELDS_QUERY_PARAM = 'fields'
+
+
+def requested_fields(request):
+    """
+    ?fields=a,b 指定要輸出的欄位，回傳欄位名稱的集合；未指定時回傳 None (輸出所有欄位)。
+    """
+    if request is None:
+        return None
+    value = request.query_params.get(FIELDS_QUERY_PARAM)
+    if not value:
+        return None
+    return {name.strip() for name in value.split(',') if name.strip()}
+
+
+class _CursorPagination(CursorPagination):
+    # 以 cursor 分頁：不需要 COUNT(*)，翻頁成本不隨頁數增加，輪詢期間新增的資料也不會讓頁面錯位
+    page_size = settings.RAG_API_PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = settings.RAG_API_MAX_PAGE_SIZE
+
+
+class DocumentCursorPagination(_CursorPagination):
+    ordering = '-uploaded_at'
+
+
+class QuestionAnswerCursorPagination(_CursorPagination):
+    ordering = '-created_at'
+
+
+class ConditionalListMixin:
+    """
+    列表與單筆查詢的共用行為：
+    - 依 ?fields= 只載入需要的欄位 (未要求的大欄位以 defer 略過，關聯欄位才做 select_related / prefetch_related)。
+    - 以 ETag 支援條件式 GET：ETag 由本頁資料的 (主鍵, updated_at) 與完整網址計算，分頁時先只查詢這兩個欄位，
+      內容未變更時直接回應 304，不載入完整資料也不序列化。輸出關聯資料欄位 (例如文件名稱) 時，關聯資料的 updated_at
+      也計入 ETag，關聯資料變更後列表不會一直回應 304。回應帶 Cache-Control: no-cache，瀏覽器每次輪詢都會帶上 If-None-Match。
+    子類別以下列屬性描述序列化欄位與資料表欄位的對應。
+    """
+    version_field = 'updated_at'
+    # 資料表欄位 -> 需要它的序列化欄位；這些序列化欄位都沒有被要求時以 defer 略過
+    deferrable_fields = {}
+    # 序列化欄位 -> 需要 select_related / prefetch_related 的關聯
+    select_related_fields = {}
+    prefetch_related_fields = {}
+    # 序列化欄位 -> 關聯資料的版本欄位 (例如 'document__updated_at')；輸出該欄位時一併計入 ETag
+    related_version_fields = {}
+
+    def _related_versions(self):
+        fields = requested_fields(self.request)
+        return [path for name, path in self.related_version_fields.items() if fields is None or name in fields]
+
+    def project(self, queryset):
+        fields = requested_fields(self.request)
+        related = [relation for name, relation in self.select_related_fields.items() if fields is None or name in fields]
+        if related:
+            queryset = queryset.select_related(*related)
+        prefetch = [relation for name, relation in self.prefetch_related_fields.items() if fields is None or name in fields]
+        if prefetch:
+            queryset = queryset.prefetch_related(*prefetch)
+        if fields is not None:
+            deferred = [column for column, needed_by in self.deferrable_fields.items() if not fields & set(needed_by)]
+            if deferred:
+                queryset = queryset.defer(*deferred)
+        return queryset
+
+    def _etag(self, request, versions, *extra):
+        # versions：[(主鍵, 版本, 關聯資料的版本...)]
+        digest = hashlib.sha256(request.get_full_path().encode())
+        digest.update(repr(extra).encode())
+        for pk, *row_versions in versions:
+            stamps = ','.join(version.isoformat() if version else '' for version in row_versions)
+            digest.update(f"{pk}:{stamps};".encode())
+        return f'"{digest.hexdigest()[:32]}"'
+
+    def _conditional(self, request, etag, build_response):
+        not_modified = get_conditional_response(request, etag=etag)
+        if not_modified is not None:
+            return not_modified
+        response = build_response()
+        response['ETag'] = etag
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        ordering = self.paginator.ordering
+        ordering = [ordering] if isinstance(ordering, str) else list(ordering)
+        related = {f"_etag_version_{index}": F(path) for index, path in enumerate(self._related_versions())}
+        page = self.paginate_queryset(
+            queryset.only(self.version_field, *(field.lstrip('-') for field in ordering)).annotate(**related)
+        )
+        etag = self._etag(
+            request, [(row.pk, getattr(row, self.version_field), *(getattr(row, name) for name in related)) for row in page],
+            self.paginator.has_next, self.paginator.has_previous,
+        )
+
+        def build_response():
+            rows = {row.pk: row for row in self.project(queryset.model.objects.filter(pk__in=[row.pk for row in page]))}
+            serializer = self.get_serializer([rows[row.pk] for row in page if row.pk in rows], many=True)
+            return self.get_paginated_response(serializer.data)
+
+        return self._conditional(request, etag, build_response)
+
+    @staticmethod
+    def _follow(instance, path):
+        # 'document__updated_at' -> instance.document.updated_at (關聯為空時回傳 None)
+        for name in path.split('__'):
+            if instance is None:
+                return None
+            instance = getattr(instance, name)
+        return instance
+
+    def retrieve(self, request, *args, **kwargs):
+        instance = self.get_object()
+        related = [self._follow(instance, path) for path in self._related_versions()]
+        etag = self._etag(request, [(instance.pk, getattr(instance, self.version_field), *related)])
+        return self._conditional(request, etag, lambda: Response(self.get_serializer(instance).data))
@@ -0,0 +1,71 @@
+from collections import deque
+
+import billiard
+from django.conf import settings
+from pypdf import PdfReader
+
+
+def _extract_page_range(file_path, start, end):
+    """
+    進程池工作函式：各自開啟 PDF，只解析 [start, end) 範圍內的頁面文字。
+    """
+    reader = PdfReader(file_path)
+    return [reader.pages[i].extract_text().strip() for i in range(start, end)]
+
+
+def _document_metadata(reader, file_path):
+    # 與 PyPDFLoader 相同的文件層級 metadata (producer、creationdate、total_pages 等)
+    from langchain_community.document_loaders.parsers.pdf import _purge_metadata
+
+    return _purge_metadata(
+        {"producer": "PyPDF", "creator": "PyPDF", "creationdate": ""}
+        | dict(reader.metadata or {})
+        | {"source": file_path, "total_pages": len(reader.pages)}
+    )
+
+
+def iter_pdf_pages(file_path, start_page=0, end_page=None, num_workers=None):
+    """
+    依頁碼順序逐頁產出 [start_page, end_page) 範圍內的 LangChain Document (metadata 含 page / page_label，與 PyPDFLoader 一致)。
+    頁數夠多時把頁面範圍分給進程池並行解析，同時在途的範圍數有上限，解析結果不會整份堆積在記憶體中。
+    """
+    # LangChain 在這裡才匯入：spawn 出來的解析進程只需要 pypdf，不必負擔 LangChain 的匯入時間
+    from langchain_core.documents import Document as PageDocument
+
+    reader = PdfReader(file_path)
+    total_pages = len(reader.pages)
+    end_page = total_pages if end_page is None else min(end_page, total_pages)
+    metadata = _document_metadata(reader, file_path)
+    page_labels = reader.page_labels
+    num_workers = settings.RAG_PDF_PARSE_WORKERS if num_workers is None else num_workers
+    pages_per_task = max(1, settings.RAG_PDF_PAGES_PER_TASK)
+
+    def to_document(page_number, text):
+        return PageDocument(
+            page_content=text,
+            metadata=dict(metadata, page=page_number, page_label=page_labels[page_number]),
+        )
+
+    if num_workers <= 1 or end_page - start_page < settings.RAG_PDF_PARALLEL_MIN_PAGES:
+        for page_number in range(start_page, end_page):
+            yield to_document(page_number, reader.pages[page_number].extract_text().strip())
+        return
+
+    ranges = deque(
+        (start, min(start + pages_per_task, end_page))
+        for start in range(start_page, end_page, pages_per_task)
+    )
+    # 使用 billiard (Celery 的 multiprocessing 分支)：Celery prefork 的 daemon 子進程也能再建立進程池
+    pool = billiard.get_context('spawn').Pool(processes=min(num_workers, len(ranges)))
+    try:
+        pending = deque()
+        while ranges or pending:
+            while ranges and len(pending) < num_workers * 2:
+                start, end = ranges.popleft()
+                pending.append((start, pool.apply_async(_extract_page_range, (file_path, start, end))))
+            start, result = pending.popleft()
+            for offset, text in enumerate(result.get()):
+                yield to_document(start + offset, text)
+    finally:
+        pool.terminate()
+        pool.join()
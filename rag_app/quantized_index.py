@@ -0,0 +1,285 @@
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from django.conf import settings
+
+QUANTIZATION_INT8 = 'int8'
+QUANTIZATION_BINARY = 'binary'
+BACKEND_CHROMA = 'chroma'
+BACKEND_QUANTIZED = 'quantized'
+
+_KMEANS_ITERATIONS = 10
+_KMEANS_SAMPLE_PER_LIST = 64
+_SCAN_BLOCK_ROWS = 16384 # 掃描量化碼時每次轉成浮點數的列數，限制暫存記憶體
+
+
+def enabled():
+    backend = getattr(settings, 'RAG_VECTOR_SEARCH_BACKEND', BACKEND_CHROMA)
+    if backend not in (BACKEND_CHROMA, BACKEND_QUANTIZED):
+        raise ValueError(f"不支援的向量檢索後端: {backend}")
+    return backend == BACKEND_QUANTIZED
+
+
+def index_path(document_id):
+    return os.path.join(settings.RAG_QUANTIZED_INDEX_DIR, str(document_id))
+
+
+def _nearest_centroids(vectors, centroids):
+    # 依平方歐氏距離找出每個向量最近的中心點 (分段計算，避免 n x 中心點數 的矩陣過大)
+    centroid_norms = (centroids ** 2).sum(axis=1)
+    assignment = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), _SCAN_BLOCK_ROWS):
+        block = vectors[start:start + _SCAN_BLOCK_ROWS]
+        assignment[start:start + len(block)] = np.argmin(centroid_norms - 2 * block @ centroids.T, axis=1)
+    return assignment
+
+
+def _train_centroids(vectors, lists):
+    """
+    以 k-means 訓練粗分群的中心點 (取樣訓練，固定亂數種子讓重建結果一致)。
+    """
+    rng = np.random.default_rng(0)
+    sample_size = min(len(vectors), lists * _KMEANS_SAMPLE_PER_LIST)
+    sample = vectors[rng.choice(len(vectors), sample_size, replace=False)]
+    centroids = sample[rng.choice(len(sample), lists, replace=False)].copy()
+    for _ in range(_KMEANS_ITERATIONS):
+        assignment = _nearest_centroids(sample, centroids)
+        for cluster in range(lists):
+            members = sample[assignment == cluster]
+            if len(members):
+                centroids[cluster] = members.mean(axis=0)
+    return centroids
+
+
+def build_index(document_id, chunk_ids, vectors, quantization=None):
+    """
+    由文件所有區塊的嵌入建立量化索引，寫成一組可以 memory-map 的 .npy 檔：
+    - int8：以文件內的最大絕對值為尺度做對稱純量量化，另存每個向量的平方長度，用來估計平方歐氏距離 (約 1/4 記憶體)。
+    - binary：每一維相對於文件平均向量的正負號壓成 1 bit (約 1/32 記憶體)，查詢時以浮點數的問題向量與 ±1 碼做內積估計。
+    區塊數達到 RAG_QUANTIZED_COARSE_MIN_VECTORS 時另建 k-means 粗分群 (IVF)，查詢時只掃描最近的 RAG_QUANTIZED_NPROBE 群。
+    另以 RAG_QUANTIZED_RERANK_DTYPE 存一份重新排序用的向量 (rerank.npy)，查詢時只讀取候選區塊的列，不必讓 Chroma 載入向量。
+    先寫暫存目錄再替換，查詢端不會讀到寫到一半的索引。回傳寫入的區塊數。
+    """
+    quantization = quantization or settings.RAG_QUANTIZATION
+    if quantization not in (QUANTIZATION_INT8, QUANTIZATION_BINARY):
+        raise ValueError(f"不支援的量化方式: {quantization}")
+    rerank_dtype = np.dtype(settings.RAG_QUANTIZED_RERANK_DTYPE)
+    if rerank_dtype not in (np.float16, np.float32):
+        raise ValueError(f"不支援的重新排序向量型別: {settings.RAG_QUANTIZED_RERANK_DTYPE}")
+    vectors = np.asarray(vectors, dtype=np.float32)
+    ids = np.array(chunk_ids, dtype=bytes)
+    arrays = {}
+
+    lists = int(np.sqrt(len(vectors))) if len(vectors) >= settings.RAG_QUANTIZED_COARSE_MIN_VECTORS else 0
+    if lists:
+        centroids = _train_centroids(vectors, lists)
+        assignment = _nearest_centroids(vectors, centroids)
+        # 依群排序，同一群的區塊在檔案中連續，查詢時只讀取被選中的區段
+        order = np.argsort(assignment, kind='stable')
+        vectors, ids = vectors[order], ids[order]
+        arrays['centroids'] = centroids
+        arrays['list_offsets'] = np.searchsorted(assignment[order], np.arange(lists + 1)).astype(np.int64)
+
+    if quantization == QUANTIZATION_INT8:
+        scale = float(np.abs(vectors).max()) / 127 or 1.0
+        arrays['codes'] = np.clip(np.rint(vectors / scale), -127, 127).astype(np.int8)
+        arrays['norms'] = (vectors ** 2).sum(axis=1).astype(np.float32)
+        arrays['meta'] = np.array([scale], dtype=np.float32)
+    else:
+        mean = vectors.mean(axis=0)
+        arrays['codes'] = np.packbits(vectors > mean, axis=1)
+        arrays['mean'] = mean.astype(np.float32)
+    arrays['ids'] = ids
+    arrays['rerank'] = vectors.astype(rerank_dtype)
+
+    path = index_path(document_id)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_path, f"{name}.npy"), array)
+    with open(os.path.join(tmp_path, 'QUANTIZATION'), 'w') as f:
+        f.write(quantization)
+    old_path = f"{path}.{os.getpid()}.old"
+    if os.path.exists(path):
+        os.replace(path, old_path)
+    os.replace(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+    _forget(document_id)
+    return len(ids)
+
+
+def build_from_collection(document_id, collection, where=None, batch_size=1000, quantization=None):
+    """
+    從 Chroma Collection 中已存的區塊嵌入 (where 為共用 Collection 時的文件過濾條件) 建立量化索引，回傳區塊數。
+    """
+    chunk_ids, vectors = [], []
+    offset = 0
+    while True:
+        batch = collection.get(where=where, limit=batch_size, offset=offset, include=['embeddings'])
+        if not batch['ids']:
+            break
+        chunk_ids.extend(batch['ids'])
+        vectors.extend(batch['embeddings'])
+        offset += len(batch['ids'])
+    if not chunk_ids:
+        delete_index(document_id)
+        return 0
+    return build_index(document_id, chunk_ids, vectors, quantization)
+
+
+class QuantizedIndex:
+    """
+    單一文件的量化向量索引 (唯讀，所有陣列以 memory-map 開啟，實際常駐的只有被掃描到的量化碼)。
+    """
+
+    def __init__(self, path):
+        def load(name):
+            file_path = os.path.join(path, f"{name}.npy")
+            return np.load(file_path, mmap_mode='r') if os.path.exists(file_path) else None
+
+        with open(os.path.join(path, 'QUANTIZATION')) as f:
+            self.quantization = f.read().strip()
+        self.codes = load('codes')
+        self.ids = load('ids')
+        self.rerank_vectors = load('rerank')
+        if self.rerank_vectors is None:
+            # 舊版建立的索引沒有重新排序向量，需以 build_quantized_index --rebuild 重建；在此之前改由 Chroma 檢索
+            raise FileNotFoundError(os.path.join(path, 'rerank.npy'))
+        self._rows = None
+        self.norms = load('norms')
+        self.mean = load('mean')
+        self.centroids = load('centroids')
+        self.list_offsets = load('list_offsets')
+        meta = load('meta')
+        self.scale = float(meta[0]) if meta is not None else None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def memory_bytes(self):
+        """
+        查詢時需要掃描的資料量 (量化碼與輔助陣列)；重新排序向量每次只讀取候選區塊的列，不計入。
+        """
+        return sum(array.nbytes for array in (self.codes, self.norms, self.mean, self.centroids, self.list_offsets)
+                   if array is not None)
+
+    def rerank_bytes(self):
+        return self.rerank_vectors.nbytes
+
+    @property
+    def dimension(self):
+        return self.rerank_vectors.shape[1]
+
+    def vectors(self, chunk_ids):
+        """
+        依區塊ID取回重新排序向量 ({區塊ID: float32 向量}，不在索引中的區塊略過)，只讀取需要的列。
+        """
+        if self._rows is None:
+            self._rows = {chunk_id.decode(): row for row, chunk_id in enumerate(self.ids)}
+        rows = {chunk_id: self._rows[chunk_id] for chunk_id in chunk_ids if chunk_id in self._rows}
+        if not rows:
+            return {}
+        ordered = sorted(rows.values())
+        stored = np.asarray(self.rerank_vectors[ordered], dtype=np.float32)
+        position = {row: index for index, row in enumerate(ordered)}
+        return {chunk_id: stored[position[row]] for chunk_id, row in rows.items()}
+
+    def _candidate_rows(self, question_vector):
+        if self.centroids is None:
+            return [(0, len(self))]
+        distances = (np.asarray(self.centroids) ** 2).sum(axis=1) - 2 * np.asarray(self.centroids) @ question_vector
+        probes = np.argsort(distances)[:settings.RAG_QUANTIZED_NPROBE]
+        return [(int(self.list_offsets[cluster]), int(self.list_offsets[cluster + 1])) for cluster in sorted(probes)]
+
+    def _approximate_distances(self, question_vector, start, end):
+        # 數值越小越相似：int8 估計平方歐氏距離 (省略與區塊無關的 |q|^2)
+        codes = self.codes[start:end]
+        if self.quantization == QUANTIZATION_INT8:
+            dots = codes.astype(np.float32) @ question_vector
+            return np.asarray(self.norms[start:end]) - 2 * self.scale * dots
+        # binary 採非對稱估計：問題向量保留浮點數，與各區塊的 bit 做內積 (比兩邊都量化的 Hamming 距離準確)
+        bits = np.unpackbits(codes, axis=1, count=len(self.mean)).astype(np.float32)
+        return -(bits @ (question_vector - np.asarray(self.mean)))
+
+    def _shortlist(self, question_vector, candidates_wanted):
+        # 以量化碼估計距離，回傳最相近的 candidates_wanted 個區塊的列號 (由小到大)
+        rows, distances = [], []
+        for start, end in self._candidate_rows(question_vector):
+            for block_start in range(start, end, _SCAN_BLOCK_ROWS):
+                block_end = min(end, block_start + _SCAN_BLOCK_ROWS)
+                rows.append(np.arange(block_start, block_end))
+                distances.append(self._approximate_distances(question_vector, block_start, block_end))
+        if not rows:
+            return np.empty(0, dtype=np.int64)
+        rows, distances = np.concatenate(rows), np.concatenate(distances)
+        if len(rows) > candidates_wanted:
+            rows = rows[np.argpartition(distances, candidates_wanted - 1)[:candidates_wanted]]
+        return np.sort(rows)
+
+    def search(self, question_vectors, k):
+        """
+        對每個問題向量回傳 [(chunk_id, 平方歐氏距離)]，依距離由小到大取前 k 個：
+        先以量化碼估計距離取出 k * RAG_QUANTIZED_RERANK_FACTOR[量化方式] 個候選，再以重新排序向量計算精確距離
+        (float16 時與 Chroma 的距離只差捨入誤差)。
+        """
+        question_vectors = np.asarray(question_vectors, dtype=np.float32)
+        candidates_wanted = max(k, k * settings.RAG_QUANTIZED_RERANK_FACTOR[self.quantization])
+        results = []
+        for question_vector in question_vectors:
+            rows = self._shortlist(question_vector, candidates_wanted)
+            if not len(rows):
+                results.append([])
+                continue
+            vectors = np.asarray(self.rerank_vectors[rows], dtype=np.float32)
+            exact = ((vectors - question_vector) ** 2).sum(axis=1)
+            best = np.argsort(exact, kind='stable')[:k]
+            results.append([(self.ids[rows[i]].decode(), float(exact[i])) for i in best])
+        return results
+
+
+_loaded = OrderedDict() # document_id -> (mtime, QuantizedIndex)
+_loaded_lock = threading.Lock()
+
+
+def _forget(document_id):
+    with _loaded_lock:
+        _loaded.pop(str(document_id), None)
+
+
+def get_index(document_id):
+    """
+    取得文件的量化索引 (進程內以 LRU 保留 memory-map 的 handle，索引重建後自動重新開啟)；尚未建立時回傳 None。
+    """
+    document_id = str(document_id)
+    try:
+        mtime = os.stat(index_path(document_id)).st_mtime_ns
+    except FileNotFoundError:
+        _forget(document_id)
+        return None
+
+    with _loaded_lock:
+        cached = _loaded.get(document_id)
+        if cached is not None and cached[0] == mtime:
+            _loaded.move_to_end(document_id)
+            return cached[1]
+
+    try:
+        index = QuantizedIndex(index_path(document_id))
+    except FileNotFoundError:
+        # 索引正在被替換 (舊目錄已移走、新目錄尚未就位) 或是缺少重新排序向量的舊版索引，這次改由 Chroma 檢索
+        return None
+    with _loaded_lock:
+        _loaded[document_id] = (mtime, index)
+        _loaded.move_to_end(document_id)
+        while len(_loaded) > settings.RAG_QUANTIZED_INDEX_CACHE_SIZE:
+            _loaded.popitem(last=False)
+    return index
+
+
+def delete_index(document_id):
+    _forget(document_id)
+    shutil.rmtree(index_path(document_id), ignore_errors=True)
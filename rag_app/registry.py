@@ -0,0 +1,296 @@
+import importlib
+import json
+import os
+import resource
+import socket
+import threading
+import time
+from collections import OrderedDict, deque
+
+import numpy as np
+import redis
+from django.conf import settings
+
+from .embedding import get_embedding_engine
+from .llm import QA_PROMPT_TEMPLATE, OllamaClient
+
+CHROMA_DB_PATH = os.path.join(settings.BASE_DIR, "chroma_db")
+WORKER_STATS_KEY_PREFIX = 'rag:worker_stats:'
+
+# 可預熱的常駐資源；chromadb、LangChain 與嵌入模型的套件都在第一次使用 (或預熱) 時才匯入，
+# Web 進程、管理命令與 migrate 匯入 rag_app 時不會載入它們
+WARM_UP_COMPONENTS = ('chroma', 'embedding', 'llm', 'parsing', 'rerank')
+_PRELOAD_MODULES = {
+    'chroma': ('chromadb', 'langchain_community.vectorstores'),
+    'embedding': {
+        'torch': ('torch', 'sentence_transformers'),
+        'onnx': ('onnxruntime', 'tokenizers', 'huggingface_hub'),
+    },
+    'llm': ('langchain.prompts',),
+    'parsing': ('langchain_text_splitters', 'langchain_community.document_loaders', 'langchain_core.documents'),
+    'rerank': ('torch', 'sentence_transformers'),
+}
+
+
+def worker_warm_up_components(profile=None):
+    """
+    Worker 需要預熱的資源：依 RAG_WORKER_PROFILE 對應佇列設定檔的 warm_up (未指定設定檔時預熱全部)。
+    """
+    profile = profile or os.environ.get('RAG_WORKER_PROFILE')
+    if not profile:
+        return WARM_UP_COMPONENTS
+    return tuple(settings.RAG_CELERY_QUEUE_PROFILES[profile].get('warm_up', WARM_UP_COMPONENTS))
+
+
+def preload_modules(components):
+    """
+    只匯入資源需要的套件而不建立任何物件 (不載入模型、不開啟連線)，回傳匯入的模組名稱與秒數。
+    在 Worker 主進程 fork 子進程之前呼叫，子進程直接共用已匯入的模組 (copy-on-write)，不必各自再花匯入時間。
+    """
+    started = time.perf_counter()
+    names = []
+    for component in components:
+        if component == 'rerank' and not settings.RAG_RERANK_ENABLED:
+            continue
+        modules = _PRELOAD_MODULES.get(component, ())
+        if isinstance(modules, dict):
+            modules = modules.get(settings.RAG_EMBEDDING_BACKEND, ())
+        for name in modules:
+            importlib.import_module(name)
+            names.append(name)
+    return names, time.perf_counter() - started
+
+
+def process_memory():
+    """
+    本進程目前與峰值的 RSS (MB)；目前值讀取 /proc，其他平台只回報峰值。
+    """
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    current_mb = None
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    current_mb = round(int(line.split()[1]) / 1024, 1)
+                    break
+    except OSError:
+        pass
+    # Linux 的 ru_maxrss 單位為 KB，macOS 為 byte
+    peak_mb = peak_kb / 1024 / 1024 if os.uname().sysname == 'Darwin' else peak_kb / 1024
+    return {'rss_mb': current_mb, 'peak_rss_mb': round(peak_mb, 1)}
+
+
+class WorkerRegistry:
+    """
+    每個 Worker 進程一份的常駐資源：ChromaDB 客戶端、依 LRU 保留的向量庫 handle、Ollama 客戶端與問答 Prompt。
+    在 Celery 的 worker_process_init 時預熱，之後的任務直接重用，不必每個問題重新建立。
+    """
+
+    def __init__(self, max_vector_stores=32, chroma_path=CHROMA_DB_PATH):
+        self.max_vector_stores = max_vector_stores
+        self.chroma_path = chroma_path
+        self._lock = threading.RLock()
+        self._qa_prompt = None
+        self._chroma_client = None
+        self._vector_stores = OrderedDict()
+        self._llm = None
+
+        self.created_at = time.time()
+        self.warm_up_seconds = None
+        self.warmed_up = ()
+        self.vector_store_hits = 0
+        self.vector_store_misses = 0
+        self.vector_store_evictions = 0
+        # 最近完成的問答 (完成時間, 從建立到完成的秒數)，用來計算延遲百分位數與吞吐量
+        self._answer_latencies = deque(maxlen=settings.RAG_ANSWER_LATENCY_SAMPLES)
+
+    def warm_up(self, components=WARM_UP_COMPONENTS):
+        """
+        預先建立指定的常駐資源，記錄所花時間：chroma (ChromaDB 客戶端)、embedding (載入嵌入模型)、
+        llm (Ollama 客戶端與問答 Prompt)、parsing (文件解析與分塊的套件)、rerank (載入 cross-encoder，未啟用重新排序時略過)。
+        """
+        from .reranker import get_reranker
+
+        started = time.perf_counter()
+        if 'chroma' in components:
+            self.get_chroma_client()
+        if 'llm' in components:
+            self.get_llm()
+            self.qa_prompt # 匯入 LangChain 並建立問答 Prompt
+        if 'parsing' in components:
+            preload_modules(['parsing'])
+        if 'embedding' in components:
+            get_embedding_engine().embed_query("warm up")
+        reranker = get_reranker() if 'rerank' in components else None
+        if reranker is not None:
+            reranker.warm_up()
+        self.warm_up_seconds = time.perf_counter() - started
+        self.warmed_up = tuple(components)
+        print(f"進程 {os.getpid()} 預熱完成 ({', '.join(components)})，耗時 {self.warm_up_seconds:.2f} 秒。")
+
+    @property
+    def qa_prompt(self):
+        with self._lock:
+            if self._qa_prompt is None:
+                from langchain.prompts import PromptTemplate
+
+                self._qa_prompt = PromptTemplate.from_template(QA_PROMPT_TEMPLATE)
+            return self._qa_prompt
+
+    def get_chroma_client(self):
+        with self._lock:
+            if self._chroma_client is None:
+                import chromadb
+
+                self._chroma_client = chromadb.PersistentClient(path=self.chroma_path)
+            return self._chroma_client
+
+    def get_vector_store(self, collection_name):
+        with self._lock:
+            vector_store = self._vector_stores.get(collection_name)
+            if vector_store is not None:
+                self._vector_stores.move_to_end(collection_name)
+                self.vector_store_hits += 1
+                return vector_store
+
+            self.vector_store_misses += 1
+            from langchain_community.vectorstores import Chroma
+
+            vector_store = Chroma(
+                client=self.get_chroma_client(),
+                embedding_function=get_embedding_engine(),
+                collection_name=collection_name,
+            )
+            self._vector_stores[collection_name] = vector_store
+            while len(self._vector_stores) > self.max_vector_stores:
+                self._vector_stores.popitem(last=False)
+                self.vector_store_evictions += 1
+            return vector_store
+
+    def evict_vector_store(self, collection_name):
+        with self._lock:
+            self._vector_stores.pop(collection_name, None)
+
+    def get_llm(self):
+        with self._lock:
+            if self._llm is None:
+                self._llm = OllamaClient(
+                    base_url=settings.RAG_OLLAMA_BASE_URL,
+                    model=settings.RAG_OLLAMA_MODEL,
+                    keep_alive=settings.RAG_OLLAMA_KEEP_ALIVE,
+                    timeout=settings.RAG_OLLAMA_TIMEOUT,
+                    max_parallel=settings.RAG_OLLAMA_NUM_PARALLEL,
+                )
+            return self._llm
+
+    def record_answer(self, seconds):
+        with self._lock:
+            self._answer_latencies.append((time.time(), seconds))
+
+    def _answer_stats(self):
+        with self._lock:
+            samples = list(self._answer_latencies)
+        if not samples:
+            return {'count': 0, 'p50_seconds': None, 'p95_seconds': None, 'per_second': None}
+        latencies = np.array([seconds for _, seconds in samples])
+        span = samples[-1][0] - samples[0][0]
+        return {
+            'count': len(samples),
+            'p50_seconds': round(float(np.percentile(latencies, 50)), 3),
+            'p95_seconds': round(float(np.percentile(latencies, 95)), 3),
+            'per_second': round((len(samples) - 1) / span, 3) if span > 0 else None,
+        }
+
+    def stats(self):
+        from .answer_batching import get_answer_batcher
+        from .reranker import get_reranker
+
+        batcher = get_answer_batcher()
+        reranker = get_reranker()
+        lookups = self.vector_store_hits + self.vector_store_misses
+        engine = get_embedding_engine()
+        llm = self._llm
+        return {
+            'hostname': socket.gethostname(),
+            'pid': os.getpid(),
+            'uptime_seconds': round(time.time() - self.created_at, 1),
+            'warm_up_seconds': None if self.warm_up_seconds is None else round(self.warm_up_seconds, 3),
+            'warmed_up': list(self.warmed_up),
+            'embedding_model_loaded': engine.model_loaded,
+            'embedding_processes': engine.pool_processes,
+            'memory': process_memory(),
+            'vector_stores': {
+                'open': len(self._vector_stores),
+                'max': self.max_vector_stores,
+                'hits': self.vector_store_hits,
+                'misses': self.vector_store_misses,
+                'evictions': self.vector_store_evictions,
+                'hit_rate': round(self.vector_store_hits / lookups, 3) if lookups else None,
+            },
+            'llm': {
+                'model': settings.RAG_OLLAMA_MODEL,
+                'requests': llm.request_count if llm else 0,
+                'avg_seconds': round(llm.total_seconds / llm.request_count, 3) if llm and llm.request_count else None,
+                'max_parallel': llm.max_parallel if llm else settings.RAG_OLLAMA_NUM_PARALLEL,
+                'slot_wait_seconds': round(llm.slot_wait_seconds, 3) if llm else 0,
+            },
+            'answers': self._answer_stats(),
+            'answer_batching': batcher.stats() if batcher is not None else None,
+            'rerank': reranker.stats() if reranker is not None else None,
+            'embedding_cache': engine.cache.stats() if engine.cache is not None else None,
+        }
+
+    def publish_stats(self):
+        """
+        將本進程的統計寫入 Redis (帶 TTL)，讓 Web 端的健康檢查端點可以彙整所有 Worker 進程。
+        """
+        stats = self.stats()
+        try:
+            get_redis().set(
+                f"{WORKER_STATS_KEY_PREFIX}{stats['hostname']}:{stats['pid']}",
+                json.dumps(stats),
+                ex=settings.RAG_WORKER_STATS_TTL,
+            )
+        except redis.RedisError as e:
+            print(f"警告: 寫入 Worker 統計失敗: {e}")
+
+
+_redis_client = None
+
+
+def get_redis():
+    global _redis_client
+    if _redis_client is None:
+        _redis_client = redis.Redis.from_url(settings.RAG_REDIS_URL)
+    return _redis_client
+
+
+def read_worker_stats():
+    client = get_redis()
+    keys = sorted(client.scan_iter(match=f"{WORKER_STATS_KEY_PREFIX}*"))
+    if not keys:
+        return []
+    return [json.loads(value) for value in client.mget(keys) if value]
+
+
+_registry = None
+
+
+def get_registry():
+    global _registry
+    if _registry is None:
+        _registry = WorkerRegistry(max_vector_stores=settings.RAG_VECTOR_STORE_POOL_SIZE)
+    return _registry
+
+
+def warm_up_web_process():
+    """
+    Web 進程 (WSGI/ASGI) 啟動時預熱語意搜尋用到的嵌入模型與 ChromaDB 客戶端；未啟用 RAG_SEARCH_WARM_UP_IN_WEB 時不做任何事。
+    預熱失敗只印出警告，第一個請求時會再嘗試載入。
+    """
+    if not settings.RAG_SEARCH_WARM_UP_IN_WEB:
+        return
+    try:
+        get_registry().warm_up(('chroma', 'embedding'))
+    except Exception as e:
+        print(f"警告: Web 進程預熱失敗: {e}")
@@ -0,0 +1,173 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+
+from .answer_cache import normalize_question
+
+# 還沒有每對 (問題, 區塊) 的耗時估計時，第一批只計算這麼多對，用來校正估計值，避免第一批就超出時間預算
+_CALIBRATION_PAIRS = 4
+_ESTIMATE_SMOOTHING = 0.2
+
+# ranked：重新排序後的 [(區塊, 距離)]；scores：{區塊ID: cross-encoder 分數}；
+# scored：排序依據分數的前幾個候選數 (之後維持原本的檢索順序)；timed_out：是否因時間預算用完而提前停止
+RerankResult = namedtuple('RerankResult', ['ranked', 'scores', 'scored', 'cache_hits', 'timed_out', 'seconds'])
+
+
+class CrossEncoderReranker:
+    """
+    以 sentence-transformers 的 cross-encoder 在 CPU 上為 (問題, 區塊) 重新評分。
+    分數以 (正規化問題, 區塊ID) 為鍵保留在進程內的 LRU；區塊ID由內容雜湊決定，文件重新向量化後內容沒變的區塊仍可沿用。
+    """
+
+    def __init__(self, model_name, batch_size=16, max_length=256, cache_size=20000):
+        self.model_name = model_name
+        self.batch_size = max(1, batch_size)
+        self.max_length = max_length
+        self.cache_size = cache_size
+        self._model = None
+        self._loader = None # 背景載入模型的執行緒
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._seconds_per_pair = None
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.timeouts = 0
+
+    def _get_model(self):
+        with self._lock:
+            if self._model is None:
+                from sentence_transformers import CrossEncoder
+
+                self._model = CrossEncoder(self.model_name, max_length=self.max_length, device='cpu')
+            return self._model
+
+    def _load_in_background(self):
+        # 模型尚未載入時不在請求的時間預算內同步載入，改在背景載入，之後的請求才重新排序
+        with self._lock:
+            if self._model is not None or (self._loader is not None and self._loader.is_alive()):
+                return
+            self._loader = threading.Thread(target=self._load_quietly, name='reranker-load', daemon=True)
+            self._loader.start()
+
+    def _load_quietly(self):
+        try:
+            self._get_model()
+        except Exception as e:
+            print(f"警告: 載入重新排序模型 {self.model_name} 失敗: {e}")
+
+    def warm_up(self):
+        # 先載入模型，再計算一對得到每對耗時的初始估計 (載入時間不計入估計)
+        model = self._get_model()
+        started = time.perf_counter()
+        model.predict([("warm up", "warm up")], show_progress_bar=False)
+        self._seconds_per_pair = time.perf_counter() - started
+
+    def _predict(self, question, chunks):
+        model = self._get_model()
+        started = time.perf_counter()
+        scores = model.predict(
+            [(question, chunk.page_content) for chunk in chunks], batch_size=len(chunks), show_progress_bar=False,
+        )
+        per_pair = (time.perf_counter() - started) / len(chunks)
+        if self._seconds_per_pair is None:
+            self._seconds_per_pair = per_pair
+        else:
+            self._seconds_per_pair += _ESTIMATE_SMOOTHING * (per_pair - self._seconds_per_pair)
+        return [float(score) for score in scores]
+
+    def rerank(self, question, candidates, budget_seconds):
+        """
+        依 cross-encoder 分數重新排序檢索結果 candidates ([(區塊, 距離)]，依檢索名次排序)。
+        未快取的候選依檢索名次分批評分；每批開始前依每對的耗時估計縮小批次，預估會超出 budget_seconds 時停止
+        (已開始的批次不會中斷；第一批至少評分一對，即使估計值顯示會超出預算)。全部評分完成時依分數排序；時間用完時只有連續評分完成的前幾個候選依分數排序，
+        其餘維持原本的檢索順序。模型尚未載入時不評分 (視為時間用完)，並在背景載入模型。
+        """
+        started = time.perf_counter()
+        deadline = started + budget_seconds
+        question_key = hashlib.sha256(normalize_question(question).encode('utf-8')).hexdigest()
+
+        scores, pending = {}, []
+        with self._lock:
+            for chunk, _ in candidates:
+                score = self._cache.get((question_key, chunk.id))
+                if score is None:
+                    pending.append(chunk)
+                else:
+                    self._cache.move_to_end((question_key, chunk.id))
+                    scores[chunk.id] = score
+            self.cache_hits += len(scores)
+            self.cache_misses += len(pending)
+        cache_hits = len(scores)
+
+        timed_out = False
+        position = 0
+        if pending and self._model is None:
+            self._load_in_background()
+            timed_out = True
+        while position < len(pending) and not timed_out:
+            remaining = deadline - time.perf_counter()
+            estimate = self._seconds_per_pair
+            if estimate is None:
+                size = min(self.batch_size, _CALIBRATION_PAIRS)
+            else:
+                size = min(self.batch_size, int(remaining / estimate) if estimate > 0 else self.batch_size)
+            if position == 0:
+                # 每次呼叫至少評分一對，讓偏高的估計值有機會被實際耗時修正
+                size = max(1, size)
+            if remaining <= 0 or size < 1:
+                timed_out = True
+                break
+            batch = pending[position:position + size]
+            batch_scores = self._predict(question, batch)
+            with self._lock:
+                for chunk, score in zip(batch, batch_scores):
+                    scores[chunk.id] = score
+                    self._cache[(question_key, chunk.id)] = score
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+            position += len(batch)
+        if timed_out:
+            self.timeouts += 1
+
+        # 依檢索名次連續評分完成的前幾個候選才依分數排序
+        scored = next((index for index, (chunk, _) in enumerate(candidates) if chunk.id not in scores), len(candidates))
+        head = sorted(candidates[:scored], key=lambda item: -scores[item[0].id])
+        return RerankResult(
+            head + list(candidates[scored:]), scores, scored, cache_hits, timed_out, time.perf_counter() - started,
+        )
+
+    def stats(self):
+        lookups = self.cache_hits + self.cache_misses
+        return {
+            'model': self.model_name,
+            'loaded': self._model is not None,
+            'cache_entries': len(self._cache),
+            'cache_hit_rate': round(self.cache_hits / lookups, 3) if lookups else None,
+            'seconds_per_pair': None if self._seconds_per_pair is None else round(self._seconds_per_pair, 5),
+            'timeouts': self.timeouts,
+        }
+
+
+_reranker = None
+_reranker_lock = threading.Lock()
+
+
+def get_reranker():
+    """
+    取得進程內共用的重新排序器；未啟用 RAG_RERANK_ENABLED 時回傳 None。模型在第一次使用 (或預熱) 時才載入。
+    """
+    global _reranker
+    if not settings.RAG_RERANK_ENABLED:
+        return None
+    with _reranker_lock:
+        if _reranker is None:
+            _reranker = CrossEncoderReranker(
+                settings.RAG_RERANK_MODEL_NAME,
+                batch_size=settings.RAG_RERANK_BATCH_SIZE,
+                max_length=settings.RAG_RERANK_MAX_LENGTH,
+                cache_size=settings.RAG_RERANK_CACHE_SIZE,
+            )
+    return _reranker
@@ -0,0 +1,301 @@
+import json
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from django.conf import settings
+from langchain_core.documents import Document as ChunkDocument
+
+from . import lexical_index, quantized_index
+from .vector_layout import index_target
+
+_executor = None
+
+
+def _get_executor():
+    # 進程內共用的執行緒池；Chroma 查詢主要在原生程式碼中執行，可以並行
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.RAG_RETRIEVAL_MAX_WORKERS,
+            thread_name_prefix='rag-retrieval',
+        )
+    return _executor
+
+
+def search_targets(documents):
+    """
+    將文件依存放位置分組：每文件一個 Collection 時各自查詢；共用 Collection 時同一分片的文件合併成一次 $in 過濾查詢。
+    回傳 [(collection_name, where)]。
+    """
+    targets = []
+    shared = defaultdict(list)
+    for document in documents:
+        target = index_target(document.id, document.index_layout)
+        if target.where is None:
+            targets.append((target.collection_name, None))
+        else:
+            shared[target.collection_name].append(str(document.id))
+    for collection_name, document_ids in shared.items():
+        if len(document_ids) == 1:
+            where = {'source_file_id': document_ids[0]}
+        else:
+            where = {'source_file_id': {'$in': document_ids}}
+        targets.append((collection_name, where))
+    return targets
+
+
+def _dense_search(registry, collection_name, where, question_vectors, k):
+    """
+    以一次多向量查詢取回多個問題在同一個 Collection 中的前 k 個區塊，回傳與 question_vectors 對應的結果列表。
+    直接查詢底層 Collection 以取得區塊 ID (LangChain 的包裝不回傳 ID)，融合排序時需要用它對齊兩路結果。
+    """
+    collection = registry.get_vector_store(collection_name)._collection
+    results = collection.query(
+        query_embeddings=question_vectors,
+        n_results=k,
+        where=where,
+        include=['documents', 'metadatas', 'distances'],
+    )
+    return [
+        [
+            (ChunkDocument(id=chunk_id, page_content=text, metadata=metadata or {}), distance)
+            for chunk_id, text, metadata, distance in zip(ids, texts, metadatas, distances)
+        ]
+        for ids, texts, metadatas, distances in zip(
+            results['ids'], results['documents'], results['metadatas'], results['distances']
+        )
+    ]
+
+
+def _quantized_search(registry, document, index, question_vectors, k):
+    """
+    以文件的量化索引取回多個問題的前 k 個區塊 (距離為重新排序向量的平方歐氏距離，與 Chroma 的 l2 距離一致)。
+    所有問題命中區塊的文字與 metadata 以一次依區塊 ID 的查詢從 Chroma 取回 (不取嵌入，Chroma 不必載入向量)。
+    回傳與 question_vectors 對應的結果列表。
+    """
+    hits = index.search(question_vectors, k)
+    wanted = list(dict.fromkeys(chunk_id for per_question in hits for chunk_id, _ in per_question))
+    if not wanted:
+        return [[] for _ in hits]
+    collection_name = index_target(document.id, document.index_layout).collection_name
+    stored = registry.get_vector_store(collection_name)._collection.get(ids=wanted, include=['documents', 'metadatas'])
+    chunks = {
+        chunk_id: ChunkDocument(id=chunk_id, page_content=text, metadata=metadata or {})
+        for chunk_id, text, metadata in zip(stored['ids'], stored['documents'], stored['metadatas'])
+    }
+    return [
+        [(chunks[chunk_id], distance) for chunk_id, distance in per_question if chunk_id in chunks]
+        for per_question in hits
+    ]
+
+
+def _index_vectors(document, chunk_ids):
+    """
+    使用量化檢索後端且文件已有量化索引時，從索引的重新排序向量取回區塊嵌入 ({區塊ID: 向量})，不必讓 Chroma 載入向量；
+    否則回傳空字典。
+    """
+    if not quantized_index.enabled():
+        return {}
+    index = quantized_index.get_index(document.id)
+    return index.vectors(chunk_ids) if index is not None else {}
+
+
+def _dense_jobs(registry, documents):
+    """
+    決定文件的向量查詢方式，回傳 [(分組鍵, 查詢函式, 固定參數)]：使用量化檢索後端時，已有量化索引的文件各自查詢量化索引，
+    其餘文件依 search_targets 查詢 Chroma。同一分組鍵的請求可合併成一次多向量查詢。
+    """
+    remaining = documents
+    jobs = []
+    if quantized_index.enabled():
+        remaining = []
+        for document in documents:
+            index = quantized_index.get_index(document.id)
+            if index is None:
+                remaining.append(document)
+            else:
+                jobs.append((('quantized', str(document.id)), _quantized_search, (registry, document, index)))
+    for collection_name, where in search_targets(remaining):
+        key = ('chroma', collection_name, json.dumps(where, sort_keys=True))
+        jobs.append((key, _dense_search, (registry, collection_name, where)))
+    return jobs
+
+
+def _fetch_chunks(registry, hits, question_vector):
+    """
+    取回只出現在關鍵字檢索結果中的區塊內容，並計算其向量距離，讓所有來源的 score 意義一致。
+    """
+    by_document = defaultdict(list)
+    documents = {}
+    for chunk_id, _, document in hits:
+        by_document[str(document.id)].append(chunk_id)
+        documents[str(document.id)] = document
+    by_collection = defaultdict(list)
+    vectors = {}
+    for document_id, chunk_ids in by_document.items():
+        document = documents[document_id]
+        by_collection[index_target(document.id, document.index_layout).collection_name].extend(chunk_ids)
+        vectors.update(_index_vectors(document, chunk_ids))
+
+    query = np.asarray(question_vector, dtype=np.float32)
+    fetched = {}
+    for collection_name, chunk_ids in by_collection.items():
+        collection = registry.get_vector_store(collection_name)._collection
+        include = ['documents', 'metadatas']
+        if any(chunk_id not in vectors for chunk_id in chunk_ids):
+            include.append('embeddings')
+        results = collection.get(ids=chunk_ids, include=include)
+        embeddings = results['embeddings'] if 'embeddings' in include else [None] * len(results['ids'])
+        for chunk_id, text, metadata, embedding in zip(results['ids'], results['documents'], results['metadatas'], embeddings):
+            if chunk_id in vectors:
+                embedding = vectors[chunk_id]
+            # Chroma 預設的 l2 空間回傳的是平方歐氏距離
+            distance = float(np.sum((np.asarray(embedding, dtype=np.float32) - query) ** 2))
+            fetched[chunk_id] = (ChunkDocument(id=chunk_id, page_content=text, metadata=metadata or {}), distance)
+    return fetched
+
+
+def fetch_chunk_embeddings(registry, documents, chunks):
+    """
+    取回檢索結果中各區塊的嵌入 ({區塊ID: 向量})，同一個 Collection 的區塊合併成一次查詢；組合 Context 時用來計算區塊之間的相似度。
+    """
+    by_document = {str(document.id): document for document in documents}
+    wanted = defaultdict(list)
+    for chunk in chunks:
+        document = by_document.get(chunk.metadata.get('source_file_id'))
+        if document is not None and chunk.id:
+            wanted[str(document.id)].append(chunk.id)
+
+    # 已有量化索引的文件直接讀取索引中的重新排序向量，其餘依 Collection 合併查詢 Chroma
+    embeddings = {}
+    by_collection = defaultdict(list)
+    for document_id, chunk_ids in wanted.items():
+        document = by_document[document_id]
+        embeddings.update(_index_vectors(document, chunk_ids))
+        by_collection[index_target(document.id, document.index_layout).collection_name].extend(
+            chunk_id for chunk_id in chunk_ids if chunk_id not in embeddings
+        )
+    for collection_name, chunk_ids in by_collection.items():
+        if not chunk_ids:
+            continue
+        collection = registry.get_vector_store(collection_name)._collection
+        results = collection.get(ids=chunk_ids, include=['embeddings'])
+        embeddings.update(zip(results['ids'], results['embeddings']))
+    return embeddings
+
+
+def _reciprocal_rank_fusion(*rankings):
+    """
+    RRF：每個區塊的分數為它在各路結果中 1 / (k + 名次) 的總和，只看名次，不需要校正兩種分數的尺度。
+    """
+    rrf_k = settings.RAG_HYBRID_RRF_K
+    scores = defaultdict(float)
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking, start=1):
+            scores[chunk_id] += 1.0 / (rrf_k + rank)
+    return sorted(scores, key=lambda chunk_id: -scores[chunk_id])
+
+
+def retrieve(registry, documents, question_vector, k, question=None):
+    """
+    對多個文件的向量庫並行檢索，依距離合併後取前 k 個。回傳 [(langchain Document, distance)]，距離越小越相似。
+    整體延遲取決於最慢的一個 Collection，而不是所有 Collection 的總和。
+    傳入 question 且啟用混合檢索時，同時以 BM25 倒排索引檢索，兩路結果以 RRF 融合排序。
+    """
+    return retrieve_many(registry, [(documents, question_vector, question)], k)[0]
+
+
+def retrieve_many(registry, requests, k):
+    """
+    一次處理多個檢索請求 [(documents, question_vector, question)]，回傳與 requests 對應的結果列表。
+    查詢相同 (Collection, 過濾條件) 或相同量化索引的請求合併成一次多向量查詢，所有查詢與關鍵字檢索放進同一個執行緒池並行。
+    範圍超過 RAG_LEXICAL_MAX_DOCUMENTS 個文件 (例如全庫提問) 的請求，關鍵字檢索在向量查詢之後進行，只搜尋向量檢索命中的前幾個文件，
+    延遲不隨文件數線性增加。
+    """
+    groups = {} # (分組鍵, depth) -> (查詢函式, 固定參數, [request index])
+    depths = []
+    for index, (documents, _, question) in enumerate(requests):
+        hybrid = question is not None and settings.RAG_HYBRID_SEARCH_ENABLED
+        depth = max(k, settings.RAG_HYBRID_CANDIDATES) if hybrid else k
+        depths.append(depth)
+        for key, function, arguments in _dense_jobs(registry, documents):
+            groups.setdefault((key, depth), (function, arguments, []))[2].append(index)
+
+    jobs = [
+        (function, (*arguments, [requests[index][1] for index in indices], depth))
+        for (_, depth), (function, arguments, indices) in groups.items()
+    ]
+    lexical_indices, narrowed_indices = [], []
+    for index, (documents, _, question) in enumerate(requests):
+        if question is None or not settings.RAG_HYBRID_SEARCH_ENABLED:
+            continue
+        if len(documents) > settings.RAG_LEXICAL_MAX_DOCUMENTS:
+            narrowed_indices.append(index)
+        else:
+            lexical_indices.append(index)
+    # 關鍵字檢索與向量查詢一起放進執行緒池，幾乎不增加整體延遲
+    jobs.extend(
+        (lexical_index.search_documents, (requests[index][0], requests[index][2], depths[index]))
+        for index in lexical_indices
+    )
+    if not jobs:
+        return [[] for _ in requests]
+    results = _run_jobs(jobs)
+
+    dense = [[] for _ in requests]
+    for (_, _, indices), group_results in zip(groups.values(), results):
+        for index, hits in zip(indices, group_results):
+            dense[index].extend(hits)
+    lexical = {index: hits for index, hits in zip(lexical_indices, results[len(groups):])}
+    if narrowed_indices:
+        narrowed_jobs = [
+            (lexical_index.search_documents, (
+                _lexical_candidates(requests[index][0], dense[index], settings.RAG_LEXICAL_MAX_DOCUMENTS),
+                requests[index][2], depths[index],
+            ))
+            for index in narrowed_indices
+        ]
+        lexical.update(zip(narrowed_indices, _run_jobs(narrowed_jobs)))
+    return [
+        _fuse(registry, dense[index], lexical.get(index), requests[index][1], k, depths[index])
+        for index in range(len(requests))
+    ]
+
+
+def _run_jobs(jobs):
+    if len(jobs) == 1:
+        return [jobs[0][0](*jobs[0][1])]
+    return list(_get_executor().map(lambda job: job[0](*job[1]), jobs))
+
+
+def _lexical_candidates(documents, dense_hits, limit):
+    """
+    依向量檢索結果挑出關鍵字檢索要搜尋的文件：依命中區塊的距離順序，取前 limit 個不同的文件。
+    """
+    by_id = {str(document.id): document for document in documents}
+    selected = {}
+    for chunk, _ in sorted(dense_hits, key=lambda item: item[1]):
+        document_id = chunk.metadata.get('source_file_id')
+        if document_id in by_id and document_id not in selected:
+            selected[document_id] = by_id[document_id]
+            if len(selected) >= limit:
+                break
+    return list(selected.values())
+
+
+def _fuse(registry, dense, lexical_hits, question_vector, k, depth):
+    dense.sort(key=lambda item: item[1])
+    dense = dense[:depth]
+    if not lexical_hits:
+        return dense[:k]
+
+    fused_ids = _reciprocal_rank_fusion(
+        [doc.id for doc, _ in dense],
+        [chunk_id for chunk_id, _, _ in lexical_hits],
+    )[:k]
+    chunks = {doc.id: (doc, distance) for doc, distance in dense}
+    missing = [hit for hit in lexical_hits if hit[0] in fused_ids and hit[0] not in chunks]
+    if missing:
+        chunks.update(_fetch_chunks(registry, missing, question_vector))
+    return [chunks[chunk_id] for chunk_id in fused_ids if chunk_id in chunks]
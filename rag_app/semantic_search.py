@@ -0,0 +1,65 @@
+import time
+
+from django.conf import settings
+
+from .embedding import get_embedding_engine
+from .instrumentation import StageTimings
+from .registry import get_registry
+from .reranker import get_reranker
+from .retrieval import retrieve
+
+
+def _result(rank, chunk, distance, rerank_scores):
+    metadata = chunk.metadata or {}
+    result = {
+        'rank': rank,
+        'chunk_id': chunk.id,
+        'document': metadata.get('source_file_id'),
+        'filename': metadata.get('source_filename'),
+        'page': metadata.get('page'),
+        'page_label': metadata.get('page_label'),
+        'score': round(distance, 4), # 與問答參考來源相同：向量距離，越小越相似
+        'content': chunk.page_content,
+        'metadata': metadata,
+    }
+    if chunk.id in rerank_scores:
+        result['rerank_score'] = round(rerank_scores[chunk.id], 4)
+    return result
+
+
+def semantic_search(documents, query, k, rerank=False):
+    """
+    在 documents 中同步檢索與 query 最相關的 k 個區塊 (不經過 Celery，也不呼叫 LLM)，回傳
+    {'results': [...], 'timings_ms': {...}}。嵌入模型與向量庫連線使用本進程常駐的實例 (與問答相同的檢索路徑，含混合檢索)；
+    rerank 為 True 且啟用 RAG_RERANK_ENABLED 時多取候選，在 RAG_SEARCH_RERANK_BUDGET_MS 內以 cross-encoder 重新排序。
+    各階段秒數寫入 search 管線的直方圖 (/metrics)。
+    """
+    timings = StageTimings('search')
+    started = time.perf_counter()
+    reranker = get_reranker() if rerank else None
+    depth = max(k, settings.RAG_RERANK_CANDIDATES) if reranker is not None else k
+
+    with timings.stage('embed'):
+        question_vector = get_embedding_engine().embed_query(query)
+    with timings.stage('retrieve'):
+        retrieved = retrieve(get_registry(), documents, question_vector, k=depth, question=query)
+
+    rerank_scores = {}
+    if reranker is not None and retrieved:
+        reranked = reranker.rerank(query, retrieved, settings.RAG_SEARCH_RERANK_BUDGET_MS / 1000)
+        timings.add('rerank', reranked.seconds)
+        retrieved, rerank_scores = reranked.ranked, reranked.scores
+    retrieved = retrieved[:k]
+    timings.add('total', time.perf_counter() - started)
+
+    seconds = timings.finish(attributes={
+        'rag.search.documents': len(documents),
+        'rag.search.k': k,
+        'rag.search.results': len(retrieved),
+    })
+    return {
+        'results': [
+            _result(rank, chunk, distance, rerank_scores) for rank, (chunk, distance) in enumerate(retrieved, start=1)
+        ],
+        'timings_ms': {stage: round(value * 1000, 2) for stage, value in seconds.items()},
+    }
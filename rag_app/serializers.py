@@ -1,16 +1,96 @@
+import os
 from rest_framework import serializers
-from .models import Document, QuestionAnswer
+from django.utils import timezone
+from .models import Document, IngestBatch, QuestionAnswer
+from .pagination import requested_fields
+from .bulk_upload import SUPPORTED_EXTENSIONS, uploaded_file_matches_extension
+
+class SparseFieldsMixin:
+    # 請求帶有 ?fields=a,b 時只輸出指定的欄位 (未知的名稱忽略)；巢狀使用時沒有 request，一律輸出所有欄位
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        fields = requested_fields(self.context.get('request'))
+        if fields is not None:
+            for name in set(self.fields) - fields:
+                self.fields.pop(name)
+
+class DocumentSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    progress = serializers.SerializerMethodField()
 
-class DocumentSerializer(serializers.ModelSerializer):
     class Meta:
         model = Document
-        fields = ['id', 'file', 'filename', 'uploaded_at', 'status', 'processing_message']
-        read_only_fields = ['uploaded_at', 'status', 'processing_message', 'filename']
+        fields = ['id', 'file', 'filename', 'uploaded_at', 'updated_at', 'status', 'processing_message',
+                  'total_pages', 'processed_pages', 'processed_chunks', 'progress', 'stage_timings']
+        read_only_fields = ['uploaded_at', 'updated_at', 'status', 'processing_message', 'filename',
+                            'total_pages', 'processed_pages', 'processed_chunks', 'stage_timings']
+
+    def validate_file(self, value):
+        # 上傳時就拒絕不支援或內容與副檔名不符的檔案，不必等到向量化任務才失敗
+        extension = os.path.splitext(value.name)[1].lower()
+        if extension not in SUPPORTED_EXTENSIONS:
+            raise serializers.ValidationError(f"Unsupported file type: {extension or value.name}.")
+        if not uploaded_file_matches_extension(value):
+            raise serializers.ValidationError(f"File content does not match its extension: {extension}.")
+        return value
 
-class QuestionAnswerSerializer(serializers.ModelSerializer):
-    document_filename = serializers.CharField(source='document.filename', read_only=True)
+    def get_progress(self, obj):
+        # 向量化進度百分比 (依已寫入的頁數)；尚未開始計算頁數時為 None
+        if obj.status == 'COMPLETED':
+            return 100
+        if not obj.total_pages:
+            return None
+        return min(100, round(obj.processed_pages * 100 / obj.total_pages))
+
+class IngestBatchSerializer(serializers.ModelSerializer):
+    documents = DocumentSerializer(many=True, read_only=True)
+    status = serializers.SerializerMethodField()
+    document_counts = serializers.SerializerMethodField()
+    throughput = serializers.SerializerMethodField()
+
+    class Meta:
+        model = IngestBatch
+        fields = ['id', 'created_at', 'started_at', 'finished_at', 'status', 'total_documents', 'duplicate_files',
+                  'skipped_files', 'embedded_chunks', 'reused_chunks', 'embedding_batches', 'document_counts',
+                  'throughput', 'documents']
+        read_only_fields = fields
+
+    def get_status(self, obj):
+        return 'COMPLETED' if obj.finished_at else ('PROCESSING' if obj.started_at else 'PENDING')
+
+    def get_document_counts(self, obj):
+        # 批次內各狀態的文件數
+        counts = {status: 0 for status, _ in Document.STATUS_CHOICES}
+        for document in obj.documents.all():
+            counts[document.status] += 1
+        return counts
+
+    def get_throughput(self, obj):
+        # 從開始匯入 (或上傳) 到完成 (或目前) 的平均處理量
+        started = obj.started_at or obj.created_at
+        elapsed = ((obj.finished_at or timezone.now()) - started).total_seconds()
+        chunks = obj.embedded_chunks + obj.reused_chunks
+        completed = sum(1 for document in obj.documents.all() if document.status == 'COMPLETED')
+        return {
+            'elapsed_seconds': round(elapsed, 1),
+            'documents_per_second': round(completed / elapsed, 3) if elapsed > 0 else None,
+            'chunks_per_second': round(chunks / elapsed, 1) if elapsed > 0 else None,
+        }
+
+class QuestionAnswerSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    document_filename = serializers.CharField(source='document.filename', read_only=True, allow_null=True)
+    cited_documents = serializers.SerializerMethodField()
 
     class Meta:
         model = QuestionAnswer
-        fields = ['id', 'document', 'document_filename', 'question', 'answer', 'source_documents', 'created_at', 'status', 'error_message']
-        read_only_fields = ['answer', 'source_documents', 'created_at', 'status', 'error_message']
\ No newline at end of file
+        fields = ['id', 'document', 'document_filename', 'question', 'answer', 'source_documents', 'created_at', 'updated_at', 'status', 'error_message', 'cache_hit', 'scope', 'documents', 'cited_documents', 'stage_timings', 'context_tokens', 'context_tokens_saved']
+        read_only_fields = ['answer', 'source_documents', 'created_at', 'updated_at', 'status', 'error_message', 'cache_hit', 'scope', 'documents', 'stage_timings', 'context_tokens', 'context_tokens_saved']
+
+    def get_cited_documents(self, obj):
+        # 答案引用到的文件 (依來源區塊順序去重)，多文件/全庫提問時用來標示出處
+        cited = {}
+        for source in obj.source_documents or []:
+            metadata = source.get('metadata') or {}
+            file_id = metadata.get('source_file_id')
+            if file_id and file_id not in cited:
+                cited[file_id] = {'id': file_id, 'filename': metadata.get('source_filename')}
+        return list(cited.values())
\ No newline at end of file
@@ -0,0 +1,219 @@
+import json
+import os
+import time
+import zipfile
+from collections import namedtuple
+
+import numpy as np
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.utils import timezone
+
+from . import lexical_index
+from .embedding import EmbeddingEngine, get_embedding_engine
+from .embedding_cache import chunk_hash
+from .index_ops import delete_stale_chunks, iter_stored_chunks, refresh_quantized_index
+from .models import Document
+from .vector_layout import configured_layout, index_target
+
+SNAPSHOT_FORMAT = 'rag-document-snapshot'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_EXTENSION = '.ragsnap'
+_UPSERT_BATCH_SIZE = 1000
+
+# 快照是一個 zip 檔：
+#   manifest.json    格式版本、文件資訊、嵌入模型與維度、區塊數
+#   embeddings.npy   float32 [區塊數, 維度] (不壓縮，匯入時直接讀取)
+#   chunks.jsonl     每行一個區塊 {"id", "text", "metadata"}，順序與 embeddings 的列相同 (壓縮)
+#   file/<檔名>      原始上傳檔案 (可選)
+ImportResult = namedtuple('ImportResult', ['document', 'chunks', 'created', 'seconds'])
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def snapshot_filename(document_id):
+    return f"{document_id}{SNAPSHOT_EXTENSION}"
+
+
+def export_snapshot(registry, document, path, include_file=True):
+    """
+    將已完成向量化的文件 (區塊文字、metadata 與嵌入) 匯出成單一快照檔，先寫暫存檔再原子替換，回傳區塊數。
+    """
+    if document.status != 'COMPLETED':
+        raise SnapshotError(f"文件尚未完成向量化 (狀態 {document.status})。")
+    target = index_target(document.id, document.index_layout)
+    vector_db = registry.get_vector_store(target.collection_name)
+
+    chunk_lines, vector_batches = [], []
+    for batch in iter_stored_chunks(vector_db, target.where, ['documents', 'metadatas', 'embeddings']):
+        for chunk_id, text, metadata in zip(batch['ids'], batch['documents'], batch['metadatas']):
+            chunk_lines.append(json.dumps({'id': chunk_id, 'text': text, 'metadata': metadata or {}}, ensure_ascii=False))
+        vector_batches.append(np.asarray(batch['embeddings'], dtype=np.float32))
+    if not chunk_lines:
+        raise SnapshotError("向量庫中沒有此文件的區塊。")
+    vectors = np.concatenate(vector_batches)
+
+    file_path = document.file.path if document.file else None
+    if include_file and (file_path is None or not os.path.exists(file_path)):
+        include_file = False
+    manifest = {
+        'format': SNAPSHOT_FORMAT,
+        'version': SNAPSHOT_VERSION,
+        'created_at': timezone.now().isoformat(),
+        'document': {
+            'id': str(document.id),
+            'filename': document.filename,
+            'content_hash': document.content_hash,
+            'total_pages': document.total_pages,
+            'index_version': document.index_version,
+        },
+        'embedding': {
+            'model': settings.RAG_EMBEDDING_MODEL_NAME,
+            'dimension': int(vectors.shape[1]),
+            'dtype': 'float32',
+        },
+        'chunks': len(chunk_lines),
+        'file': f"file/{os.path.basename(document.filename or file_path)}" if include_file else None,
+    }
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with zipfile.ZipFile(tmp_path, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as zf:
+        zf.writestr('manifest.json', json.dumps(manifest, ensure_ascii=False, indent=2), compress_type=zipfile.ZIP_DEFLATED)
+        with zf.open('embeddings.npy', 'w', force_zip64=True) as f:
+            np.save(f, vectors)
+        zf.writestr('chunks.jsonl', '\n'.join(chunk_lines), compress_type=zipfile.ZIP_DEFLATED)
+        if include_file:
+            zf.write(file_path, arcname=manifest['file'])
+    os.replace(tmp_path, path)
+    return len(chunk_lines)
+
+
+def read_manifest(zf):
+    try:
+        manifest = json.loads(zf.read('manifest.json'))
+    except (KeyError, ValueError) as e:
+        raise SnapshotError(f"不是有效的文件快照: {e}")
+    if manifest.get('format') != SNAPSHOT_FORMAT:
+        raise SnapshotError("不是有效的文件快照。")
+    if manifest.get('version', 0) > SNAPSHOT_VERSION:
+        raise SnapshotError(f"不支援的快照版本 {manifest['version']} (目前支援到 {SNAPSHOT_VERSION})。")
+    return manifest
+
+
+def _check_embedding(manifest):
+    # 不同模型 (或維度) 的嵌入無法與本節點計算的問題嵌入比較
+    embedding = manifest['embedding']
+    if embedding['model'] != settings.RAG_EMBEDDING_MODEL_NAME:
+        raise SnapshotError(
+            f"快照的嵌入模型 {embedding['model']} 與本節點的 RAG_EMBEDDING_MODEL_NAME ({settings.RAG_EMBEDDING_MODEL_NAME}) 不同。"
+        )
+
+
+def stored_chunk_count(registry, document):
+    target = index_target(document.id, document.index_layout)
+    collection = registry.get_vector_store(target.collection_name)._collection
+    if target.where is None:
+        return collection.count()
+    return len(collection.get(where=target.where, include=[])['ids'])
+
+
+def _restore_file(zf, manifest, document):
+    """
+    快照帶有原始檔案且本節點沒有時寫入 media/ (沿用資料表中記錄的路徑，新文件則以原檔名存放)。
+    """
+    if not manifest.get('file'):
+        return
+    if document.file and os.path.exists(document.file.path):
+        return
+    with zf.open(manifest['file']) as f:
+        if document.file:
+            document.file.name = default_storage.save(document.file.name, File(f))
+        else:
+            document.file.save(os.path.basename(manifest['file']), File(f), save=False)
+
+
+def import_snapshot(registry, path, force=False, skip_existing=False):
+    """
+    將快照直接批次寫入本節點的向量庫 (不計算任何嵌入)，並重建關鍵字倒排索引與量化索引，回傳 ImportResult；
+    skip_existing 時，向量庫中已有相同區塊數的文件直接略過 (回傳 None)。
+
+    資料表中沒有此文件時以快照的資訊建立 (可用於全新的節點)；已有時 (多個節點共用資料庫) 沿用其索引配置與版本，
+    內容雜湊不同時需 force 才會覆寫，並遞增 index_version 讓答案快取失效。
+    """
+    started = time.perf_counter()
+    with zipfile.ZipFile(path) as zf:
+        manifest = read_manifest(zf)
+        _check_embedding(manifest)
+        info = manifest['document']
+
+        document = Document.objects.filter(id=info['id']).first()
+        created = document is None
+        if created:
+            document = Document(
+                id=info['id'],
+                filename=info['filename'],
+                content_hash=info['content_hash'],
+                total_pages=info['total_pages'],
+                processed_pages=info['total_pages'] or 0,
+                index_layout=configured_layout(),
+                index_version=max(1, info['index_version']),
+            )
+        else:
+            if document.status == 'PROCESSING':
+                raise SnapshotError("文件正在向量化中，請稍後再匯入。")
+            if skip_existing and document.status == 'COMPLETED' and stored_chunk_count(registry, document) == manifest['chunks']:
+                return None
+            if document.content_hash and info['content_hash'] and document.content_hash != info['content_hash']:
+                if not force:
+                    raise SnapshotError("快照與資料表中的文件內容不同 (content_hash 不符)，以 force 覆寫。")
+                document.content_hash = info['content_hash']
+                document.filename = info['filename']
+                document.index_version += 1
+            if document.status != 'COMPLETED':
+                document.index_layout = configured_layout()
+        target_version = document.index_version
+
+        with zf.open('embeddings.npy') as f:
+            vectors = np.load(f)
+        if vectors.shape != (manifest['chunks'], manifest['embedding']['dimension']):
+            raise SnapshotError(f"嵌入陣列的形狀 {vectors.shape} 與 manifest 不符。")
+        chunks = [json.loads(line) for line in zf.read('chunks.jsonl').decode('utf-8').splitlines() if line]
+        if len(chunks) != len(vectors):
+            raise SnapshotError("區塊數與嵌入數不符。")
+
+        target = index_target(document.id, document.index_layout)
+        vector_db = registry.get_vector_store(target.collection_name)
+        lexical_writer = lexical_index.LexicalIndexWriter(document.id) if settings.RAG_HYBRID_SEARCH_ENABLED else None
+        cache = get_embedding_engine().cache
+        for start in range(0, len(chunks), _UPSERT_BATCH_SIZE):
+            batch = chunks[start:start + _UPSERT_BATCH_SIZE]
+            batch_vectors = vectors[start:start + len(batch)]
+            ids = [chunk['id'] for chunk in batch]
+            texts = [chunk['text'] for chunk in batch]
+            metadatas = [
+                dict(chunk['metadata'], source_file_id=str(document.id), source_filename=document.filename,
+                     index_version=target_version)
+                for chunk in batch
+            ]
+            vector_db._collection.upsert(ids=ids, embeddings=batch_vectors.tolist(), documents=texts, metadatas=metadatas)
+            if lexical_writer is not None:
+                lexical_writer.add(ids, texts)
+            if cache is not None:
+                # 之後替換檔案或重新上傳時，內容沒變的區塊可以直接沿用這些嵌入
+                cache.put_many([chunk_hash(text) for text in EmbeddingEngine._prepare(texts)], batch_vectors)
+        delete_stale_chunks(vector_db, target.where, target_version)
+        if lexical_writer is not None:
+            lexical_writer.commit()
+        refresh_quantized_index(document.id, vector_db, target.where)
+
+        with transaction.atomic():
+            _restore_file(zf, manifest, document)
+            document.status = 'COMPLETED'
+            document.processed_chunks = len(chunks)
+            document.processing_message = f"已由快照匯入 ({len(chunks)} 個區塊，未重新計算嵌入)。"
+            document.save()
+    return ImportResult(document, len(chunks), created, time.perf_counter() - started)
@@ -0,0 +1,116 @@
+import json
+import time
+
+import redis
+from django.conf import settings
+
+STREAM_KEY_PREFIX = 'rag:qa_stream:'
+TERMINAL_EVENTS = ('done', 'error')
+
+
+def _stream_key(qa_id):
+    return f"{STREAM_KEY_PREFIX}{qa_id}"
+
+
+def format_sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+class AnswerStreamPublisher:
+    """
+    Worker 端：把答案生成過程的事件 (sources → token... → done/error) 依序寫入 Redis Stream。
+    使用 Stream 而非 Pub/Sub，晚一步連線的 SSE 客戶端也能從頭重播，不會漏掉已產生的 token。
+    """
+
+    def __init__(self, qa_id, client=None):
+        self.key = _stream_key(qa_id)
+        self._client = client or redis.Redis.from_url(settings.RAG_REDIS_URL)
+
+    def _publish(self, event, data):
+        try:
+            pipe = self._client.pipeline()
+            pipe.xadd(self.key, {'event': event, 'data': json.dumps(data, ensure_ascii=False)})
+            pipe.expire(self.key, settings.RAG_STREAM_TTL)
+            pipe.execute()
+        except redis.RedisError as e:
+            # 串流只是加速體驗，寫入失敗不影響答案本身的保存
+            print(f"警告: 寫入答案串流 {self.key} 失敗: {e}")
+
+    def sources(self, source_documents):
+        self._publish('sources', {'source_documents': source_documents})
+
+    def token(self, text):
+        self._publish('token', {'text': text})
+
+    def done(self, answer, cache_hit=False):
+        self._publish('done', {'status': 'COMPLETED', 'answer': answer, 'cache_hit': cache_hit})
+
+    def error(self, message):
+        self._publish('error', {'status': 'FAILED', 'message': message})
+
+
+def _decode_entry(fields):
+    return fields[b'event'].decode(), json.loads(fields[b'data'])
+
+
+def iter_answer_events(qa_id):
+    """
+    同步版本 (WSGI)：依序產出 SSE 格式的事件，直到 done/error 或逾時。
+    """
+    client = redis.Redis.from_url(settings.RAG_REDIS_URL)
+    key = _stream_key(qa_id)
+    last_id = '0-0'
+    deadline = time.monotonic() + settings.RAG_STREAM_TIMEOUT
+    while time.monotonic() < deadline:
+        response = client.xread({key: last_id}, block=settings.RAG_STREAM_HEARTBEAT_SECONDS * 1000)
+        if not response:
+            yield ": keep-alive\n\n"
+            continue
+        for entry_id, fields in response[0][1]:
+            last_id = entry_id
+            event, data = _decode_entry(fields)
+            yield format_sse(event, data)
+            if event in TERMINAL_EVENTS:
+                return
+    yield format_sse('error', {'status': 'FAILED', 'message': '等待答案逾時。'})
+
+
+async def aiter_answer_events(qa_id):
+    """
+    非同步版本 (ASGI)：等待 Redis 時不佔用執行緒。
+    """
+    import redis.asyncio as aioredis
+
+    client = aioredis.Redis.from_url(settings.RAG_REDIS_URL)
+    key = _stream_key(qa_id)
+    last_id = '0-0'
+    deadline = time.monotonic() + settings.RAG_STREAM_TIMEOUT
+    try:
+        while time.monotonic() < deadline:
+            response = await client.xread({key: last_id}, block=settings.RAG_STREAM_HEARTBEAT_SECONDS * 1000)
+            if not response:
+                yield ": keep-alive\n\n"
+                continue
+            for entry_id, fields in response[0][1]:
+                last_id = entry_id
+                event, data = _decode_entry(fields)
+                yield format_sse(event, data)
+                if event in TERMINAL_EVENTS:
+                    return
+        yield format_sse('error', {'status': 'FAILED', 'message': '等待答案逾時。'})
+    finally:
+        await client.aclose()
+
+
+def iter_completed_answer_events(qa_instance):
+    """
+    答案已經保存 (例如快取命中或串流已過期) 時，直接以資料庫內容組成完整的事件序列。
+    """
+    if qa_instance.source_documents:
+        yield format_sse('sources', {'source_documents': qa_instance.source_documents})
+    if qa_instance.status == 'FAILED':
+        yield format_sse('error', {'status': 'FAILED', 'message': qa_instance.error_message or ''})
+        return
+    if qa_instance.answer:
+        yield format_sse('token', {'text': qa_instance.answer})
+    yield format_sse('done', {'status': 'COMPLETED', 'answer': qa_instance.answer, 'cache_hit': qa_instance.cache_hit})
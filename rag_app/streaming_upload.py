@@ -0,0 +1,168 @@
+import hashlib
+import os
+import uuid
+from urllib.parse import unquote
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.files import File
+from django.db import close_old_connections, transaction
+from rest_framework.renderers import JSONRenderer
+
+from .bulk_upload import SNIFF_BYTES, SUPPORTED_EXTENSIONS, content_matches_extension
+from .models import Document
+from .serializers import DocumentSerializer
+from .tasks import parse_and_vectorize_document_task
+
+
+class UploadRejected(Exception):
+    def __init__(self, status, detail, **extra):
+        super().__init__(detail)
+        self.status = status
+        self.body = {'detail': detail, **extra}
+
+
+class _ClientDisconnected(Exception):
+    pass
+
+
+class _PartialFile(File):
+    # 讓 FileSystemStorage 以搬移 (rename) 取代複製，寫完的暫存檔直接成為文件檔案
+    def temporary_file_path(self):
+        return self.file.name
+
+
+def _duplicate_of(content_hash):
+    # 失敗的文件不算重複，允許重新上傳 (與批次上傳相同)
+    return Document.objects.filter(content_hash=content_hash).exclude(status='FAILED').values_list('id', flat=True).first()
+
+
+def _find_duplicate(content_hash):
+    # 不經過 Django 的請求流程，需自行處理資料庫連線的回收
+    close_old_connections()
+    try:
+        return _duplicate_of(content_hash)
+    finally:
+        close_old_connections()
+
+
+def _create_document(partial_path, filename, content_hash):
+    """
+    寫完的暫存檔再比對一次內容雜湊 (串流期間可能有相同內容的上傳先完成)，沒有重複時搬移成文件檔案、建立文件並排入向量化。
+    回傳 (文件序列化資料, None) 或 (None, 重複的文件ID)。
+    """
+    close_old_connections()
+    try:
+        duplicate_id = _duplicate_of(content_hash)
+        if duplicate_id is not None:
+            return None, duplicate_id
+        with transaction.atomic():
+            document = Document(filename=filename, content_hash=content_hash)
+            with open(partial_path, 'rb') as f:
+                document.file.save(filename, _PartialFile(f), save=False)
+            document.save()
+            transaction.on_commit(lambda: parse_and_vectorize_document_task.delay(str(document.id)))
+        return DocumentSerializer(document).data, None
+    finally:
+        close_old_connections()
+
+
+class StreamingUploadApplication:
+    """
+    包住 Django 的 ASGI application，直接處理 RAG_STREAM_UPLOAD_PATH 的上傳，其餘請求原樣交給 Django。
+    Django 的 ASGIHandler 會先把整個請求本文讀進暫存檔才呼叫 view，因此在 ASGI 層逐段讀取 receive() 的本文：
+    邊寫入磁碟邊計算 SHA-256，並在讀到開頭的內容時確認檔案格式，不支援、格式不符、過大或重複的檔案在寫完之前就回應錯誤。
+    等待本文時只佔用事件迴圈，不佔用執行緒；資料庫操作以 sync_to_async 執行。
+
+    請求本文為檔案原始內容 (非 multipart)，檔名放在 X-Filename 標頭 (URL 編碼)；可選的 X-Content-SHA256 讓重複的檔案在上傳前就被拒絕。
+    必要的自訂標頭使跨站請求一定要先經過 CORS preflight，因此不需要 CSRF token。
+    """
+
+    def __init__(self, app, path=None):
+        self.app = app
+        self.path = path or settings.RAG_STREAM_UPLOAD_PATH
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['path'] != self.path:
+            return await self.app(scope, receive, send)
+        try:
+            status, body = 201, await self._handle(scope, receive)
+        except UploadRejected as e:
+            status, body = e.status, e.body
+        except _ClientDisconnected:
+            return
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(b'content-type', b'application/json'), (b'cache-control', b'no-store')],
+        })
+        await send({'type': 'http.response.body', 'body': JSONRenderer().render(body)})
+
+    async def _handle(self, scope, receive):
+        if scope['method'] != 'POST':
+            raise UploadRejected(405, f"Method \"{scope['method']}\" not allowed.")
+        headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+
+        filename = os.path.basename(unquote(headers.get('x-filename', '')).replace('\\', '/'))
+        if not filename:
+            raise UploadRejected(400, "X-Filename header is required.")
+        extension = os.path.splitext(filename)[1].lower()
+        if extension not in SUPPORTED_EXTENSIONS:
+            raise UploadRejected(415, f"Unsupported file type: {extension or filename}.")
+
+        max_bytes = settings.RAG_UPLOAD_MAX_BYTES
+        try:
+            declared_length = int(headers['content-length']) if 'content-length' in headers else None
+        except ValueError:
+            raise UploadRejected(400, "Invalid Content-Length header.")
+        if declared_length is not None and declared_length > max_bytes:
+            raise UploadRejected(413, f"File too large (max {max_bytes} bytes).")
+
+        expected_hash = headers.get('x-content-sha256', '').strip().lower() or None
+        if expected_hash:
+            duplicate_id = await sync_to_async(_find_duplicate)(expected_hash)
+            if duplicate_id is not None:
+                raise UploadRejected(409, "Duplicate file.", duplicate_of=str(duplicate_id))
+
+        os.makedirs(settings.RAG_STREAM_UPLOAD_TMP_DIR, exist_ok=True)
+        partial_path = os.path.join(settings.RAG_STREAM_UPLOAD_TMP_DIR, f"{uuid.uuid4().hex}.part")
+        try:
+            content_hash = await self._receive_to_file(receive, partial_path, extension, max_bytes)
+            if expected_hash and expected_hash != content_hash:
+                raise UploadRejected(400, "Content does not match X-Content-SHA256.")
+            data, duplicate_id = await sync_to_async(_create_document)(partial_path, filename, content_hash)
+        finally:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+        if duplicate_id is not None:
+            raise UploadRejected(409, "Duplicate file.", duplicate_of=str(duplicate_id))
+        return data
+
+    @staticmethod
+    async def _receive_to_file(receive, partial_path, extension, max_bytes):
+        # ASGI 伺服器每次交付的本文片段不大 (uvicorn 約 64KB)，直接寫入本機磁碟不會明顯阻塞事件迴圈
+        digest = hashlib.sha256()
+        head = b''
+        size = 0
+        with open(partial_path, 'wb') as f:
+            more_body = True
+            while more_body:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    raise _ClientDisconnected()
+                chunk = message.get('body', b'')
+                more_body = message.get('more_body', False)
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadRejected(413, f"File too large (max {max_bytes} bytes).")
+                if head is not None:
+                    head += chunk
+                    if head and (len(head) >= SNIFF_BYTES or not more_body):
+                        if not content_matches_extension(extension, head):
+                            raise UploadRejected(415, f"File content does not match its extension: {extension}.")
+                        head = None
+                digest.update(chunk)
+                f.write(chunk)
+        if size == 0:
+            raise UploadRejected(400, "The submitted file is empty.")
+        return digest.hexdigest()
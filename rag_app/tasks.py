@@ -1,145 +1,737 @@
+import itertools
 import os
+import time
+from collections import namedtuple
 from celery import shared_task
 from django.conf import settings
-from .models import Document, QuestionAnswer
-from langchain_community.document_loaders import PyPDFLoader, TextLoader, Docx2txtLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_community.embeddings import HuggingFaceEmbeddings
-from langchain_community.vectorstores import Chroma
-from langchain_community.llms import Ollama
-from langchain.chains import RetrievalQA
-from langchain.prompts import PromptTemplate
+from .models import Document, IngestBatch, QuestionAnswer
+from pypdf import PdfReader
+from celery.signals import worker_process_init, worker_ready
 from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from .embedding import get_embedding_engine
+from .embedding_cache import chunk_hash
+from .registry import get_redis, get_registry, worker_warm_up_components
+from . import answer_cache
+from .streaming import AnswerStreamPublisher
+from .vector_layout import configured_layout, delete_document_vectors, index_target
+from .index_ops import delete_stale_chunks, iter_stored_chunks, refresh_quantized_index
+from .retrieval import fetch_chunk_embeddings, retrieve
+from .context_builder import build_context, estimate_tokens, format_blocks
+from .answer_batching import get_answer_batcher
+from .reranker import get_reranker
+from . import lexical_index, quantized_index
+from .maintenance import MaintenanceRunning, exclusive_run, run_maintenance, store_report
+from .pdf_parsing import iter_pdf_pages
+from .instrumentation import StageTimings
 
-# Chroma DB 的持久化路徑
-CHROMA_DB_PATH = os.path.join(settings.BASE_DIR, "chroma_db")
 
-# 初始化嵌入模型
-embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2", model_kwargs={'device': 'cpu'})
+def _chunk_id(document_id, content_hash):
+    # 區塊 ID 由內容決定 (文件ID:內容雜湊)，重新處理時內容沒變的區塊會得到相同的 ID，可以直接沿用既有的嵌入
+    return f"{document_id}:{content_hash[:32]}"
 
 
-@shared_task(bind=True)
+def _upsert_chunk_batch(vector_db, chunk_ids, chunks, vectors):
+    """
+    將一批已計算好嵌入的區塊寫入 Chroma (重跑時以相同的 ID 覆寫而非重複新增)。
+    """
+    vector_db._collection.upsert(
+        ids=chunk_ids,
+        embeddings=vectors.tolist(),
+        documents=[chunk.page_content for chunk in chunks],
+        metadatas=[chunk.metadata for chunk in chunks],
+    )
+
+
+@worker_process_init.connect
+def warm_up_worker_process(**kwargs):
+    """
+    Worker 子進程啟動時預熱常駐資源；預熱哪些資源依 Worker 設定檔 (RAG_CELERY_QUEUE_PROFILES 的 warm_up) 決定，
+    例如維護佇列的 Worker 不載入嵌入模型。RAG_WORKER_WARM_UP = False 時全部延後到第一次使用。
+    """
+    if not settings.RAG_WORKER_WARM_UP:
+        return
+    try:
+        registry = get_registry()
+        registry.warm_up(worker_warm_up_components())
+        registry.publish_stats()
+    except Exception as e:
+        print(f"警告: Worker 進程預熱失敗，將在第一次使用時再初始化: {e}")
+
+
+@worker_ready.connect
+def warm_up_in_process_pool(sender=None, **kwargs):
+    # threads / solo pool 在 Worker 主進程內執行任務，不會觸發 worker_process_init，改在 Worker 就緒時預熱
+    from celery.concurrency.prefork import TaskPool as PreforkPool
+
+    if not isinstance(getattr(sender, 'pool', None), PreforkPool):
+        warm_up_worker_process()
+
+
+@shared_task
+def publish_worker_stats_task():
+    """
+    Celery 任務：回報處理此任務的 Worker 進程統計 (並寫入 Redis 供健康檢查端點讀取)。
+    """
+    registry = get_registry()
+    registry.publish_stats()
+    return registry.stats()
+
+
+def _text_splitter():
+    # LangChain 的文件處理模組在實際處理文件時才載入，Web 進程與管理命令匯入 tasks 時不必負擔
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+    return RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
+
+
+def _open_pages(file_path):
+    """
+    依副檔名回傳 (總頁數, 逐頁產出 [start_page, end_page) 範圍內 LangChain Document 的函式)；PDF 以外的格式視為單頁。
+    """
+    file_ext = os.path.splitext(file_path)[1].lower()
+    if file_ext == '.pdf':
+        # PDF 以進程池並行解析頁面 (見 pdf_parsing)，續傳時直接從指定頁開始，不必重新解析前面的頁面
+        return len(PdfReader(file_path).pages), lambda start_page, end_page=None: iter_pdf_pages(file_path, start_page, end_page)
+    if file_ext == '.txt':
+        from langchain_community.document_loaders import TextLoader
+        loader = TextLoader(file_path, encoding='utf-8')
+    elif file_ext == '.docx':
+        from langchain_community.document_loaders import Docx2txtLoader
+        loader = Docx2txtLoader(file_path)
+    else:
+        raise ValueError(f"不支援的文件類型: {file_ext}")
+    return 1, lambda start_page, end_page=None: itertools.islice(loader.lazy_load(), start_page, end_page)
+
+
+def _seed_resumed_chunks(vector_db, where, index_version, seen_ids, lexical_writer):
+    """
+    斷點續傳時，找出這次處理中已寫入的區塊 (metadata 的 index_version 為本次版本)，並補進關鍵字倒排索引。
+    """
+    for batch in iter_stored_chunks(vector_db, where, ['documents', 'metadatas']):
+        for chunk_id, text, metadata in zip(batch['ids'], batch['documents'], batch['metadatas']):
+            if (metadata or {}).get('index_version') == index_version and chunk_id not in seen_ids:
+                seen_ids.add(chunk_id)
+                if lexical_writer is not None:
+                    lexical_writer.add([chunk_id], [text])
+
+
+def _open_index(registry, document, resuming):
+    """
+    依設定的配置決定文件區塊的存放位置，回傳 (配置, IndexTarget, 向量庫)；若文件先前以另一種配置建立過索引，先清除舊的向量。
+    """
+    layout = document.index_layout if resuming else configured_layout()
+    if not resuming and document.index_version > 0 and document.index_layout != layout:
+        delete_document_vectors(registry, document.id, document.index_layout)
+    target = index_target(document.id, layout)
+    return layout, target, registry.get_vector_store(target.collection_name)
+
+
+def _record_batch_progress(batch_id, embedded_count=0, reused_count=0):
+    """
+    累加批次的區塊統計；批次內已沒有等待或處理中的文件時記錄完成時間。
+    """
+    if batch_id is None:
+        return
+    IngestBatch.objects.filter(id=batch_id).update(
+        embedded_chunks=F('embedded_chunks') + embedded_count,
+        reused_chunks=F('reused_chunks') + reused_count,
+    )
+    if not Document.objects.filter(ingest_batch_id=batch_id, status__in=('UPLOADED', 'PROCESSING')).exists():
+        IngestBatch.objects.filter(id=batch_id, finished_at__isnull=True).update(finished_at=timezone.now())
+
+
+def _mark_completed(document_id, layout, embedded_count, reused_count, removed_count, timings):
+    stage_timings = timings.finish({'rag.document_id': str(document_id)})
+    with transaction.atomic():
+        document = Document.objects.get(id=document_id)
+        document.stage_timings = stage_timings
+        document.status = 'COMPLETED'
+        document.processing_message = f'文件處理完成 (新嵌入 {embedded_count}、沿用 {reused_count}、移除 {removed_count} 個區塊)。'
+        document.index_version = F('index_version') + 1
+        document.index_layout = layout
+        document.save()
+    _record_batch_progress(document.ingest_batch_id, embedded_count, reused_count)
+    return document
+
+
+def _mark_failed(document_id, error):
+    with transaction.atomic():
+        document = Document.objects.get(id=document_id)
+        document.status = 'FAILED'
+        document.processing_message = f'處理失敗: {str(error)}'
+        document.save()
+    _record_batch_progress(document.ingest_batch_id)
+
+
+@shared_task(bind=True, acks_late=True, reject_on_worker_lost=True)
 def parse_and_vectorize_document_task(self, document_id):
     """
-    Celery 任務：解析文件，分塊，生成嵌入，並存儲到 ChromaDB。
+    Celery 任務：逐頁解析文件，分塊，生成嵌入，並存儲到 ChromaDB。
+    每累積一批區塊就嵌入並寫入，再把進度記錄到 Document；Worker 中斷後任務重新投遞時，從最後一個已寫入的頁面繼續。
+    每次執行最多處理 RAG_INGEST_PAGES_PER_TASK 頁，其餘頁面排入新的任務接續，大型文件不會長時間佔住同一個 Worker。
+    重新處理 (例如替換檔案) 時只嵌入內容有變動的區塊，已存在的區塊只更新 metadata，最後刪除不再出現的區塊。
     """
     try:
         with transaction.atomic():
-            document = Document.objects.get(id=document_id)
+            document = Document.objects.select_for_update().get(id=document_id)
+            # 只有上一次執行中斷 (仍為 PROCESSING 且已有進度) 時才續傳，其餘情況從頭開始
+            resuming = document.status == 'PROCESSING' and document.processed_pages > 0
+            if not resuming:
+                document.processed_pages = 0
+                document.processed_chunks = 0
+                document.stage_timings = None
             document.status = 'PROCESSING'
             document.processing_message = '文件解析與向量化中...'
             document.save()
+        answer_cache.invalidate(document_id) # 重新向量化後舊答案不再有效
+        # 各階段 (load / split / embed / persist) 的累計秒數；續傳或接續的任務從已記錄的秒數繼續累加
+        timings = StageTimings('ingest', initial=document.stage_timings if resuming else None)
+        run_started = time.perf_counter()
 
-        file_path = document.file.path
-        file_ext = os.path.splitext(file_path)[1].lower()
-        documents_to_process = []
+        with timings.stage('load'):
+            total_pages, iter_pages = _open_pages(document.file.path)
+        Document.objects.filter(id=document_id).update(total_pages=total_pages, updated_at=timezone.now())
 
-        if file_ext == '.pdf':
-            loader = PyPDFLoader(file_path)
-        elif file_ext == '.txt':
-            loader = TextLoader(file_path, encoding='utf-8')
-        elif file_ext == '.docx':
-            loader = Docx2txtLoader(file_path)
-        else:
-            raise ValueError(f"不支援的文件類型: {file_ext}")
+        layout, target, vector_db = _open_index(get_registry(), document, resuming)
+        # 本次處理寫入或沿用的區塊都標記為新版本，完成時其餘的區塊即為過時的區塊
+        target_version = document.index_version + 1
 
-        loaded_docs = loader.load()
+        # 關鍵字倒排索引隨每批區塊一起累積，完成後寫入磁碟
+        lexical_writer = lexical_index.LexicalIndexWriter(document_id) if settings.RAG_HYBRID_SEARCH_ENABLED else None
+        pages_done = document.processed_pages
+        chunks_done = document.processed_chunks
+        seen_ids = set()
+        embedded_count = reused_count = 0
+        if resuming:
+            print(f"文件 {document.filename} (ID: {document_id}) 從第 {pages_done + 1} 頁繼續處理。")
+            _seed_resumed_chunks(vector_db, target.where, target_version, seen_ids, lexical_writer)
 
-        for doc in loaded_docs:
-            doc.metadata['source_file_id'] = str(document.id)
-            doc.metadata['source_filename'] = document.filename
-        documents_to_process.extend(loaded_docs)
+        text_splitter = _text_splitter()
+        pending_chunks = []
+        pending_pages = 0
 
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-        chunks = text_splitter.split_documents(documents_to_process)
+        def flush():
+            # 嵌入並寫入目前累積的區塊，成功後才推進進度；內容相同的區塊只保留一份
+            nonlocal pending_chunks, pending_pages, pages_done, chunks_done, embedded_count, reused_count
+            batch = {}
+            for chunk in pending_chunks:
+                chunk.metadata['chunk_hash'] = chunk_hash(chunk.page_content)
+                chunk.metadata['index_version'] = target_version
+                chunk_id = _chunk_id(document_id, chunk.metadata['chunk_hash'])
+                if chunk_id not in seen_ids:
+                    batch.setdefault(chunk_id, chunk)
+            chunk_ids = list(batch)
+            seen_ids.update(chunk_ids)
 
-        if not chunks:
-            raise ValueError("文件解析後沒有生成任何內容區塊。")
+            # 已存在的區塊 (內容未變) 沿用原本的嵌入，只更新頁碼等 metadata
+            with timings.stage('persist'):
+                existing = set(vector_db._collection.get(ids=chunk_ids, include=[])['ids']) if chunk_ids else set()
+                reused_ids = [chunk_id for chunk_id in chunk_ids if chunk_id in existing]
+                if reused_ids:
+                    vector_db._collection.update(ids=reused_ids, metadatas=[batch[chunk_id].metadata for chunk_id in reused_ids])
+            new_ids = [chunk_id for chunk_id in chunk_ids if chunk_id not in existing]
+            new_chunks = [batch[chunk_id] for chunk_id in new_ids]
+            if new_chunks:
+                embedded_batches = get_embedding_engine().iter_embedding_batches([chunk.page_content for chunk in new_chunks])
+                for offset, vectors in timings.iterate('embed', embedded_batches):
+                    with timings.stage('persist'):
+                        _upsert_chunk_batch(vector_db, new_ids[offset:offset + len(vectors)],
+                                            new_chunks[offset:offset + len(vectors)], vectors)
+            if lexical_writer is not None:
+                with timings.stage('persist'):
+                    lexical_writer.add(chunk_ids, [batch[chunk_id].page_content for chunk_id in chunk_ids])
 
-        # 持久化到 ChromaDB
-        vector_db = Chroma.from_documents(
-            documents=chunks,
-            embedding=embeddings,
-            persist_directory=CHROMA_DB_PATH,
-            collection_name=str(document_id) # 使用文件ID作為Collection名稱
-        )
-        vector_db.persist() # 顯式調用 persist() 確保資料寫入磁碟
+            embedded_count += len(new_ids)
+            reused_count += len(reused_ids)
+            pages_done += pending_pages
+            chunks_done += len(chunk_ids)
+            pending_chunks, pending_pages = [], 0
+            Document.objects.filter(id=document_id).update(
+                index_layout=layout,
+                processed_pages=pages_done,
+                processed_chunks=chunks_done,
+                processing_message=f'文件解析與向量化中... ({pages_done}/{total_pages} 頁)',
+                updated_at=timezone.now(),
+            )
 
-        with transaction.atomic():
-            document.status = 'COMPLETED'
-            document.processing_message = '文件處理完成。'
-            document.save()
+        # 本次任務負責的頁面範圍，超過的部分交給接續的任務
+        pages_per_task = settings.RAG_INGEST_PAGES_PER_TASK
+        slice_end = pages_done + pages_per_task if pages_per_task else None
+        for page in timings.iterate('load', iter_pages(pages_done, slice_end)):
+            page.metadata['source_file_id'] = str(document.id)
+            page.metadata['source_filename'] = document.filename
+            with timings.stage('split'):
+                pending_chunks.extend(text_splitter.split_documents([page]))
+            pending_pages += 1
+            if len(pending_chunks) >= settings.RAG_INGEST_FLUSH_CHUNKS:
+                flush()
+        if pending_pages:
+            flush()
+
+        if slice_end is not None and pages_done < total_pages:
+            # 仍為 PROCESSING 且已有進度，接續的任務會走斷點續傳的路徑
+            _record_batch_progress(document.ingest_batch_id, embedded_count, reused_count)
+            timings.add('total', time.perf_counter() - run_started)
+            Document.objects.filter(id=document_id).update(
+                stage_timings=timings.finish({'rag.document_id': str(document_id)}, observe=False),
+                updated_at=timezone.now(),
+            )
+            self.apply_async(args=(document_id,))
+            print(f"文件 {document.filename} (ID: {document_id}) 已處理 {pages_done}/{total_pages} 頁，其餘頁面交給接續的任務。")
+            return
+
+        if chunks_done == 0:
+            raise ValueError("文件解析後沒有生成任何內容區塊。")
+        with timings.stage('persist'):
+            removed_count = delete_stale_chunks(vector_db, target.where, target_version)
+            if lexical_writer is not None:
+                lexical_writer.commit()
+            refresh_quantized_index(document_id, vector_db, target.where)
+
+        timings.add('total', time.perf_counter() - run_started)
+        document = _mark_completed(document_id, layout, embedded_count, reused_count, removed_count, timings)
 
-        print(f"文件 {document.filename} (ID: {document_id}) 處理完成並存入 ChromaDB。")
+        print(f"文件 {document.filename} (ID: {document_id}) 處理完成並存入 ChromaDB，共 {pages_done} 頁、{chunks_done} 個區塊。")
+        if get_embedding_engine().cache is not None:
+            print(f"嵌入快取統計: {get_embedding_engine().cache.stats()}")
 
     except Document.DoesNotExist:
         print(f"錯誤: 文件 (ID: {document_id}) 不存在。")
     except Exception as e:
         print(f"處理文件 {document_id} 時發生錯誤: {e}")
-        with transaction.atomic():
-            document = Document.objects.get(id=document_id)
-            document.status = 'FAILED'
-            document.processing_message = f'處理失敗: {str(e)}'
-            document.save()
+        _mark_failed(document_id, e)
+
+
+class _BatchDocument:
+    """
+    批次匯入中單一文件的處理狀態。
+    """
+
+    def __init__(self, document, timings, layout, target, vector_db):
+        self.document = document
+        self.timings = timings # 嵌入與寫入由多個文件共用，依各文件在批次中的區塊數分攤秒數
+        self.run_started = time.perf_counter()
+        self.layout = layout
+        self.target = target
+        self.vector_db = vector_db
+        self.target_version = document.index_version + 1
+        self.lexical_writer = lexical_index.LexicalIndexWriter(document.id) if settings.RAG_HYBRID_SEARCH_ENABLED else None
+        self.seen_ids = set()
+        self.total_pages = 0
+        self.pages_done = 0
+        self.chunks_done = 0
+        self.outstanding = 0 # 已排入佇列但尚未寫入的區塊數
+        self.parsed = False
+        self.embedded_count = 0
+        self.reused_count = 0
+
+
+# 排入佇列等待寫入的區塊：page_index 用來在寫入後推進文件的頁數進度
+_QueuedChunk = namedtuple('_QueuedChunk', ['state', 'chunk_id', 'chunk', 'page_index'])
+
+
+class BatchIngestScheduler:
+    """
+    批次匯入排程：依序解析多個文件，把它們的區塊合併到同一個佇列，湊滿 RAG_EMBEDDING_BATCH_SIZE 才送進嵌入模型，
+    避免每個小文件各自產生一個不滿的批次。文件的所有區塊都寫入後就個別標記為完成，進度同樣記錄在各自的 Document。
+    """
+
+    def __init__(self, batch_id):
+        self.batch_id = batch_id
+        self.text_splitter = _text_splitter()
+        self.states = {}
+        self.pending = [] # 尚未確認是否已存在於向量庫的區塊
+        self.to_embed = [] # 需要計算嵌入的新區塊 (不足一批時留待下一個文件補滿)
+        self.embedding_batches = 0
+
+    def add_document(self, document_id):
+        try:
+            with transaction.atomic():
+                document = Document.objects.select_for_update().get(id=document_id)
+                if document.status == 'COMPLETED':
+                    return
+                # 批次內的文件一律從頭處理；內容相同的區塊 ID 不變，重跑時直接沿用已寫入的嵌入
+                document.status = 'PROCESSING'
+                document.processing_message = '文件解析與向量化中 (批次匯入)...'
+                document.processed_pages = 0
+                document.processed_chunks = 0
+                document.stage_timings = None
+                document.save()
+            answer_cache.invalidate(document_id)
+            timings = StageTimings('ingest')
+            with timings.stage('load'):
+                total_pages, iter_pages = _open_pages(document.file.path)
+            Document.objects.filter(id=document_id).update(total_pages=total_pages, updated_at=timezone.now())
+            state = _BatchDocument(document, timings, *_open_index(get_registry(), document, False))
+            state.total_pages = total_pages
+            pages = enumerate(timings.iterate('load', iter_pages(0)))
+        except Document.DoesNotExist:
+            print(f"錯誤: 文件 (ID: {document_id}) 不存在。")
+            return
+        except Exception as e:
+            self._fail(document_id, e)
+            return
+        self.states[document.id] = state
+
+        while True:
+            try:
+                page_index, page = next(pages, (None, None))
+                if page is None:
+                    break
+                self._queue_page(state, page_index, page)
+            except Exception as e:
+                self._fail(document.id, e)
+                return
+            if len(self.pending) >= settings.RAG_INGEST_FLUSH_CHUNKS:
+                self._flush()
+        state.parsed = True
+        self._finalize_ready()
+
+    def finish(self):
+        self._flush(final=True)
+        IngestBatch.objects.filter(id=self.batch_id).update(
+            embedding_batches=F('embedding_batches') + self.embedding_batches,
+        )
+
+    def _queue_page(self, state, page_index, page):
+        page.metadata['source_file_id'] = str(state.document.id)
+        page.metadata['source_filename'] = state.document.filename
+        with state.timings.stage('split'):
+            chunks = self.text_splitter.split_documents([page])
+        for chunk in chunks:
+            chunk.metadata['chunk_hash'] = chunk_hash(chunk.page_content)
+            chunk.metadata['index_version'] = state.target_version
+            chunk_id = _chunk_id(state.document.id, chunk.metadata['chunk_hash'])
+            if chunk_id in state.seen_ids:
+                continue
+            state.seen_ids.add(chunk_id)
+            state.outstanding += 1
+            self.pending.append(_QueuedChunk(state, chunk_id, chunk, page_index))
+
+    def _flush(self, final=False):
+        touched = set()
+        pending, self.pending = self.pending, []
+        by_state = {}
+        for item in pending:
+            by_state.setdefault(item.state, []).append(item)
+        for state, items in by_state.items():
+            # 已存在的區塊 (例如任務重新投遞) 沿用原本的嵌入，只更新 metadata
+            with state.timings.stage('persist'):
+                existing = set(state.vector_db._collection.get(ids=[item.chunk_id for item in items], include=[])['ids'])
+                reused = [item for item in items if item.chunk_id in existing]
+                if reused:
+                    state.vector_db._collection.update(ids=[item.chunk_id for item in reused],
+                                                       metadatas=[item.chunk.metadata for item in reused])
+            if reused:
+                self._commit(state, reused, reused=True)
+                touched.add(state)
+            self.to_embed.extend(item for item in items if item.chunk_id not in existing)
+
+        batch_size = get_embedding_engine().batch_size
+        count = len(self.to_embed) if final else len(self.to_embed) // batch_size * batch_size
+        items, self.to_embed = self.to_embed[:count], self.to_embed[count:]
+        if items:
+            embedded_batches = iter(get_embedding_engine().iter_embedding_batches([item.chunk.page_content for item in items]))
+            while True:
+                start_ns = time.time_ns()
+                result = next(embedded_batches, None)
+                if result is None:
+                    break
+                offset, vectors = result
+                self._share_stage(items[offset:offset + len(vectors)], 'embed', start_ns)
+                self.embedding_batches += 1
+                # 同一批向量可能屬於多個文件，依目標 Collection 分組寫入 (共用 Collection 配置下合併成一次寫入)
+                by_collection = {}
+                for index, item in enumerate(items[offset:offset + len(vectors)]):
+                    by_collection.setdefault(item.state.target.collection_name, []).append(index)
+                for indices in by_collection.values():
+                    group = [items[offset + index] for index in indices]
+                    start_ns = time.time_ns()
+                    _upsert_chunk_batch(group[0].state.vector_db, [item.chunk_id for item in group],
+                                        [item.chunk for item in group], vectors[indices])
+                    self._share_stage(group, 'persist', start_ns)
+                    for item in group:
+                        self._commit(item.state, [item], reused=False)
+                        touched.add(item.state)
+
+        for state in touched:
+            Document.objects.filter(id=state.document.id).update(
+                processed_pages=state.pages_done,
+                processed_chunks=state.chunks_done,
+                processing_message=f'文件解析與向量化中 (批次匯入)... ({state.pages_done}/{state.total_pages} 頁)',
+                updated_at=timezone.now(),
+            )
+        self._finalize_ready()
+
+    @staticmethod
+    def _share_stage(items, stage, start_ns):
+        # 多個文件共用的一段時間，依各文件的區塊數分攤
+        end_ns = time.time_ns()
+        counts = {}
+        for item in items:
+            counts[item.state] = counts.get(item.state, 0) + 1
+        for state, count in counts.items():
+            state.timings.add(stage, (end_ns - start_ns) / 1e9 * count / len(items), start_ns, end_ns)
+
+    def _commit(self, state, items, reused):
+        state.outstanding -= len(items)
+        state.chunks_done += len(items)
+        if reused:
+            state.reused_count += len(items)
+        else:
+            state.embedded_count += len(items)
+        # 區塊依頁面順序排入佇列，已寫入區塊所在頁之前的頁面都已完整寫入
+        state.pages_done = max(state.pages_done, max(item.page_index for item in items))
+        if state.lexical_writer is not None:
+            state.lexical_writer.add([item.chunk_id for item in items], [item.chunk.page_content for item in items])
+
+    def _finalize_ready(self):
+        for state in [state for state in self.states.values() if state.parsed and state.outstanding == 0]:
+            document_id = state.document.id
+            del self.states[document_id]
+            try:
+                if state.chunks_done == 0:
+                    raise ValueError("文件解析後沒有生成任何內容區塊。")
+                with state.timings.stage('persist'):
+                    removed_count = delete_stale_chunks(state.vector_db, state.target.where, state.target_version)
+                    if state.lexical_writer is not None:
+                        state.lexical_writer.commit()
+                    refresh_quantized_index(document_id, state.vector_db, state.target.where)
+                Document.objects.filter(id=document_id).update(processed_pages=state.total_pages,
+                                                               processed_chunks=state.chunks_done,
+                                                               updated_at=timezone.now())
+                state.timings.add('total', time.perf_counter() - state.run_started)
+                _mark_completed(document_id, state.layout, state.embedded_count, state.reused_count, removed_count,
+                                state.timings)
+            except Exception as e:
+                self._fail(document_id, e)
+
+    def _fail(self, document_id, error):
+        print(f"處理文件 {document_id} 時發生錯誤: {error}")
+        state = self.states.pop(document_id, None)
+        if state is not None:
+            self.pending = [item for item in self.pending if item.state is not state]
+            self.to_embed = [item for item in self.to_embed if item.state is not state]
+        _mark_failed(document_id, error)
+
+
+@shared_task(bind=True, acks_late=True, reject_on_worker_lost=True)
+def ingest_batch_task(self, batch_id, document_ids):
+    """
+    Celery 任務：批次匯入多個 (小) 文件，合併各文件的區塊後以完整的批次計算嵌入。
+    每個文件的狀態與進度仍記錄在各自的 Document；批次的區塊數與嵌入批次數累加到 IngestBatch。
+    """
+    IngestBatch.objects.filter(id=batch_id, started_at__isnull=True).update(started_at=timezone.now())
+    scheduler = BatchIngestScheduler(batch_id)
+    try:
+        for document_id in document_ids:
+            scheduler.add_document(document_id)
+        scheduler.finish()
+    except Exception as e:
+        print(f"批次匯入 {batch_id} 時發生錯誤: {e}")
+        # 尚未完成的文件 (包括還沒輪到的) 都標記為失敗，讓批次可以結束
+        unfinished = Document.objects.filter(id__in=document_ids, status__in=('UPLOADED', 'PROCESSING'))
+        for document_id in unfinished.values_list('id', flat=True):
+            _mark_failed(document_id, e)
+    print(f"批次匯入 {batch_id} 的 {len(document_ids)} 個文件處理完畢，共 {scheduler.embedding_batches} 個嵌入批次。")
+
+
+def _scope_documents(qa_instance):
+    """
+    依提問範圍取得要檢索的文件 (只包含已處理完成的文件)。
+    """
+    if qa_instance.scope == 'CORPUS':
+        return list(Document.objects.filter(status='COMPLETED'))
+    if qa_instance.scope == 'DOCUMENTS':
+        return list(qa_instance.documents.filter(status='COMPLETED'))
+    if qa_instance.document is None:
+        raise Document.DoesNotExist()
+    return [qa_instance.document]
+
+
+def _coalesce_key(qa_instance, documents, question):
+    # 範圍、文件 (含版本) 與正規化問題都相同的問題才共用同一次生成
+    return (
+        qa_instance.scope,
+        tuple(sorted((str(document.id), document.index_version) for document in documents)),
+        answer_cache.normalize_question(question),
+    )
+
+
+def _produce_answer(qa_instance, documents, document, question, batcher, deadline=None):
+    """
+    依序產出回答事件：('cache_hit', True)、('rerank', 重新排序統計)、('context', Prompt token 統計)、('sources', 參考來源)、
+    ('token', 文字片段)。啟用微批次時，問題嵌入與檢索在 batcher 中與同時到達的其他問題一起計算。
+    deadline 為 time.monotonic() 的期限，生成超過期限時拋出 TimeoutError (問答標記為失敗)。
+    """
+    registry = get_registry()
+    # 啟用 Context 組合時多取一些候選區塊，再依 token 預算挑選；否則沿用固定的前 k 個區塊
+    top_k = settings.RAG_CONTEXT_CANDIDATES if settings.RAG_CONTEXT_BUILDER_ENABLED else settings.RAG_RETRIEVAL_TOP_K
+    # 啟用重新排序時先多取候選，由 cross-encoder 重新評分後再取前 top_k 個
+    reranker = get_reranker()
+    k = max(top_k, settings.RAG_RERANK_CANDIDATES) if reranker is not None else top_k
+    if batcher is not None:
+        question_vector, retrieved = batcher.search(documents, question, k=k)
+    else:
+        # 問題嵌入只計算一次，同時用於答案快取的語意比對與向量檢索
+        question_vector, retrieved = get_embedding_engine().embed_query(question), None
+    if document is not None:
+        index_version = document.index_version
+        cached = answer_cache.lookup(document, question, question_vector=question_vector)
+        if cached is not None:
+            yield 'cache_hit', True
+            yield 'sources', cached.source_documents
+            yield 'token', cached.answer
+            return
+
+    if retrieved is None:
+        # 對範圍內所有文件並行檢索 (向量 + 關鍵字)，合併後取前 k 個
+        retrieved = retrieve(registry, documents, question_vector, k=k, question=question)
+
+    rerank_scores = {}
+    if reranker is not None and retrieved:
+        reranked = reranker.rerank(question, retrieved, settings.RAG_RERANK_BUDGET_MS / 1000)
+        retrieved, rerank_scores = reranked.ranked[:top_k], reranked.scores
+        yield 'rerank', {
+            'seconds': reranked.seconds,
+            'candidates': len(reranked.ranked),
+            'scored': reranked.scored,
+            'cache_hits': reranked.cache_hits,
+            'timed_out': reranked.timed_out,
+        }
+
+    # 多文件時標註每段內容的來源文件，讓答案可以引用
+    label_sources = qa_instance.scope != 'DOCUMENT'
+    if settings.RAG_CONTEXT_BUILDER_ENABLED:
+        # 去除重疊的文字、合併同頁相鄰的區塊，並以 MMR 挑選多樣的區塊填滿 token 預算
+        built = build_context(
+            retrieved, fetch_chunk_embeddings(registry, documents, [doc for doc, _ in retrieved]), label_sources,
+        )
+        retrieved, context = built.selected, format_blocks(built.blocks, label_sources)
+        context_tokens, baseline_tokens = built.tokens, built.baseline_tokens
+    else:
+        context = format_blocks([(doc.metadata, doc.page_content) for doc, _ in retrieved], label_sources)
+        context_tokens = baseline_tokens = estimate_tokens(context)
+    yield 'context', {'tokens': context_tokens, 'saved': baseline_tokens - context_tokens}
+
+    source_documents = []
+    for doc, distance in retrieved:
+        source_info = {
+            "content": doc.page_content[:200] + "...",
+            "metadata": doc.metadata,
+            "score": round(distance, 4)
+        }
+        if doc.id in rerank_scores:
+            source_info["rerank_score"] = round(rerank_scores[doc.id], 4)
+        source_documents.append(source_info)
+    yield 'sources', source_documents
+
+    prompt = registry.qa_prompt.format(context=context, question=question)
+    answer_parts = []
+    for token in registry.get_llm().stream(prompt, deadline=deadline):
+        if deadline is not None and time.monotonic() > deadline:
+            raise TimeoutError(f"生成答案超過 {settings.RAG_ANSWER_TIME_LIMIT} 秒的時間限制。")
+        answer_parts.append(token)
+        yield 'token', token
+    if document is not None:
+        answer_cache.store(document, index_version, question, question_vector, "".join(answer_parts), source_documents)
 
 
 @shared_task(bind=True)
 def answer_question_with_rag_task(self, qa_id, document_id, question):
     """
     Celery 任務：使用 RAG 從 ChromaDB 檢索資訊並生成答案。
+    生成過程會即時寫入答案串流 (先送參考來源，再逐一送出 token)，完成後將完整答案保存到 QuestionAnswer。
+    啟用微批次 (RAG_ANSWER_BATCHING_ENABLED) 時，同一 Worker 進程內正在生成的相同問題共用同一次生成。
     """
+    stream = AnswerStreamPublisher(qa_id, client=get_redis())
+    # threads pool 不會執行 Celery 的 soft_time_limit / time_limit，由任務自己檢查期限
+    deadline = time.monotonic() + settings.RAG_ANSWER_TIME_LIMIT
     try:
         with transaction.atomic():
-            qa_instance = QuestionAnswer.objects.get(id=qa_id)
+            qa_instance = QuestionAnswer.objects.select_related('document').get(id=qa_id)
             qa_instance.status = 'ANSWERING'
             qa_instance.save()
+        # 各階段 (queue_wait / retrieve / first_token / generate / save) 的秒數，依事件到達的時間點計算，
+        # 共用同一次生成的請求也能得到自己的等待時間
+        timings = StageTimings('answer')
+        created_ns, started_ns = int(qa_instance.created_at.timestamp() * 1e9), time.time_ns()
+        timings.add('queue_wait', (started_ns - created_ns) / 1e9, created_ns, started_ns)
+        documents = _scope_documents(qa_instance)
+        if not documents:
+            raise ValueError("提問範圍內沒有已處理完成的文件。")
+        # 答案快取以單一文件為範圍，多文件/全庫提問不使用
+        document = qa_instance.document if qa_instance.scope == 'DOCUMENT' else None
 
-        vector_store = Chroma(
-            persist_directory=CHROMA_DB_PATH,
-            embedding_function=embeddings,
-            collection_name=str(document_id)
-        )
+        batcher = get_answer_batcher()
+        produce = lambda: _produce_answer(qa_instance, documents, document, question, batcher, deadline)
+        events = batcher.answer(_coalesce_key(qa_instance, documents, question), produce) if batcher else produce()
 
-        llm = Ollama(model="llama3.2") # 確保您在 Ollama 中實際運行的 Llama 3.2 模型名稱
-
-        prompt_template = """
-        Use the following pieces of context to answer the user's question.
-        If you don't know the answer, just say that you don't know, don't try to make up an answer.
-        ----------------
-        Context: {context}
-        ----------------
-        Question: {question}
-        ----------------
-        Helpful Answer:"""
-
-        QA_CHAIN_PROMPT = PromptTemplate.from_template(prompt_template)
-
-        qa_chain = RetrievalQA.from_chain_type(
-            llm=llm,
-            chain_type="stuff",
-            retriever=vector_store.as_retriever(search_kwargs={"k": 5}),
-            return_source_documents=True,
-            chain_type_kwargs={"prompt": QA_CHAIN_PROMPT}
-        )
+        cache_hit = False
+        context_stats = {}
+        rerank_stats = {}
+        source_documents = None
+        answer_parts = []
+        retrieve_ns = sources_ns = time.time_ns()
+        for kind, value in events:
+            if kind == 'cache_hit':
+                cache_hit = True
+            elif kind == 'rerank':
+                # 重新排序是檢索階段中的一段，另外記錄以便觀察時間預算的使用情況
+                rerank_stats, rerank_end_ns = value, time.time_ns()
+                rerank_start_ns = rerank_end_ns - int(value['seconds'] * 1e9)
+                timings.add('rerank', value['seconds'], rerank_start_ns, rerank_end_ns)
+            elif kind == 'context':
+                context_stats = value
+            elif kind == 'sources':
+                sources_ns = time.time_ns()
+                timings.add('retrieve', (sources_ns - retrieve_ns) / 1e9, retrieve_ns, sources_ns)
+                source_documents = value
+                stream.sources(value)
+            else:
+                if not answer_parts:
+                    first_token_ns = time.time_ns()
+                    timings.add('first_token', (first_token_ns - sources_ns) / 1e9, sources_ns, first_token_ns)
+                answer_parts.append(value)
+                stream.token(value)
+        generated_ns = time.time_ns()
+        timings.add('generate', (generated_ns - sources_ns) / 1e9, sources_ns, generated_ns)
+        answer = "".join(answer_parts)
 
-        result = qa_chain.invoke({"query": question})
-
-        answer = result["result"]
-        source_documents = []
-        for doc in result.get("source_documents", []):
-            source_info = {
-                "content": doc.page_content[:200] + "...",
-                "metadata": doc.metadata
-            }
-            source_documents.append(source_info)
-
-        with transaction.atomic():
-            qa_instance.answer = answer
-            qa_instance.source_documents = source_documents
-            qa_instance.status = 'COMPLETED'
-            qa_instance.save()
+        with timings.stage('save'):
+            with transaction.atomic():
+                qa_instance.answer = answer
+                qa_instance.source_documents = source_documents
+                qa_instance.cache_hit = cache_hit
+                qa_instance.context_tokens = context_stats.get('tokens')
+                qa_instance.context_tokens_saved = context_stats.get('saved')
+                qa_instance.status = 'COMPLETED'
+                qa_instance.save()
+        stream.done(answer, cache_hit=cache_hit)
 
-        print(f"問題 '{question}' (QA ID: {qa_id}) 已回答。")
+        total_seconds = (time.time_ns() - created_ns) / 1e9
+        timings.add('total', total_seconds)
+        attributes = {'rag.qa_id': str(qa_id), 'rag.scope': qa_instance.scope, 'rag.cache_hit': cache_hit}
+        if context_stats:
+            attributes.update({'rag.context_tokens': context_stats['tokens'], 'rag.context_tokens_saved': context_stats['saved']})
+        if rerank_stats:
+            attributes.update({
+                'rag.rerank_candidates': rerank_stats['candidates'],
+                'rag.rerank_scored': rerank_stats['scored'],
+                'rag.rerank_cache_hits': rerank_stats['cache_hits'],
+                'rag.rerank_timed_out': rerank_stats['timed_out'],
+            })
+        stage_timings = timings.finish(attributes)
+        QuestionAnswer.objects.filter(id=qa_id).update(stage_timings=stage_timings, updated_at=timezone.now())
+        registry = get_registry()
+        registry.record_answer(total_seconds)
+        if cache_hit:
+            print(f"問題 '{question}' (QA ID: {qa_id}) 命中答案快取。")
+        else:
+            print(f"問題 '{question}' (QA ID: {qa_id}) 已回答。")
+        registry.publish_stats()
 
     except QuestionAnswer.DoesNotExist:
         print(f"錯誤: 問答實例 (ID: {qa_id}) 不存在。")
@@ -153,6 +745,7 @@ def answer_question_with_rag_task(self, qa_id, document_id, question):
             qa_instance.error_message = f"錯誤: {str(e)}"
             qa_instance.status = 'FAILED'
             qa_instance.save()
+        stream.error(qa_instance.error_message)
 
 @shared_task
 def delete_document_data_task(document_id, file_path):
@@ -160,24 +753,26 @@ def delete_document_data_task(document_id, file_path):
     Celery 任務：刪除 Document 記錄、其相關的 QA 記錄、物理文件和 ChromaDB 向量索引。
     """
     try:
-        # 1. 刪除 Django Document 記錄 (會級聯刪除相關的 QuestionAnswer 記錄)
+        # 1. 刪除 Django Document 記錄 (會級聯刪除相關的 QuestionAnswer 記錄與答案快取)
+        answer_cache.invalidate(document_id)
         with transaction.atomic():
             document = Document.objects.get(id=document_id)
+            index_layout = document.index_layout # 刪除前記下向量存放配置
             document.delete()
         print(f"Django Document (ID: {document_id}) 及其所有相關 QA 記錄已刪除。")
 
-        # 2. 刪除 ChromaDB 中對應的 Collection
+        # 2. 刪除 ChromaDB 中對應的向量 (每文件的 Collection，或共用 Collection 中屬於此文件的區塊)
         try:
-            chroma_client = Chroma(persist_directory=CHROMA_DB_PATH, embedding_function=embeddings)
-            # 確保 collection_name 與創建時一致
-            chroma_client.delete_collection(name=str(document_id))
-            print(f"ChromaDB Collection '{document_id}' 已刪除。")
+            delete_document_vectors(get_registry(), document_id, index_layout)
+            print(f"ChromaDB 中文件 '{document_id}' 的向量已刪除 ({index_layout})。")
         except Exception as e:
-            print(f"警告: 刪除 ChromaDB Collection '{document_id}' 失敗: {e}")
+            print(f"警告: 刪除 ChromaDB 中文件 '{document_id}' 的向量失敗 (將由 vector_store_maintenance_task 回收): {e}")
             # 如果 collection 不存在或有其他錯誤，不阻止繼續刪除文件
+        lexical_index.delete_index(document_id)
+        quantized_index.delete_index(document_id)
 
         # 3. 刪除物理文件
-        if os.path.exists(file_path):
+        if file_path and os.path.exists(file_path):
             os.remove(file_path)
             print(f"物理文件 '{file_path}' 已刪除。")
         else:
@@ -188,6 +783,25 @@ def delete_document_data_task(document_id, file_path):
     except Exception as e:
         print(f"刪除文件 {document_id} 及相關資料時發生錯誤: {e}")
 
+@shared_task
+def vector_store_maintenance_task():
+    """
+    Celery 任務 (由 beat 定期排程)：回收孤兒 Collection、共用分片中的區塊、segment 目錄、索引與 media 檔案，
+    必要時 VACUUM chroma.sqlite3，並將每個文件的索引大小報告寫入 Redis (GET /api/health/storage/)。
+    """
+    try:
+        with exclusive_run(settings.RAG_MAINTENANCE_TIME_LIMIT):
+            report = run_maintenance(get_registry())
+    except MaintenanceRunning as e:
+        print(f"略過向量庫維護: {e}")
+        return
+    store_report(report)
+    orphan_count = sum(len(items) for items in report['orphans'].values())
+    print(
+        f"向量庫維護完成：回收 {orphan_count} 項孤兒資料，共 {report['reclaimed_bytes'] / 1024 / 1024:.1f} MB，"
+        f"{len(report['missing_indexes'])} 個文件缺少向量，耗時 {report['seconds']:.1f} 秒。"
+    )
+
 @shared_task
 def delete_qa_record_task(qa_id):
     """
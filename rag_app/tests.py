@@ -1,3 +1,1038 @@
-from django.test import TestCase
+import hashlib
+import io
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import httpx
+import numpy as np
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, TestCase, override_settings
+from rest_framework.test import APIClient
+
+from . import lexical_index, maintenance, quantized_index, retrieval
+from .answer_batching import AnswerBatcher
+from .bulk_upload import close_files, expand_uploaded_files
+from .context_builder import assemble_blocks, build_context, estimate_tokens
+from .embedding_cache import EmbeddingCache, chunk_hash
+from .llm import OllamaClient
+from .models import Document, QuestionAnswer
+from .registry import warm_up_web_process
+from .snapshots import export_snapshot, import_snapshot
+from .tasks import _chunk_id
+from .reranker import CrossEncoderReranker
+from .streaming_upload import StreamingUploadApplication
+from .vector_layout import LAYOUT_PER_DOCUMENT, LAYOUT_SHARED, index_target
+
+
+def _matches(metadata, where):
+    if where is None:
+        return True
+    (field, condition), = where.items()
+    if isinstance(condition, dict):
+        return metadata.get(field) in condition['$in']
+    return metadata.get(field) == condition
+
+
+class FakeCollection:
+    """
+    以 numpy 實作 Chroma Collection 的 query/get/upsert/delete (平方歐氏距離)，並記錄每次查詢的過濾條件。
+    """
+
+    def __init__(self):
+        self.rows = {}
+        self.queries = []
+        self.gets = [] # 每次 get 要求的 include
+
+    def add(self, chunk_id, vector, text, metadata):
+        self.rows[chunk_id] = (np.asarray(vector, dtype=np.float32), text, metadata)
+
+    def query(self, query_embeddings, n_results, where=None, include=()):
+        self.queries.append(where)
+        rows = [(chunk_id, row) for chunk_id, row in self.rows.items() if _matches(row[2], where)]
+        results = {'ids': [], 'documents': [], 'metadatas': [], 'distances': []}
+        for vector in query_embeddings:
+            vector = np.asarray(vector, dtype=np.float32)
+            ranked = sorted(rows, key=lambda item: float(np.sum((item[1][0] - vector) ** 2)))[:n_results]
+            results['ids'].append([chunk_id for chunk_id, _ in ranked])
+            results['documents'].append([row[1] for _, row in ranked])
+            results['metadatas'].append([row[2] for _, row in ranked])
+            results['distances'].append([float(np.sum((row[0] - vector) ** 2)) for _, row in ranked])
+        return results
+
+    def upsert(self, ids, embeddings, documents, metadatas):
+        for chunk_id, vector, text, metadata in zip(ids, embeddings, documents, metadatas):
+            self.add(chunk_id, vector, text, metadata)
+
+    def delete(self, ids):
+        for chunk_id in ids:
+            self.rows.pop(chunk_id, None)
+
+    def get(self, ids=None, where=None, include=(), limit=None, offset=0):
+        self.gets.append(list(include))
+        selected = [
+            (chunk_id, row) for chunk_id, row in self.rows.items()
+            if (ids is None or chunk_id in ids) and _matches(row[2], where)
+        ][offset:None if limit is None else offset + limit]
+        return {
+            'ids': [chunk_id for chunk_id, _ in selected],
+            'documents': [row[1] for _, row in selected],
+            'metadatas': [row[2] for _, row in selected],
+            'embeddings': [row[0] for _, row in selected] if 'embeddings' in include else None,
+        }
+
+
+class FakeRegistry:
+    def __init__(self):
+        self.collections = {}
+
+    def get_vector_store(self, collection_name):
+        collection = self.collections.setdefault(collection_name, FakeCollection())
+        return SimpleNamespace(_collection=collection)
+
+    def add_chunk(self, document, chunk_id, vector, text='', **metadata):
+        target = index_target(document.id, document.index_layout)
+        metadata = dict(metadata, source_file_id=str(document.id))
+        self.get_vector_store(target.collection_name)._collection.add(chunk_id, vector, text, metadata)
+
+
+def _document(layout=LAYOUT_PER_DOCUMENT):
+    return SimpleNamespace(id=uuid.uuid4(), index_layout=layout)
+
+
+class EmbeddingCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        # last_used 以遞增的假時間記錄，LRU 的順序不受時鐘解析度影響
+        clock = itertools.count(1000)
+        patcher = mock.patch('rag_app.embedding_cache.time.time', side_effect=lambda: float(next(clock)))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _cache(self, max_entries=10):
+        return EmbeddingCache(self.directory, 'test/model', max_entries=max_entries)
+
+    def test_chunk_hash_ignores_whitespace_and_unicode_form(self):
+        self.assertEqual(chunk_hash("café  au\n lait "), chunk_hash("café au lait"))
+        self.assertNotEqual(chunk_hash("café au lait"), chunk_hash("café au lait!"))
+
+    def test_round_trip_through_memmap_survives_reopen(self):
+        cache = self._cache()
+        keys = [chunk_hash("alpha"), chunk_hash("beta")]
+        vectors = np.array([[1, 2, 3], [4, 5, 6]], dtype=np.float32)
+        cache.put_many(keys, vectors)
+
+        reopened = self._cache()
+        found = reopened.get_many(keys + [chunk_hash("gamma")])
+        self.assertEqual(set(found), set(keys))
+        np.testing.assert_array_equal(found[keys[0]], vectors[0])
+        np.testing.assert_array_equal(found[keys[1]], vectors[1])
+        self.assertEqual((reopened.hits, reopened.misses), (2, 1))
+
+    def test_evicts_least_recently_used_entry(self):
+        cache = self._cache(max_entries=2)
+        a, b, c = (chunk_hash(text) for text in ("a", "b", "c"))
+        cache.put_many([a, b], np.eye(2, 3, dtype=np.float32))
+        cache.get_many([a]) # a 成為最近使用，b 最久未使用
+        cache.put_many([c], np.ones((1, 3), dtype=np.float32))
+
+        found = cache.get_many([a, b, c])
+        self.assertEqual(set(found), {a, c})
+        np.testing.assert_array_equal(found[c], np.ones(3, dtype=np.float32))
+        self.assertEqual(cache.stats()['entries'], 2)
+
+    def test_overwritten_slot_is_treated_as_miss(self):
+        cache = self._cache()
+        key = chunk_hash("alpha")
+        cache.put_many([key], np.ones((1, 3), dtype=np.float32))
+        # 模擬其他進程正在覆寫這個槽位：鍵摘要已清除
+        cache._keys[0] = 0
+        self.assertEqual(cache.get_many([key]), {})
+
+    def test_duplicate_keys_are_stored_once(self):
+        cache = self._cache()
+        key = chunk_hash("alpha")
+        cache.put_many([key, key], np.array([[1, 1, 1], [2, 2, 2]], dtype=np.float32))
+        self.assertEqual(cache.stats()['entries'], 1)
+        np.testing.assert_array_equal(cache.get_many([key])[key], np.ones(3, dtype=np.float32))
+
+
+@override_settings(RAG_VECTOR_SEARCH_BACKEND='chroma', RAG_HYBRID_RRF_K=60, RAG_SHARED_COLLECTION_SHARDS=1,
+                   RAG_SHARED_COLLECTION_PREFIX='test_chunks')
+class MultiDocumentRetrievalTests(SimpleTestCase):
+    def test_search_targets_merge_shared_documents_into_one_filter(self):
+        first, second = _document(LAYOUT_SHARED), _document(LAYOUT_SHARED)
+        separate = _document()
+        targets = retrieval.search_targets([first, separate, second])
+        self.assertIn((str(separate.id), None), targets)
+        self.assertIn(('test_chunks_0', {'source_file_id': {'$in': [str(first.id), str(second.id)]}}), targets)
+        self.assertEqual(len(targets), 2)
+
+    @override_settings(RAG_HYBRID_SEARCH_ENABLED=False)
+    def test_retrieve_merges_collections_by_distance(self):
+        registry = FakeRegistry()
+        first, second, shared = _document(), _document(), _document(LAYOUT_SHARED)
+        registry.add_chunk(first, 'a1', [0.0, 0.0])
+        registry.add_chunk(first, 'a2', [3.0, 0.0])
+        registry.add_chunk(second, 'b1', [1.0, 0.0])
+        registry.add_chunk(shared, 'c1', [2.0, 0.0])
+        registry.add_chunk(_document(LAYOUT_SHARED), 'other', [0.0, 0.0]) # 同一分片中不在範圍內的文件
+
+        results = retrieval.retrieve(registry, [first, second, shared], [0.0, 0.0], k=3)
+        self.assertEqual([chunk.id for chunk, _ in results], ['a1', 'b1', 'c1'])
+        self.assertEqual([distance for _, distance in results], [0.0, 1.0, 4.0])
+
+    @override_settings(RAG_HYBRID_SEARCH_ENABLED=False)
+    def test_retrieve_many_batches_questions_on_the_same_collection(self):
+        registry = FakeRegistry()
+        document = _document()
+        registry.add_chunk(document, 'near_origin', [0.0, 0.0])
+        registry.add_chunk(document, 'near_one', [1.0, 1.0])
+
+        results = retrieval.retrieve_many(
+            registry, [([document], [0.0, 0.0], None), ([document], [1.0, 1.0], None)], k=1,
+        )
+        self.assertEqual([[chunk.id for chunk, _ in hits] for hits in results], [['near_origin'], ['near_one']])
+        self.assertEqual(len(registry.collections[str(document.id)].queries), 1)
+
+    def test_reciprocal_rank_fusion_rewards_agreement_between_rankings(self):
+        fused = retrieval._reciprocal_rank_fusion(['a', 'b', 'c'], ['d', 'b', 'e'])
+        # b 在兩路都是第 2 名，分數高於只在一路排第 1 名的 a 與 d
+        self.assertEqual(fused[0], 'b')
+        self.assertEqual(set(fused[1:3]), {'a', 'd'})
+        self.assertEqual(set(fused[3:]), {'c', 'e'})
+
+    def test_fuse_fetches_lexical_only_chunks_with_their_dense_distance(self):
+        registry = FakeRegistry()
+        document = _document()
+        registry.add_chunk(document, 'dense', [0.0, 0.0], text='dense')
+        registry.add_chunk(document, 'keyword', [2.0, 0.0], text='keyword')
+        dense = [(retrieval.ChunkDocument(id='dense', page_content='dense', metadata={}), 0.0)]
+        lexical = [('keyword', 5.0, document)]
+
+        fused = retrieval._fuse(registry, dense, lexical, [0.0, 0.0], k=2, depth=2)
+        self.assertEqual({chunk.id: distance for chunk, distance in fused}, {'dense': 0.0, 'keyword': 4.0})
+        self.assertEqual(fused[0][0].page_content, 'dense')
+
+
+class LexicalIndexTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        overrides = override_settings(RAG_LEXICAL_INDEX_DIR=directory, RAG_LEXICAL_INDEX_CACHE_SIZE=4)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+    def _build(self, document, chunks):
+        writer = lexical_index.LexicalIndexWriter(document.id)
+        writer.add(list(chunks), list(chunks.values()))
+        self.assertEqual(writer.commit(), len(chunks))
+        return lexical_index.get_index(document.id)
+
+    @override_settings(RAG_HYBRID_SEARCH_ENABLED=True, RAG_HYBRID_CANDIDATES=4, RAG_LEXICAL_MAX_DOCUMENTS=1)
+    def test_corpus_scope_fuses_lexical_hits_from_dense_selected_documents(self):
+        registry = FakeRegistry()
+        near, far = _document(), _document()
+        registry.add_chunk(near, 'near_intro', [0.0, 0.0], text="introduction")
+        registry.add_chunk(near, 'near_refund', [3.0, 0.0], text="refund window")
+        registry.add_chunk(far, 'far_refund', [5.0, 0.0], text="refund refund window")
+        self._build(near, {'near_intro': "introduction", 'near_refund': "refund window"})
+        self._build(far, {'far_refund': "refund refund window"})
+
+        with mock.patch.object(lexical_index, 'search_documents', wraps=lexical_index.search_documents) as search:
+            results, = retrieval.retrieve_many(registry, [([near, far], [0.0, 0.0], "refund")], k=2)
+        # 範圍超過上限時只搜尋向量檢索命中的文件 (near 的區塊距離最近)
+        (documents, _, _), _ = search.call_args
+        self.assertEqual([document.id for document in documents], [near.id])
+        # far 的關鍵字命中沒有參與融合；near_refund 由兩路排名都支持，排在第一
+        self.assertEqual([chunk.id for chunk, _ in results], ['near_refund', 'near_intro'])
+
+    def test_tokenize_keeps_codes_and_splits_cjk_into_bigrams(self):
+        tokens = lexical_index.tokenize("See ISO-9001 條款說明")
+        self.assertIn('iso-9001', tokens)
+        self.assertIn('iso', tokens)
+        self.assertIn('9001', tokens)
+        self.assertEqual([token for token in tokens if not token.isascii()], ['條款', '款說', '說明'])
+
+    def test_postings_round_trip_through_disk(self):
+        document = _document()
+        index = self._build(document, {
+            'c1': "refund policy refund window",
+            'c2': "shipping policy",
+            'c3': "warranty terms",
+        })
+        self.assertEqual(len(index), 3)
+        hits = index.search(set(lexical_index.tokenize("refund policy")), k=10)
+        self.assertEqual([chunk_id for chunk_id, _ in hits], ['c1', 'c2'])
+        self.assertEqual(index.search({'missing'}, k=10), [])
+
+    def test_scores_match_bm25_formula(self):
+        document = _document()
+        index = self._build(document, {'c1': "alpha alpha beta", 'c2': "beta gamma gamma gamma"})
+        (chunk_id, score), = index.search({'alpha'}, k=10)
+        # alpha 只出現在 c1 (tf=2，長度 3)；平均長度 3.5
+        idf = np.log(1 + (2 - 1 + 0.5) / (1 + 0.5))
+        norm = lexical_index.BM25_K1 * (1 - lexical_index.BM25_B + lexical_index.BM25_B * 3 / 3.5)
+        self.assertEqual(chunk_id, 'c1')
+        self.assertAlmostEqual(score, idf * 2 * (lexical_index.BM25_K1 + 1) / (2 + norm), places=5)
+
+    def test_search_documents_merges_indexes_and_skips_missing_ones(self):
+        first, second, unindexed = _document(), _document(), _document()
+        self._build(first, {'a': "invoice number"})
+        self._build(second, {'b': "invoice invoice invoice"})
+        hits = lexical_index.search_documents([first, second, unindexed], "invoice", k=1)
+        self.assertEqual([(chunk_id, document) for chunk_id, _, document in hits], [('b', second)])
+
+    def test_rewritten_and_deleted_indexes_are_reloaded(self):
+        document = _document()
+        self._build(document, {'old': "legacy text"})
+        self._build(document, {'new': "fresh text"})
+        self.assertEqual(lexical_index.get_index(document.id).search({'fresh'}, k=1)[0][0], 'new')
+        lexical_index.delete_index(document.id)
+        self.assertIsNone(lexical_index.get_index(document.id))
+
+
+@override_settings(RAG_BULK_UPLOAD_MAX_MEMBER_BYTES=1024)
+class BulkUploadExpansionTests(SimpleTestCase):
+    def _archive(self, members):
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+            for name, content in members.items():
+                zf.writestr(name, content)
+        return SimpleUploadedFile('upload.zip', buffer.getvalue())
+
+    def test_zip_members_are_extracted_to_temporary_files(self):
+        archive = self._archive({
+            'docs/a.txt': b"hello",
+            'b.pdf': b"%PDF-1.4 body",
+            'c.exe': b"MZ",
+            'd.pdf': b"not a pdf",
+            'big.txt': b"x" * 2048,
+            '__MACOSX/._a.txt': b"",
+        })
+        accepted, skipped = expand_uploaded_files([archive])
+        self.addCleanup(close_files, accepted)
+
+        self.assertEqual([name for name, _ in accepted], ['a.txt', 'b.pdf'])
+        self.assertEqual(
+            sorted((item['filename'], item['reason']) for item in skipped),
+            [('big.txt', 'too_large'), ('c.exe', 'unsupported'), ('d.pdf', 'invalid_content')],
+        )
+        name, member = accepted[0]
+        self.assertTrue(os.path.exists(member.temporary_file_path()))
+        self.assertEqual((member.size, member.read()), (5, b"hello"))
+
+        path = member.temporary_file_path()
+        close_files(accepted)
+        self.assertFalse(os.path.exists(path))
+
+
+class AnswerBatcherTests(SimpleTestCase):
+    def _run_in_thread(self, function):
+        result = {}
+
+        def target():
+            try:
+                result['value'] = function()
+            except Exception as e:
+                result['error'] = e
+
+        thread = threading.Thread(target=target)
+        thread.start()
+        self.addCleanup(thread.join, 5)
+        return thread, result
+
+    def test_identical_in_flight_answers_share_one_generation(self):
+        batcher = AnswerBatcher(embedder=None)
+        started, release = threading.Event(), threading.Event()
+        calls = []
+
+        def produce():
+            calls.append(1)
+            yield 'sources', ['s1']
+            started.set()
+            release.wait(5)
+            yield 'token', "answer"
+
+        leader, leader_result = self._run_in_thread(lambda: list(batcher.answer('key', produce)))
+        self.assertTrue(started.wait(5))
+        follower, follower_result = self._run_in_thread(lambda: list(batcher.answer('key', produce)))
+        while batcher.coalesced_answers < 1:
+            threading.Event().wait(0.001)
+        release.set()
+        leader.join(5)
+        follower.join(5)
+
+        expected = [('sources', ['s1']), ('token', "answer")]
+        self.assertEqual(leader_result['value'], expected)
+        self.assertEqual(follower_result['value'], expected)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(batcher.stats()['inflight_answers'], 0)
+
+        # 生成結束後相同的問題重新生成
+        self.assertEqual(list(batcher.answer('key', produce)), expected)
+        self.assertEqual(len(calls), 2)
+
+    def test_followers_see_the_leader_failure(self):
+        batcher = AnswerBatcher(embedder=None)
+        started, release = threading.Event(), threading.Event()
+
+        def produce():
+            yield 'sources', []
+            started.set()
+            release.wait(5)
+            raise ValueError("LLM unavailable")
+
+        leader, leader_result = self._run_in_thread(lambda: list(batcher.answer('key', produce)))
+        self.assertTrue(started.wait(5))
+        follower, follower_result = self._run_in_thread(lambda: list(batcher.answer('key', produce)))
+        while batcher.coalesced_answers < 1:
+            threading.Event().wait(0.001)
+        release.set()
+        leader.join(5)
+        follower.join(5)
+
+        self.assertIsInstance(leader_result['error'], ValueError)
+        self.assertIsInstance(follower_result['error'], RuntimeError)
+        self.assertIn("LLM unavailable", str(follower_result['error']))
+
+    def test_concurrent_questions_share_one_embedding_batch(self):
+        embedder = mock.Mock()
+        embedder.embed_documents.side_effect = lambda questions: [[float(len(q))] for q in questions]
+        batcher = AnswerBatcher(embedder, window_seconds=5, max_batch_size=2)
+        batcher._active_answers = 2 # 模擬兩個並行中的問答，帶頭的請求會等待窗口
+
+        def fake_retrieve_many(registry, requests, k):
+            return [[(question, k)] for _, _, question in requests]
+
+        with mock.patch('rag_app.answer_batching.get_registry'), \
+                mock.patch('rag_app.answer_batching.retrieve_many', side_effect=fake_retrieve_many):
+            first, first_result = self._run_in_thread(lambda: batcher.search([], "short", 3))
+            while not batcher._pending:
+                threading.Event().wait(0.001)
+            second_result = batcher.search([], "a longer question", 3)
+            first.join(5)
+
+        self.assertEqual(first_result['value'], ([5.0], [("short", 3)]))
+        self.assertEqual(second_result, ([17.0], [("a longer question", 3)]))
+        embedder.embed_documents.assert_called_once_with(["short", "a longer question"])
+        self.assertEqual(batcher.stats()['avg_batch_size'], 2.0)
+
+
+def _chunk(chunk_id, text, page=1, document='doc'):
+    return retrieval.ChunkDocument(
+        id=chunk_id, page_content=text, metadata={'source_file_id': document, 'page': page, 'source_filename': f"{document}.pdf"},
+    )
+
+
+@override_settings(RAG_CONTEXT_CHARS_PER_TOKEN=4)
+class ContextBuilderTests(SimpleTestCase):
+    def test_estimate_tokens_counts_cjk_characters_individually(self):
+        self.assertEqual(estimate_tokens("退款期限"), 4)
+        self.assertEqual(estimate_tokens("abcdefgh"), 2)
+        self.assertEqual(estimate_tokens("退款 abc"), 3)
+
+    def test_assemble_blocks_merges_overlap_on_the_same_page_only(self):
+        overlap = "the overlapping sentence is long enough to match."
+        first = _chunk('a', "Intro paragraph. " + overlap)
+        second = _chunk('b', overlap + " Closing paragraph.")
+        other_page = _chunk('c', "Intro paragraph. " + overlap + " Other page.", page=2)
+        contained = _chunk('d', "Intro paragraph.")
+
+        blocks = assemble_blocks([first, second, contained, other_page])
+        self.assertEqual([text for _, text in blocks], [
+            "Intro paragraph. " + overlap + " Closing paragraph.",
+            "Intro paragraph. " + overlap + " Other page.",
+        ])
+        self.assertEqual(blocks[1][0]['page'], 2)
+
+    def test_mmr_prefers_diverse_chunks_within_the_budget(self):
+        retrieved = [
+            (_chunk('a', "alpha " * 10), 0.1),
+            (_chunk('b', "alpha again " * 5), 0.2), # 與 a 幾乎相同的內容
+            (_chunk('c', "gamma " * 10), 0.3),
+        ]
+        embeddings = {'a': [1.0, 0.0], 'b': [0.99, 0.01], 'c': [0.0, 1.0]}
+
+        built = build_context(retrieved, embeddings, label_sources=False, token_budget=35, mmr_lambda=0.5, baseline_k=3)
+        self.assertEqual([chunk.id for chunk, _ in built.selected], ['a', 'c'])
+        self.assertLessEqual(built.tokens, 35)
+        self.assertEqual(built.tokens, estimate_tokens("\n\n".join(text for _, text in built.blocks)))
+        self.assertGreater(built.baseline_tokens, built.tokens)
+
+    def test_first_chunk_is_kept_even_over_budget(self):
+        retrieved = [(_chunk('a', "x" * 400), 0.1), (_chunk('b', "y" * 8), 0.2)]
+        built = build_context(retrieved, {}, label_sources=True, token_budget=10, mmr_lambda=0.7, baseline_k=1)
+        self.assertEqual([chunk.id for chunk, _ in built.selected], ['a'])
+        self.assertTrue(built.blocks[0][1].startswith("x"))
+
+    def test_empty_retrieval(self):
+        built = build_context([], {}, label_sources=False, token_budget=10, mmr_lambda=0.7, baseline_k=5)
+        self.assertEqual((built.blocks, built.selected, built.tokens, built.baseline_tokens), ([], [], 0, 0))
+
+
+@override_settings(RAG_QUANTIZED_RERANK_FACTOR={'int8': 4, 'binary': 20}, RAG_QUANTIZED_COARSE_MIN_VECTORS=10 ** 9)
+class QuantizedIndexTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        overrides = override_settings(RAG_QUANTIZED_INDEX_DIR=directory)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        rng = np.random.default_rng(1)
+        self.vectors = rng.normal(size=(200, 16)).astype(np.float32)
+        self.ids = [f"chunk-{i}" for i in range(len(self.vectors))]
+        self.stored = dict(zip(self.ids, self.vectors))
+        self.queries = rng.normal(size=(5, 16)).astype(np.float32)
+
+    def _check(self, quantization, min_recall):
+        document_id = uuid.uuid4()
+        self.assertEqual(quantized_index.build_index(document_id, self.ids, self.vectors, quantization), 200)
+        index = quantized_index.get_index(document_id)
+        self.assertEqual(index.rerank_bytes(), self.vectors.nbytes // 2) # float16
+        self.assertLess(index.memory_bytes(), self.vectors.nbytes)
+
+        results = index.search(self.queries, 5)
+        hits = 0
+        for query, found in zip(self.queries, results):
+            exact = ((self.vectors - query) ** 2).sum(axis=1)
+            truth = {self.ids[i] for i in np.argsort(exact)[:5]}
+            hits += len(truth & {chunk_id for chunk_id, _ in found})
+            for chunk_id, distance in found:
+                expected = float(((self.stored[chunk_id] - query) ** 2).sum())
+                self.assertAlmostEqual(distance, expected, delta=expected * 1e-2)
+            self.assertEqual([distance for _, distance in found], sorted(distance for _, distance in found))
+        self.assertGreaterEqual(hits / 25, min_recall)
+
+    def test_int8_reranks_with_stored_vectors(self):
+        self._check(quantized_index.QUANTIZATION_INT8, 0.95)
+
+    def test_binary_reranks_with_stored_vectors(self):
+        self._check(quantized_index.QUANTIZATION_BINARY, 0.6)
+
+    def test_vectors_reads_requested_rows(self):
+        document_id = uuid.uuid4()
+        quantized_index.build_index(document_id, self.ids, self.vectors, quantized_index.QUANTIZATION_INT8)
+        vectors = quantized_index.get_index(document_id).vectors(['chunk-7', 'missing', 'chunk-3'])
+        self.assertEqual(set(vectors), {'chunk-7', 'chunk-3'})
+        np.testing.assert_allclose(vectors['chunk-7'], self.vectors[7], atol=1e-2)
+
+    def test_index_without_rerank_vectors_falls_back_to_chroma(self):
+        document_id = uuid.uuid4()
+        quantized_index.build_index(document_id, self.ids, self.vectors, quantized_index.QUANTIZATION_INT8)
+        os.remove(os.path.join(quantized_index.index_path(document_id), 'rerank.npy'))
+        quantized_index._forget(document_id)
+        self.assertIsNone(quantized_index.get_index(document_id))
+
+    @override_settings(RAG_VECTOR_SEARCH_BACKEND='quantized', RAG_HYBRID_SEARCH_ENABLED=False)
+    def test_retrieve_does_not_load_chroma_vectors(self):
+        registry = FakeRegistry()
+        document = _document()
+        for chunk_id, vector in self.stored.items():
+            registry.add_chunk(document, chunk_id, vector, text=f"text of {chunk_id}")
+        quantized_index.build_index(document.id, self.ids, self.vectors, quantized_index.QUANTIZATION_INT8)
+
+        results = retrieval.retrieve(registry, [document], self.queries[0].tolist(), k=3)
+        exact = ((self.vectors - self.queries[0]) ** 2).sum(axis=1)
+        self.assertEqual([chunk.id for chunk, _ in results], [self.ids[i] for i in np.argsort(exact)[:3]])
+        self.assertEqual(results[0][0].page_content, f"text of {results[0][0].id}")
+        collection = registry.collections[str(document.id)]
+        self.assertEqual(collection.queries, []) # 沒有查詢 Chroma 的 HNSW
+        self.assertEqual(collection.gets, [['documents', 'metadatas']]) # 只取文字與 metadata，不取嵌入
+
+        embeddings = retrieval.fetch_chunk_embeddings(registry, [document], [chunk for chunk, _ in results])
+        self.assertEqual(set(embeddings), {chunk.id for chunk, _ in results})
+        self.assertEqual(len(collection.gets), 1)
+
+
+class ListApiTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.documents = [
+            Document.objects.create(file=f"documents/doc{i}.pdf", filename=f"doc{i}.pdf", status='COMPLETED')
+            for i in range(5)
+        ]
+
+    def test_cursor_pages_cover_every_document_once(self):
+        seen, url = [], '/api/documents/?page_size=2'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(response.data['results']), 2)
+            seen.extend(item['id'] for item in response.data['results'])
+            url = response.data['next']
+        self.assertEqual(sorted(seen), sorted(str(document.id) for document in self.documents))
+        # 依上傳時間由新到舊
+        self.assertEqual(seen[0], str(self.documents[-1].id))
+
+    def test_list_etag_changes_only_when_a_row_on_the_page_changes(self):
+        response = self.client.get('/api/documents/?page_size=2')
+        etag = response['ETag']
+        self.assertIn('no-cache', response['Cache-Control'])
+        self.assertEqual(self.client.get('/api/documents/?page_size=2', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        # 不在第一頁的文件變更不影響第一頁的 ETag
+        self.documents[0].processing_message = "changed"
+        self.documents[0].save()
+        self.assertEqual(self.client.get('/api/documents/?page_size=2', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        self.documents[-1].status = 'FAILED'
+        self.documents[-1].save()
+        response = self.client.get('/api/documents/?page_size=2', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.data['results'][0]['status'], 'FAILED')
+
+    def test_retrieve_supports_conditional_get(self):
+        url = f'/api/documents/{self.documents[0].id}/'
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    def test_qa_list_etag_follows_the_document_filename(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        document = self.documents[0]
+        QuestionAnswer.objects.create(document=document, question="q", status='COMPLETED')
+        url = f'/api/qa/?document={document.id}'
+        etag = self.client.get(url)['ETag']
+
+        with override_settings(MEDIA_ROOT=media_root), \
+                mock.patch('rag_app.views.parse_and_vectorize_document_task') as task, \
+                self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                f'/api/documents/{document.id}/replace/', {'file': SimpleUploadedFile('renamed.txt', b"new content")},
+            )
+        self.assertEqual(response.status_code, 202)
+        task.delay.assert_called_once_with(str(document.id))
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['results'][0]['document_filename'], 'renamed.txt')
+        # 沒有輸出文件名稱時，文件變更不影響 ETag
+        etag = self.client.get(f'{url}&fields=id,status')['ETag']
+        document.refresh_from_db()
+        document.save()
+        self.assertEqual(self.client.get(f'{url}&fields=id,status', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    def test_replace_is_rejected_until_the_queued_reindex_runs(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        document = self.documents[0]
+        url = f'/api/documents/{document.id}/replace/'
+        with override_settings(MEDIA_ROOT=media_root), \
+                mock.patch('rag_app.views.parse_and_vectorize_document_task') as task, \
+                self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.client.post(url, {'file': SimpleUploadedFile('a.txt', b"first")}).status_code, 202)
+            # 第一次取代的任務還在佇列中 (UPLOADED)
+            self.assertEqual(self.client.post(url, {'file': SimpleUploadedFile('b.txt', b"second")}).status_code, 409)
+            Document.objects.filter(id=document.id).update(status='PROCESSING')
+            self.assertEqual(self.client.post(url, {'file': SimpleUploadedFile('b.txt', b"second")}).status_code, 409)
+        self.assertEqual(task.delay.call_count, 1)
+        document.refresh_from_db()
+        self.assertEqual(document.filename, 'a.txt')
+
+    def test_corpus_history_lists_corpus_scope_answers(self):
+        QuestionAnswer.objects.create(document=self.documents[0], question="single", status='COMPLETED')
+        corpus = QuestionAnswer.objects.create(scope='CORPUS', question="corpus", status='COMPLETED')
+        response = self.client.get('/api/qa/?scope=corpus')
+        self.assertEqual([item['id'] for item in response.data['results']], [corpus.id])
+        self.assertIsNone(response.data['results'][0]['document_filename'])
+
+    def test_fields_and_status_filters(self):
+        self.documents[1].status = 'FAILED'
+        self.documents[1].save()
+        response = self.client.get('/api/documents/?status=failed&fields=id,status')
+        self.assertEqual(response.data['results'], [{'id': str(self.documents[1].id), 'status': 'FAILED'}])
+        self.assertEqual(self.client.get('/api/documents/?status=bogus').status_code, 400)
+
+
+class StreamingUploadTests(TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        overrides = override_settings(MEDIA_ROOT=directory, RAG_STREAM_UPLOAD_TMP_DIR=os.path.join(directory, 'partial'))
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        # 測試的交易中不能關閉資料庫連線
+        patcher = mock.patch('rag_app.streaming_upload.close_old_connections')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _upload(self, body, content_hash):
+        app = StreamingUploadApplication(app=None)
+        scope = {'type': 'http', 'method': 'POST', 'path': app.path, 'headers': [
+            (b'x-filename', b'notes.txt'),
+            (b'content-length', str(len(body)).encode()),
+            (b'x-content-sha256', content_hash.encode()),
+        ]}
+        received, sent = [], []
+
+        async def receive():
+            received.append(body)
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        async def send(message):
+            sent.append(message)
+
+        async_to_sync(app)(scope, receive, send)
+        return sent[0]['status'], json.loads(sent[1]['body']), received
+
+    def test_declared_hash_of_existing_document_is_rejected_before_the_body(self):
+        body = b"refund policy"
+        existing = Document.objects.create(
+            file='documents/notes.txt', filename='notes.txt', status='COMPLETED', content_hash=hashlib.sha256(body).hexdigest(),
+        )
+        status, payload, received = self._upload(body, existing.content_hash.upper())
+        self.assertEqual(status, 409)
+        self.assertEqual(payload, {'detail': "Duplicate file.", 'duplicate_of': str(existing.id)})
+        self.assertEqual(received, [])
+        self.assertEqual(Document.objects.count(), 1)
+
+    def test_failed_document_does_not_block_the_same_content(self):
+        body = b"refund policy"
+        content_hash = hashlib.sha256(body).hexdigest()
+        Document.objects.create(file='documents/notes.txt', filename='notes.txt', status='FAILED', content_hash=content_hash)
+        with mock.patch('rag_app.streaming_upload.parse_and_vectorize_document_task') as task, \
+                self.captureOnCommitCallbacks(execute=True):
+            status, payload, received = self._upload(body, content_hash)
+        self.assertEqual(status, 201)
+        self.assertEqual(received, [body])
+        self.assertEqual(Document.objects.get(pk=payload['id']).content_hash, content_hash)
+        task.delay.assert_called_once_with(payload['id'])
+
+
+@override_settings(RAG_HYBRID_SEARCH_ENABLED=False, RAG_VECTOR_SEARCH_BACKEND='chroma')
+class SnapshotChunkIdTests(TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.path = os.path.join(directory, 'doc.ragsnap')
+        patcher = mock.patch('rag_app.snapshots.get_embedding_engine', return_value=SimpleNamespace(cache=None))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.document = Document.objects.create(
+            file='', filename='notes.txt', status='COMPLETED', index_layout=LAYOUT_PER_DOCUMENT, index_version=1,
+        )
+
+    def _stored(self, registry):
+        collection = registry.collections[str(self.document.id)]
+        return {chunk_id: row[2]['index_version'] for chunk_id, row in collection.rows.items()}
+
+    def test_chunk_ids_depend_only_on_document_and_content(self):
+        self.assertEqual(_chunk_id(self.document.id, 'a' * 64), _chunk_id(self.document.id, 'a' * 64))
+        self.assertEqual(_chunk_id(self.document.id, 'a' * 64), f"{self.document.id}:{'a' * 32}")
+        self.assertNotEqual(_chunk_id(self.document.id, 'a' * 64), _chunk_id(uuid.uuid4(), 'a' * 64))
+
+    def test_import_keeps_chunk_ids_and_deletes_only_stale_chunks(self):
+        source = FakeRegistry()
+        ids = [_chunk_id(self.document.id, content_hash * 64) for content_hash in 'ab']
+        for position, chunk_id in enumerate(ids):
+            source.add_chunk(self.document, chunk_id, [float(position), 0.0], text=f"chunk {position}", index_version=1)
+        self.assertEqual(export_snapshot(source, self.document, self.path, include_file=False), 2)
+
+        # 目標節點已有其中一個區塊，另有一個這次快照沒有的舊區塊
+        target = FakeRegistry()
+        target.add_chunk(self.document, ids[0], [0.0, 0.0], text="chunk 0", index_version=0)
+        target.add_chunk(self.document, _chunk_id(self.document.id, 'c' * 64), [9.0, 0.0], index_version=0)
+        result = import_snapshot(target, self.path)
+
+        self.assertEqual(result.chunks, 2)
+        self.assertEqual(self._stored(target), {ids[0]: 1, ids[1]: 1})
+        np.testing.assert_array_equal(target.collections[str(self.document.id)].rows[ids[1]][0], [1.0, 0.0])
+        # 再次匯入時 ID 不變，不會新增或刪除任何區塊
+        import_snapshot(target, self.path)
+        self.assertEqual(self._stored(target), {ids[0]: 1, ids[1]: 1})
+
+
+class WebWarmUpTests(SimpleTestCase):
+    def test_web_warm_up_is_off_by_default(self):
+        self.assertFalse(settings.RAG_SEARCH_WARM_UP_IN_WEB)
+        with mock.patch('rag_app.registry.get_registry') as get_registry:
+            warm_up_web_process()
+        get_registry.assert_not_called()
+
+    @override_settings(RAG_SEARCH_WARM_UP_IN_WEB=True)
+    def test_opted_in_web_warm_up_loads_only_search_components(self):
+        with mock.patch('rag_app.registry.get_registry') as get_registry:
+            warm_up_web_process()
+        get_registry.return_value.warm_up.assert_called_once_with(('chroma', 'embedding'))
+
+    @override_settings(RAG_SEARCH_WARM_UP_IN_WEB=True)
+    def test_failed_web_warm_up_does_not_stop_startup(self):
+        with mock.patch('rag_app.registry.get_registry') as get_registry, mock.patch('builtins.print') as printed:
+            get_registry.return_value.warm_up.side_effect = OSError("model missing")
+            warm_up_web_process()
+        self.assertIn("model missing", printed.call_args.args[0])
+
+
+class FakeCrossEncoder:
+    def __init__(self, seconds_per_pair=0.0):
+        self.seconds_per_pair = seconds_per_pair
+        self.calls = []
+
+    def predict(self, pairs, batch_size=None, show_progress_bar=False):
+        self.calls.append(len(pairs))
+        time.sleep(self.seconds_per_pair * len(pairs))
+        return [float(len(text)) for _, text in pairs]
+
+
+class RerankerBudgetTests(SimpleTestCase):
+    def _reranker(self, model, load_seconds=0.0, loaded=True):
+        reranker = CrossEncoderReranker('fake', batch_size=8)
+        if loaded:
+            reranker._model = model
+
+        def load():
+            if reranker._model is None:
+                time.sleep(load_seconds)
+                reranker._model = model
+            return reranker._model
+
+        reranker._get_model = load
+        return reranker
+
+    def _candidates(self, count):
+        return [(_chunk(f"c{i}", "x" * (i + 1)), float(i)) for i in range(count)]
+
+    def test_warm_up_estimate_excludes_model_load(self):
+        reranker = self._reranker(FakeCrossEncoder(), load_seconds=0.3, loaded=False)
+        reranker.warm_up()
+        self.assertLess(reranker._seconds_per_pair, 0.1)
+
+    def test_cold_model_keeps_the_budget_and_loads_in_background(self):
+        model = FakeCrossEncoder()
+        reranker = self._reranker(model, load_seconds=0.3, loaded=False)
+        candidates = self._candidates(3)
+        result = reranker.rerank("q", candidates, budget_seconds=0.03)
+        self.assertLess(result.seconds, 0.03)
+        self.assertTrue(result.timed_out)
+        self.assertEqual(result.ranked, candidates) # 維持檢索順序
+        self.assertEqual(model.calls, [])
+
+        reranker._loader.join()
+        result = reranker.rerank("q", candidates, budget_seconds=5)
+        self.assertFalse(result.timed_out)
+        self.assertEqual([chunk.id for chunk, _ in result.ranked], ['c2', 'c1', 'c0'])
+        self.assertLess(reranker._seconds_per_pair, 0.1)
+
+    def test_stale_estimate_still_scores_one_pair_and_recovers(self):
+        model = FakeCrossEncoder()
+        reranker = self._reranker(model)
+        reranker._seconds_per_pair = 10.0
+        result = reranker.rerank("q", self._candidates(5), budget_seconds=0.05)
+        self.assertEqual(model.calls, [1])
+        self.assertTrue(result.timed_out)
+        self.assertEqual(result.scored, 1)
+        self.assertLess(reranker._seconds_per_pair, 10.0)
+
+    def test_budget_limits_scored_candidates(self):
+        model = FakeCrossEncoder(seconds_per_pair=0.02)
+        reranker = self._reranker(model)
+        reranker._seconds_per_pair = 0.02
+        result = reranker.rerank("q", self._candidates(20), budget_seconds=0.1)
+        self.assertTrue(result.timed_out)
+        self.assertLess(result.scored, 20)
+        self.assertEqual([chunk.id for chunk, _ in result.ranked[result.scored:]],
+                         [f"c{i}" for i in range(result.scored, 20)])
+
+    def test_cached_scores_skip_the_model(self):
+        model = FakeCrossEncoder()
+        reranker = self._reranker(model)
+        reranker.rerank("Q ", self._candidates(3), budget_seconds=5)
+        result = reranker.rerank("q", self._candidates(3), budget_seconds=5)
+        self.assertEqual(result.cache_hits, 3)
+        self.assertEqual(sum(model.calls), 3)
+
+
+class FakeRedis:
+    def __init__(self):
+        self.hashes = {}
+
+    def hgetall(self, key):
+        return {field.encode(): str(value).encode() for field, value in self.hashes.get(key, {}).items()}
+
+    def pipeline(self):
+        return self
+
+    def delete(self, key):
+        self.hashes.pop(key, None)
+
+    def hset(self, key, mapping):
+        self.hashes.setdefault(key, {}).update(mapping)
+
+    def execute(self):
+        pass
+
+
+class MaintenanceCollection:
+    def __init__(self, name, metadatas=()):
+        self.name = name
+        self.metadatas = list(metadatas)
+        self.deleted = []
+
+    def count(self):
+        return len(self.metadatas) or 1
+
+    def get(self, include=(), limit=None, offset=0):
+        batch = self.metadatas[offset:offset + limit]
+        return {'ids': [str(index) for index in range(len(batch))], 'metadatas': batch}
+
+    def delete(self, where):
+        self.deleted.append(where)
+
+
+class MaintenanceClient:
+    def __init__(self, collections, on_get=None):
+        self.collections = {collection.name: collection for collection in collections}
+        self.on_get = on_get
+
+    def list_collections(self):
+        return list(self.collections)
+
+    def get_collection(self, name):
+        if self.on_get:
+            self.on_get()
+        return self.collections[name]
+
+    def delete_collection(self, name):
+        del self.collections[name]
+
+
+class MaintenanceTests(TestCase):
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        self.root = root
+        overrides = override_settings(
+            MEDIA_ROOT=os.path.join(root, 'media'),
+            RAG_LEXICAL_INDEX_DIR=os.path.join(root, 'lexical'),
+            RAG_QUANTIZED_INDEX_DIR=os.path.join(root, 'quantized'),
+            RAG_STREAM_UPLOAD_TMP_DIR=os.path.join(root, 'uploads'),
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        os.makedirs(os.path.join(root, 'chroma'))
+        self.redis = FakeRedis()
+        patcher = mock.patch.object(maintenance, 'get_redis', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _run(self, client, grace_seconds):
+        registry = SimpleNamespace(
+            chroma_path=os.path.join(self.root, 'chroma'), get_chroma_client=lambda: client,
+            evict_vector_store=lambda name: None,
+        )
+        return maintenance.run_maintenance(registry, vacuum=False, grace_seconds=grace_seconds)
+
+    def _index_file(self, document_id, age_seconds):
+        os.makedirs(settings.RAG_LEXICAL_INDEX_DIR, exist_ok=True)
+        path = lexical_index.index_path(document_id)
+        with open(path, 'wb') as f:
+            f.write(b"index")
+        stamp = time.time() - age_seconds
+        os.utime(path, (stamp, stamp))
+        return path
+
+    def test_collection_for_a_document_created_during_the_run_is_kept(self):
+        document_id = uuid.uuid4()
+
+        def create_document():
+            if not Document.objects.filter(id=document_id).exists():
+                Document.objects.create(id=document_id, file='documents/new.pdf', filename='new.pdf')
+
+        # 維護讀取文件快照後、開啟 Collection 時文件才建立
+        client = MaintenanceClient([MaintenanceCollection(str(document_id))], on_get=create_document)
+        report = self._run(client, grace_seconds=0)
+        self.assertIn(str(document_id), client.collections)
+        self.assertEqual(report['orphans']['collections'], [])
+
+    def test_orphan_collection_waits_for_the_grace_period(self):
+        name = str(uuid.uuid4())
+        client = MaintenanceClient([MaintenanceCollection(name)])
+        self._run(client, grace_seconds=3600)
+        self.assertIn(name, client.collections)
+        self.assertIn(f"collection:{name}", self.redis.hashes[maintenance.MAINTENANCE_ORPHANS_KEY])
+
+        # 第一次發現的時間超過寬限期後才回收
+        self.redis.hashes[maintenance.MAINTENANCE_ORPHANS_KEY][f"collection:{name}"] = time.time() - 7200
+        report = self._run(client, grace_seconds=3600)
+        self.assertNotIn(name, client.collections)
+        self.assertEqual([item['name'] for item in report['orphans']['collections']], [name])
+        self.assertEqual(self.redis.hashes.get(maintenance.MAINTENANCE_ORPHANS_KEY), None)
+
+    def test_orphan_shard_chunks_wait_for_the_grace_period(self):
+        source = str(uuid.uuid4())
+        shard = MaintenanceCollection(f"{settings.RAG_SHARED_COLLECTION_PREFIX}_0", [{'source_file_id': source}] * 3)
+        client = MaintenanceClient([shard])
+        self._run(client, grace_seconds=3600)
+        self.assertEqual(shard.deleted, [])
+        report = self._run(client, grace_seconds=0)
+        self.assertEqual(shard.deleted, [{'source_file_id': source}])
+        self.assertEqual(report['orphans']['shared_chunks'][0]['chunks'], 3)
+
+    def test_index_files_respect_grace_and_live_documents(self):
+        young, old, live = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+        young_path = self._index_file(young, age_seconds=10)
+        old_path = self._index_file(old, age_seconds=7200)
+        live_path = self._index_file(live, age_seconds=7200)
+
+        older_than = maintenance._older_than
+
+        def create_live_document(path, seconds):
+            # 掃描開始後才建立文件 (快照中沒有)
+            if path == live_path and not Document.objects.filter(id=live).exists():
+                Document.objects.create(id=live, file='documents/live.pdf', filename='live.pdf')
+            return older_than(path, seconds)
+
+        with mock.patch.object(maintenance, '_older_than', side_effect=create_live_document):
+            self._run(MaintenanceClient([]), grace_seconds=3600)
+        self.assertTrue(os.path.exists(young_path))
+        self.assertFalse(os.path.exists(old_path))
+        self.assertTrue(os.path.exists(live_path))
+
+
+class OllamaDeadlineTests(SimpleTestCase):
+    def _client(self, lines, delay):
+        def body():
+            for line in lines:
+                time.sleep(delay)
+                yield (json.dumps(line) + "\n").encode()
+
+        client = OllamaClient('http://ollama.test', 'model', timeout=30, max_parallel=1)
+        client._http = httpx.Client(
+            base_url='http://ollama.test', transport=httpx.MockTransport(lambda request: httpx.Response(200, content=body())),
+        )
+        self.addCleanup(client.close)
+        return client
+
+    def test_stream_without_deadline_reads_every_token(self):
+        client = self._client([{'response': 'a'}, {'response': 'b'}, {'done': True}], delay=0)
+        self.assertEqual(list(client.stream("prompt")), ['a', 'b'])
+
+    def test_slow_stream_stops_at_the_deadline(self):
+        client = self._client([{'response': str(i)} for i in range(50)] + [{'done': True}], delay=0.02)
+        tokens = []
+        started = time.monotonic()
+        with self.assertRaises(TimeoutError):
+            for token in client.stream("prompt", deadline=started + 0.1):
+                tokens.append(token)
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertLess(len(tokens), 50)
+        self.assertTrue(client._slots.acquire(blocking=False)) # 名額已歸還
+
+    def test_waiting_for_a_slot_respects_the_deadline(self):
+        client = self._client([{'done': True}], delay=0)
+        client._slots.acquire()
+        with self.assertRaises(TimeoutError):
+            next(client.stream("prompt", deadline=time.monotonic() + 0.05))
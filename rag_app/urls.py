@@ -1,12 +1,17 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import DocumentViewSet, QuestionAnswerViewSet, index_view
+from .views import DocumentViewSet, IngestBatchViewSet, QuestionAnswerViewSet, index_view, metrics_view, qa_stream_view, storage_health_view, worker_health_view
 
 router = DefaultRouter()
 router.register(r'documents', DocumentViewSet)
 router.register(r'qa', QuestionAnswerViewSet)
+router.register(r'ingest-batches', IngestBatchViewSet)
 
 urlpatterns = [
     path('', index_view, name='index'), # 為前端頁面新增路由
+    path('api/health/workers/', worker_health_view, name='worker-health'),
+    path('api/health/storage/', storage_health_view, name='storage-health'),
+    path('metrics', metrics_view, name='metrics'), # Prometheus 抓取端點
+    path('api/qa/<int:pk>/stream/', qa_stream_view, name='qa-stream'), # SSE 串流答案
     path('api/', include(router.urls)),
 ]
\ No newline at end of file
@@ -0,0 +1,43 @@
+import uuid
+from collections import namedtuple
+
+from django.conf import settings
+
+LAYOUT_PER_DOCUMENT = 'PER_DOCUMENT'
+LAYOUT_SHARED = 'SHARED'
+
+# collection_name：區塊所在的 Chroma Collection；where：查詢/刪除時的 metadata 過濾條件 (每文件一個 Collection 時為 None)
+IndexTarget = namedtuple('IndexTarget', ['collection_name', 'where'])
+
+
+def configured_layout():
+    layout = getattr(settings, 'RAG_VECTOR_STORE_LAYOUT', LAYOUT_PER_DOCUMENT)
+    if layout not in (LAYOUT_PER_DOCUMENT, LAYOUT_SHARED):
+        raise ValueError(f"不支援的向量庫配置: {layout}")
+    return layout
+
+
+def shard_collection_name(document_id):
+    shards = max(1, settings.RAG_SHARED_COLLECTION_SHARDS)
+    return f"{settings.RAG_SHARED_COLLECTION_PREFIX}_{uuid.UUID(str(document_id)).int % shards}"
+
+
+def index_target(document_id, layout):
+    """
+    回傳文件區塊的存放位置：每文件一個 Collection (名稱為文件ID)，或共用分片 Collection 加上 source_file_id 過濾。
+    """
+    if layout == LAYOUT_SHARED:
+        return IndexTarget(shard_collection_name(document_id), {'source_file_id': str(document_id)})
+    return IndexTarget(str(document_id), None)
+
+
+def delete_document_vectors(registry, document_id, layout):
+    """
+    刪除文件在指定配置下的所有向量。
+    """
+    target = index_target(document_id, layout)
+    if target.where is None:
+        registry.evict_vector_store(target.collection_name)
+        registry.get_chroma_client().delete_collection(name=target.collection_name)
+    else:
+        registry.get_vector_store(target.collection_name)._collection.delete(where=target.where)
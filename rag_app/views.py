@@ -1,16 +1,76 @@
-from rest_framework import viewsets, status
+from rest_framework import exceptions, viewsets, status
 from rest_framework.response import Response
-from rest_framework.decorators import action
-from .models import Document, QuestionAnswer
-from .serializers import DocumentSerializer, QuestionAnswerSerializer
-from .tasks import parse_and_vectorize_document_task, answer_question_with_rag_task, delete_document_data_task, delete_qa_record_task
-from django.shortcuts import render
+from rest_framework.decorators import action, api_view
+from .models import Document, IngestBatch, QuestionAnswer
+from .serializers import DocumentSerializer, IngestBatchSerializer, QuestionAnswerSerializer
+from .pagination import ConditionalListMixin, DocumentCursorPagination, QuestionAnswerCursorPagination
+from .tasks import parse_and_vectorize_document_task, ingest_batch_task, answer_question_with_rag_task, delete_document_data_task, delete_qa_record_task
+from .bulk_upload import SUPPORTED_EXTENSIONS, close_files, expand_uploaded_files, file_sha256, uploaded_file_matches_extension
+from .registry import read_worker_stats
+from .maintenance import read_report
+from .instrumentation import render_metrics
+from .embedding import get_embedding_engine
+from .semantic_search import semantic_search
+from . import answer_cache
+from .streaming import aiter_answer_events, iter_answer_events, iter_completed_answer_events
+from django.conf import settings
+from django.shortcuts import render, get_object_or_404
+from django.http import HttpResponse, StreamingHttpResponse
+from django.core.handlers.asgi import ASGIRequest
 from django.db import transaction
+from django.core.exceptions import ValidationError
+from django.utils import timezone
 import os # 引入 os 模組
+import uuid
+import redis
 
-class DocumentViewSet(viewsets.ModelViewSet):
+def _choices_param(request, name, choices):
+    # ?status=PENDING,ANSWERING 這類以逗號分隔的選項過濾；值不在選項中時回應 400
+    value = request.query_params.get(name)
+    if not value:
+        return None
+    values = {item.strip().upper() for item in value.split(',') if item.strip()}
+    invalid = values - {choice for choice, _ in choices}
+    if invalid:
+        raise exceptions.ValidationError({name: f"Invalid value: {', '.join(sorted(invalid))}."})
+    return values
+
+def _search_params(request):
+    # 語意搜尋的 ?q=、?k= 與 ?rerank=；不合法時回應 400
+    query = (request.query_params.get('q') or '').strip()
+    if not query:
+        raise exceptions.ValidationError({'q': "This field is required."})
+    if len(query) > settings.RAG_SEARCH_MAX_QUERY_CHARS:
+        raise exceptions.ValidationError({'q': f"Ensure this field has no more than {settings.RAG_SEARCH_MAX_QUERY_CHARS} characters."})
+    try:
+        k = int(request.query_params.get('k', settings.RAG_SEARCH_DEFAULT_K))
+    except ValueError:
+        raise exceptions.ValidationError({'k': "A valid integer is required."})
+    if not 1 <= k <= settings.RAG_SEARCH_MAX_K:
+        raise exceptions.ValidationError({'k': f"Must be between 1 and {settings.RAG_SEARCH_MAX_K}."})
+    rerank = (request.query_params.get('rerank') or '').lower() in ('1', 'true', 'yes')
+    return query, k, rerank
+
+def _search_response(request, documents):
+    query, k, rerank = _search_params(request)
+    result = semantic_search(documents, query, k, rerank=rerank)
+    return Response({'query': query, 'k': k, 'documents': len(documents), **result})
+
+class DocumentViewSet(ConditionalListMixin, viewsets.ModelViewSet):
     queryset = Document.objects.all().order_by('-uploaded_at')
     serializer_class = DocumentSerializer
+    pagination_class = DocumentCursorPagination
+    deferrable_fields = {
+        'processing_message': ('processing_message',),
+        'stage_timings': ('stage_timings',),
+    }
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        statuses = _choices_param(self.request, 'status', Document.STATUS_CHOICES)
+        if statuses:
+            queryset = queryset.filter(status__in=statuses)
+        return queryset
 
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
@@ -23,11 +83,75 @@ class DocumentViewSet(viewsets.ModelViewSet):
 
         return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
 
+    def perform_create(self, serializer):
+        serializer.save(content_hash=file_sha256(serializer.validated_data['file']))
+
+    @action(detail=False, methods=['post'], url_path='bulk')
+    def bulk_upload(self, request):
+        """
+        批次上傳多個檔案 (欄位 files，可重複；zip 壓縮檔會展開)。內容與既有文件相同的檔案略過，其餘建立文件並排入批次匯入。
+        """
+        files = request.FILES.getlist('files') or request.FILES.getlist('file')
+        if not files:
+            return Response({"detail": "files is required."}, status=status.HTTP_400_BAD_REQUEST)
+        accepted, skipped = expand_uploaded_files(files)
+        try:
+            return self._create_batch(accepted, skipped)
+        finally:
+            close_files(accepted)
+
+    def _create_batch(self, accepted, skipped):
+        if len(accepted) > settings.RAG_BULK_UPLOAD_MAX_FILES:
+            return Response({"detail": f"Too many files (max {settings.RAG_BULK_UPLOAD_MAX_FILES})."},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        hashed = [(name, file_obj, file_sha256(file_obj)) for name, file_obj in accepted]
+        # 失敗的文件不算重複，允許重新上傳
+        known = dict(
+            Document.objects.filter(content_hash__in={content_hash for _, _, content_hash in hashed})
+            .exclude(status='FAILED').values_list('content_hash', 'id')
+        )
+        documents = []
+        with transaction.atomic():
+            batch = IngestBatch.objects.create()
+            for name, file_obj, content_hash in hashed:
+                if content_hash in known:
+                    skipped.append({'filename': name, 'reason': 'duplicate', 'duplicate_of': str(known[content_hash])})
+                    continue
+                document = Document(filename=name, content_hash=content_hash, ingest_batch=batch)
+                document.file.save(name, file_obj, save=False)
+                document.save()
+                known[content_hash] = document.id
+                documents.append(document)
+            batch.total_documents = len(documents)
+            batch.duplicate_files = sum(1 for item in skipped if item['reason'] == 'duplicate')
+            batch.skipped_files = skipped
+            if not documents:
+                batch.finished_at = timezone.now()
+            batch.save()
+            transaction.on_commit(lambda: self._dispatch_batch(batch, documents))
+
+        serializer = IngestBatchSerializer(batch, context=self.get_serializer_context())
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+    @staticmethod
+    def _dispatch_batch(batch, documents):
+        # 小文件每 RAG_BULK_INGEST_DOCUMENTS_PER_TASK 個合併成一個批次匯入任務；大文件自己就能湊滿嵌入批次，交給單一文件任務
+        small = []
+        for document in documents:
+            if document.file.size <= settings.RAG_BULK_INGEST_COALESCE_MAX_BYTES:
+                small.append(str(document.id))
+            else:
+                parse_and_vectorize_document_task.delay(str(document.id))
+        per_task = max(1, settings.RAG_BULK_INGEST_DOCUMENTS_PER_TASK)
+        for start in range(0, len(small), per_task):
+            ingest_batch_task.delay(str(batch.id), small[start:start + per_task])
+
     def destroy(self, request, *args, **kwargs):
         # 覆寫 destroy 方法，以便在 Celery 中處理刪除邏輯
         instance = self.get_object()
         document_id = str(instance.id)
-        file_path = instance.file.path # 獲取文件路徑
+        file_path = instance.file.path if instance.file else None # 獲取文件路徑 (由不含原始檔案的快照匯入時為 None)
 
         # 啟動 Celery 任務來異步處理刪除操作
         delete_document_data_task.delay(document_id, file_path)
@@ -35,19 +159,155 @@ class DocumentViewSet(viewsets.ModelViewSet):
         # 立即返回成功響應，但實際刪除操作在後台執行
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+    @action(detail=True, methods=['post'], url_path='replace')
+    def replace_file(self, request, pk=None):
+        """
+        以新檔案取代文件內容：保留文件ID與問答歷史，背景任務只重新嵌入有變動的區塊。
+        """
+        document = self.get_object()
+        new_file = request.FILES.get('file')
+        if not new_file:
+            return Response({"detail": "file is required."}, status=status.HTTP_400_BAD_REQUEST)
+        extension = os.path.splitext(new_file.name)[1].lower()
+        if extension not in SUPPORTED_EXTENSIONS or not uploaded_file_matches_extension(new_file):
+            return Response({"detail": f"Unsupported file type or content does not match its extension: {new_file.name}."},
+                            status=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        with transaction.atomic():
+            # 鎖住文件列再檢查狀態：同時送出的兩次取代只有一次會排入向量化任務
+            document = Document.objects.select_for_update().get(pk=document.pk)
+            # 已排入 (UPLOADED) 或正在執行 (PROCESSING) 的向量化任務完成前不可再取代，避免兩個任務同時處理同一個文件
+            if document.status in ('UPLOADED', 'PROCESSING'):
+                return Response({"detail": "Document is still being processed. Please try again later."},
+                                status=status.HTTP_409_CONFLICT)
+
+            old_path = document.file.path if document.file else None
+            document.file.save(new_file.name, new_file, save=False)
+            document.filename = new_file.name
+            document.content_hash = file_sha256(new_file)
+            document.status = 'UPLOADED'
+            document.processing_message = '文件已更新，等待重新向量化...'
+            document.total_pages = None
+            document.processed_pages = 0
+            document.processed_chunks = 0
+            document.save()
+            transaction.on_commit(lambda: parse_and_vectorize_document_task.delay(str(document.id)))
+        if old_path and old_path != document.file.path and os.path.exists(old_path):
+            os.remove(old_path)
 
-class QuestionAnswerViewSet(viewsets.ModelViewSet):
+        serializer = self.get_serializer(document)
+        return Response(serializer.data, status=status.HTTP_202_ACCEPTED)
+
+    @action(detail=True, methods=['get'], url_path='search')
+    def search(self, request, pk=None):
+        """
+        在單一文件中同步語意搜尋 (?q=&k=)，直接回傳排序後的區塊、分數與頁碼，不經過 Celery 也不生成答案。
+        """
+        document = self.get_object()
+        if document.status != 'COMPLETED':
+            return Response({"detail": "Document not yet processed or failed. Please wait or check document status."},
+                            status=status.HTTP_400_BAD_REQUEST)
+        return _search_response(request, [document])
+
+    @action(detail=False, methods=['get'], url_path='search', url_name='search-documents')
+    def search_documents(self, request):
+        """
+        跨文件同步語意搜尋：?documents= 以逗號分隔 (或重複) 指定文件ID，未指定時搜尋所有已處理完成的文件。
+        """
+        document_ids = [
+            doc_id.strip() for value in request.query_params.getlist('documents') for doc_id in value.split(',') if doc_id.strip()
+        ]
+        queryset = Document.objects.only('id', 'status', 'index_layout')
+        if not document_ids:
+            documents = list(queryset.filter(status='COMPLETED'))
+            if not documents:
+                return Response({"detail": "No processed documents available."}, status=status.HTTP_400_BAD_REQUEST)
+            return _search_response(request, documents)
+
+        document_ids = list(dict.fromkeys(document_ids))
+        try:
+            documents = list(queryset.filter(id__in=document_ids))
+        except ValidationError:
+            return Response({"detail": "Invalid document id."}, status=status.HTTP_400_BAD_REQUEST)
+        if len(documents) != len(document_ids):
+            return Response({"detail": "Document not found."}, status=status.HTTP_404_NOT_FOUND)
+        if any(document.status != 'COMPLETED' for document in documents):
+            return Response({"detail": "Document not yet processed or failed. Please wait or check document status."},
+                            status=status.HTTP_400_BAD_REQUEST)
+        return _search_response(request, documents)
+
+
+class IngestBatchViewSet(viewsets.ReadOnlyModelViewSet):
+    queryset = IngestBatch.objects.all().prefetch_related('documents').order_by('-created_at')
+    serializer_class = IngestBatchSerializer
+
+
+class QuestionAnswerViewSet(ConditionalListMixin, viewsets.ModelViewSet):
     queryset = QuestionAnswer.objects.all().order_by('-created_at')
     serializer_class = QuestionAnswerSerializer
+    pagination_class = QuestionAnswerCursorPagination
+    deferrable_fields = {
+        'answer': ('answer',),
+        'source_documents': ('source_documents', 'cited_documents'),
+        'error_message': ('error_message',),
+        'stage_timings': ('stage_timings',),
+    }
+    select_related_fields = {'document_filename': 'document'}
+    related_version_fields = {'document_filename': 'document__updated_at'} # 取代檔案會改變文件名稱
+    prefetch_related_fields = {'documents': 'documents'}
+
+    def get_queryset(self):
+        # 過濾條件：?document=<文件ID>、?status=、?scope= (列表輪詢只取需要的資料)
+        queryset = super().get_queryset()
+        document_id = self.request.query_params.get('document')
+        if document_id:
+            try:
+                queryset = queryset.filter(document_id=uuid.UUID(document_id))
+            except ValueError:
+                raise exceptions.ValidationError({'document': "Invalid document id."})
+        statuses = _choices_param(self.request, 'status', QuestionAnswer.STATUS_CHOICES)
+        if statuses:
+            queryset = queryset.filter(status__in=statuses)
+        scopes = _choices_param(self.request, 'scope', QuestionAnswer.SCOPE_CHOICES)
+        if scopes:
+            queryset = queryset.filter(scope__in=scopes)
+        return queryset
 
     def create(self, request, *args, **kwargs):
         document_id = request.data.get('document')
+        document_ids = request.data.getlist('documents') if hasattr(request.data, 'getlist') else request.data.get('documents')
+        scope = (request.data.get('scope') or '').upper()
         question = request.data.get('question')
 
-        if not document_id or not question:
-            return Response({"detail": "document_id and question are required."},
+        if not question or not (document_id or document_ids or scope == 'CORPUS'):
+            return Response({"detail": "question and one of document, documents or scope=corpus are required."},
                             status=status.HTTP_400_BAD_REQUEST)
 
+        # 全庫提問：在所有已處理完成的文件中檢索
+        if scope == 'CORPUS':
+            if not Document.objects.filter(status='COMPLETED').exists():
+                return Response({"detail": "No processed documents available."},
+                                status=status.HTTP_400_BAD_REQUEST)
+            return self._create_multi_document_qa(question, 'CORPUS', [])
+
+        # 多文件提問：只有一個文件時視同單一文件提問 (可使用答案快取)
+        if document_ids:
+            if isinstance(document_ids, str):
+                document_ids = [document_ids]
+            document_ids = list(dict.fromkeys(str(doc_id) for doc_id in document_ids))
+            try:
+                documents = list(Document.objects.filter(id__in=document_ids))
+            except ValidationError:
+                return Response({"detail": "Invalid document id."}, status=status.HTTP_400_BAD_REQUEST)
+            if len(documents) != len(document_ids):
+                return Response({"detail": "Document not found."},
+                                status=status.HTTP_404_NOT_FOUND)
+            if any(document.status != 'COMPLETED' for document in documents):
+                return Response({"detail": "Document not yet processed or failed. Please wait or check document status."},
+                                status=status.HTTP_400_BAD_REQUEST)
+            if len(documents) > 1:
+                return self._create_multi_document_qa(question, 'DOCUMENTS', documents)
+            document_id = document_ids[0]
+
         try:
             document = Document.objects.get(id=document_id)
             if document.status != 'COMPLETED':
@@ -57,6 +317,23 @@ class QuestionAnswerViewSet(viewsets.ModelViewSet):
             return Response({"detail": "Document not found."},
                             status=status.HTTP_404_NOT_FOUND)
 
+        # 答案快取命中時直接同步回傳，不經過 Celery
+        cached = answer_cache.lookup(
+            document, question,
+            embedder=get_embedding_engine() if settings.RAG_ANSWER_CACHE_SEMANTIC_IN_WEB else None,
+        )
+        if cached is not None:
+            qa_instance = QuestionAnswer.objects.create(
+                document=document,
+                question=question,
+                answer=cached.answer,
+                source_documents=cached.source_documents,
+                cache_hit=True,
+                status='COMPLETED'
+            )
+            serializer = self.get_serializer(qa_instance)
+            return Response(serializer.data, status=status.HTTP_201_CREATED)
+
         qa_instance = QuestionAnswer.objects.create(
             document=document,
             question=question,
@@ -68,6 +345,23 @@ class QuestionAnswerViewSet(viewsets.ModelViewSet):
 
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
+    def _create_multi_document_qa(self, question, scope, documents):
+        qa_instance = QuestionAnswer.objects.create(
+            document=documents[0] if documents else None,
+            question=question,
+            scope=scope,
+            status='PENDING'
+        )
+        if documents:
+            qa_instance.documents.set(documents)
+        serializer = self.get_serializer(qa_instance)
+
+        answer_question_with_rag_task.delay(
+            str(qa_instance.id), str(documents[0].id) if documents else None, question
+        )
+
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
     # 針對 QuestionAnswer 實例的刪除
     def destroy(self, request, *args, **kwargs):
         instance = self.get_object()
@@ -76,6 +370,52 @@ class QuestionAnswerViewSet(viewsets.ModelViewSet):
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
+@api_view(['GET'])
+def worker_health_view(request):
+    # 彙整各 Worker 進程最近回報的常駐資源統計 (命中率、預熱時間等)
+    try:
+        workers = read_worker_stats()
+    except Exception as e:
+        return Response({"detail": f"無法讀取 Worker 統計: {e}"}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    return Response({"workers": workers})
+
+
+@api_view(['GET'])
+def storage_health_view(request):
+    # 最近一次向量庫維護的報告：回收的孤兒資料、缺少向量的文件與每個文件的索引大小
+    try:
+        report = read_report()
+    except redis.RedisError as e:
+        return Response({"detail": f"無法讀取維護報告: {e}"}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    if report is None:
+        return Response({"detail": "尚未執行向量庫維護。"}, status=status.HTTP_404_NOT_FOUND)
+    return Response(report)
+
+
+def metrics_view(request):
+    # Prometheus 抓取端點：各流程、各階段的延遲直方圖 (由所有 Web/Worker 進程寫入 Redis 彙整)
+    try:
+        body = render_metrics()
+    except redis.RedisError as e:
+        return HttpResponse(f"# 無法讀取統計: {e}\n", status=503, content_type='text/plain')
+    return HttpResponse(body, content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def qa_stream_view(request, pk):
+    # 以 Server-Sent Events 串流答案：先送參考來源，再逐一送出 LLM token，最後送出 done/error
+    qa_instance = get_object_or_404(QuestionAnswer, pk=pk)
+    if qa_instance.status in ('COMPLETED', 'FAILED'):
+        events = iter_completed_answer_events(qa_instance)
+    elif isinstance(request, ASGIRequest):
+        events = aiter_answer_events(qa_instance.id) # ASGI 下等待 Redis 時不佔用執行緒
+    else:
+        events = iter_answer_events(qa_instance.id)
+
+    response = StreamingHttpResponse(events, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no' # 避免反向代理緩衝串流
+    return response
+
 
 def index_view(request):
     return render(request, 'rag_app/index.html')
\ No newline at end of file
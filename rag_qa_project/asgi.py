@@ -13,4 +13,11 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'rag_qa_project.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# 需在 Django 初始化之後匯入；串流上傳的路徑由外層直接處理，其餘請求交給 Django
+from rag_app.registry import warm_up_web_process  # noqa: E402
+from rag_app.streaming_upload import StreamingUploadApplication  # noqa: E402
+
+application = StreamingUploadApplication(django_application)
+warm_up_web_process()
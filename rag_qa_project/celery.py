@@ -1,9 +1,13 @@
 import os
 from celery import Celery
+from celery.signals import celeryd_init, worker_init
+from kombu import Queue
 
 # Set the default Django settings module for the 'celery' program.
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'rag_qa_project.settings')
 
+from django.conf import settings  # noqa: E402
+
 app = Celery('rag_qa_project')
 
 # Using a string here means the worker doesn't have to serialize
@@ -12,9 +16,40 @@ app = Celery('rag_qa_project')
 #   should have a `CELERY_` prefix.
 app.config_from_object('django.conf:settings', namespace='CELERY')
 
+# 佇列依 RAG_CELERY_QUEUE_PROFILES 的順序宣告 (answer 在前)，未指定 -Q 的 Worker 會消化所有佇列
+app.conf.task_queues = [Queue(name, routing_key=name) for name in settings.RAG_CELERY_QUEUE_PROFILES]
+
+# 以 RAG_WORKER_PROFILE 選擇這個 Worker 負責的佇列，並套用該佇列的 pool、並行數與預取數
+WORKER_PROFILE = os.environ.get('RAG_WORKER_PROFILE')
+if WORKER_PROFILE:
+    if WORKER_PROFILE not in settings.RAG_CELERY_QUEUE_PROFILES:
+        raise ValueError(f"不支援的 Worker 設定檔: {WORKER_PROFILE}")
+    _profile = settings.RAG_CELERY_QUEUE_PROFILES[WORKER_PROFILE]
+    app.conf.worker_concurrency = _profile['concurrency']
+    app.conf.worker_prefetch_multiplier = _profile['prefetch_multiplier']
+    if 'pool' in _profile:
+        app.conf.worker_pool = _profile['pool']
+
+
+@celeryd_init.connect
+def select_profile_queue(sender=None, instance=None, **kwargs):
+    # 命令列的 -Q 會在之後覆寫這裡的選擇
+    if WORKER_PROFILE:
+        instance.app.amqp.queues.select([WORKER_PROFILE])
+
+@worker_init.connect
+def preload_worker_modules(sender=None, **kwargs):
+    # 在 Worker 主進程 fork 子進程之前匯入這個 Worker 會用到的重量級套件 (不載入模型)，子進程共用已匯入的模組
+    if not settings.RAG_WORKER_PRELOAD:
+        return
+    from rag_app.registry import preload_modules, worker_warm_up_components
+
+    modules, seconds = preload_modules(worker_warm_up_components())
+    print(f"Worker 主進程已預先匯入 {', '.join(modules) or '(無)'}，耗時 {seconds:.2f} 秒。")
+
 # Load task modules from all registered Django app configs.
 app.autodiscover_tasks()
 
 @app.task(bind=True, ignore_result=True)
 def debug_task(self):
-    print(f'Request: {self.request!r}')
\ No newline at end of file
+    print(f'Request: {self.request!r}')
@@ -134,4 +134,191 @@ CELERY_RESULT_BACKEND = 'redis://127.0.0.1:6379/1' # Celery 結果儲存
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
-CELERY_TASK_TRACK_STARTED = True # 追蹤任務開始狀態
\ No newline at end of file
+CELERY_TASK_TRACK_STARTED = True # 追蹤任務開始狀態
+
+# Celery 佇列：問答 (answer)、文件匯入 (ingest) 與維護 (maintenance，刪除與統計) 各自一個佇列，大量匯入不會拖住互動的問答
+# 每個佇列的 Worker 並行數、預取數、任務時間限制 (秒)、優先順序 (Redis 以數字小者優先，0~9)
+# 與啟動時預熱的資源 (chroma / embedding / llm / parsing / rerank，見 RAG_WORKER_WARM_UP)
+# 以 RAG_WORKER_PROFILE=<佇列名稱> 啟動的 Worker 只消化該佇列並套用其並行數與預取數 (命令列參數優先)
+RAG_CELERY_QUEUE_PROFILES = {
+    # 問答以執行緒池運行：等待 Ollama 時不佔用 CPU，且同一進程內的問答可以在微批次層會合。
+    # threads pool 不會執行 soft_time_limit / time_limit：問答的時間限制由任務自己以 RAG_ANSWER_TIME_LIMIT 執行
+    # (Ollama 請求的等待與讀取受剩餘時間限制，生成迴圈逾時即標記為失敗)；此處的值只在改用 prefork 時生效
+    'answer': {'pool': 'threads', 'concurrency': 16, 'prefetch_multiplier': 1, 'soft_time_limit': 360, 'time_limit': 420, 'priority': 0,
+               'warm_up': ('chroma', 'embedding', 'llm', 'rerank')},
+    'ingest': {'concurrency': 2, 'prefetch_multiplier': 1, 'soft_time_limit': 1800, 'time_limit': 1900, 'priority': 6,
+               'warm_up': ('chroma', 'embedding', 'parsing')},
+    'maintenance': {'concurrency': 2, 'prefetch_multiplier': 4, 'soft_time_limit': 300, 'time_limit': 360, 'priority': 3,
+                    'warm_up': ('chroma',)},
+}
+RAG_CELERY_TASK_QUEUES = {
+    'rag_app.tasks.answer_question_with_rag_task': 'answer',
+    'rag_app.tasks.parse_and_vectorize_document_task': 'ingest',
+    'rag_app.tasks.ingest_batch_task': 'ingest',
+    'rag_app.tasks.delete_document_data_task': 'maintenance',
+    'rag_app.tasks.delete_qa_record_task': 'maintenance',
+    'rag_app.tasks.publish_worker_stats_task': 'maintenance',
+    'rag_app.tasks.vector_store_maintenance_task': 'maintenance',
+}
+CELERY_TASK_DEFAULT_QUEUE = 'maintenance' # 未列出的任務 (例如 debug_task)
+CELERY_TASK_ROUTES = {task: {'queue': queue} for task, queue in RAG_CELERY_TASK_QUEUES.items()}
+RAG_ANSWER_TIME_LIMIT = RAG_CELERY_QUEUE_PROFILES['answer']['soft_time_limit'] # 秒，問答任務自行執行的期限 (從任務開始計算)
+CELERY_TASK_ANNOTATIONS = {
+    task: {key: RAG_CELERY_QUEUE_PROFILES[queue][key] for key in ('soft_time_limit', 'time_limit', 'priority')}
+    for task, queue in RAG_CELERY_TASK_QUEUES.items()
+}
+# 同一個 Worker 消化多個佇列時 (例如開發環境只啟動一個 Worker)，依 task_queues 的順序優先取問答佇列
+CELERY_BROKER_TRANSPORT_OPTIONS = {'queue_order_strategy': 'priority'}
+
+# RAG Configuration
+# 嵌入模型設定：backend 可為 'torch' (sentence-transformers) 或 'onnx' (ONNX Runtime CPU 推論)
+RAG_EMBEDDING_MODEL_NAME = 'sentence-transformers/all-MiniLM-L6-v2'
+RAG_EMBEDDING_BACKEND = 'torch'
+RAG_EMBEDDING_BATCH_SIZE = 64 # 每批送入模型的區塊數
+RAG_EMBEDDING_NUM_WORKERS = min(4, os.cpu_count() or 1) # 嵌入進程池大小 (1 表示不使用進程池)
+RAG_INGEST_FLUSH_CHUNKS = 256 # 逐頁解析時累積多少區塊就嵌入並寫入一次 (同時是斷點續傳與進度更新的粒度)
+RAG_PDF_PARSE_WORKERS = os.cpu_count() or 1 # PDF 並行解析的進程數 (1 表示在任務進程內逐頁解析)
+RAG_PDF_PAGES_PER_TASK = 16 # 每個解析工作負責的連續頁數
+RAG_PDF_PARALLEL_MIN_PAGES = 50 # 頁數少於此值時不啟動進程池 (啟動成本大於收益)
+RAG_INGEST_PAGES_PER_TASK = 200 # 單一匯入任務最多處理的頁數，其餘頁面交給接續的任務 (0 表示不切分)
+
+# 嵌入快取：以 (模型名稱, 區塊文字 SHA-256) 為鍵，文件重新上傳或修訂時只需嵌入變動的區塊
+RAG_EMBEDDING_CACHE_ENABLED = True
+RAG_EMBEDDING_CACHE_DIR = os.path.join(BASE_DIR, 'embedding_cache')
+RAG_EMBEDDING_CACHE_MAX_ENTRIES = 200000 # 超過後以 LRU 淘汰 (每個項目約 1.5 KB)
+
+# Ollama LLM：由每個 Worker 進程共用一個保持連線的客戶端
+RAG_OLLAMA_BASE_URL = 'http://localhost:11434'
+RAG_OLLAMA_MODEL = 'llama3.2' # 確保您在 Ollama 中實際運行的 Llama 3.2 模型名稱
+RAG_OLLAMA_KEEP_ALIVE = '30m' # 讓 Ollama 將模型常駐記憶體的時間
+RAG_OLLAMA_TIMEOUT = 300 # 秒
+RAG_OLLAMA_NUM_PARALLEL = 4 # 每個 Worker 進程同時送往 Ollama 的生成請求數，應與 Ollama 的 OLLAMA_NUM_PARALLEL 一致
+
+# Worker 進程常駐資源
+# torch、sentence-transformers、chromadb 與 LangChain 都在第一次使用時才匯入，Web 進程與管理命令不會載入它們
+# (`python manage.py measure_startup` 比較 Web 與 Worker 進程的冷啟動時間與 RSS)
+RAG_WORKER_WARM_UP = True # Worker 子進程啟動時預熱設定檔列出的資源 (False 表示全部延後到第一次使用)
+RAG_WORKER_PRELOAD = True # Worker 主進程在 fork 子進程前先匯入會用到的套件 (不載入模型)，子進程共用已匯入的模組
+RAG_VECTOR_STORE_POOL_SIZE = 32 # 每個 Worker 進程最多保留的向量庫 handle 數 (LRU)
+RAG_REDIS_URL = 'redis://127.0.0.1:6379/2' # Worker 統計等執行期資料
+RAG_WORKER_STATS_TTL = 300 # 秒，Worker 統計在 Redis 中的保留時間
+RAG_ANSWER_LATENCY_SAMPLES = 1000 # 每個 Worker 進程保留最近幾筆問答延遲，用於計算 p50/p95 與吞吐量
+
+# 階段計時：每次向量化/問答的各階段秒數記錄在 Document / QuestionAnswer 的 stage_timings，並送出 OpenTelemetry span
+# 與寫入 Redis 中的直方圖 (GET /metrics，Prometheus 文字格式)
+RAG_OTEL_EXPORTER_ENDPOINT = None # 例如 'http://localhost:4317' (OTLP gRPC)；None 表示不匯出 span
+RAG_OTEL_SERVICE_NAME = 'rag-document-qa'
+RAG_METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 900) # 秒
+
+# 文件快照：以 `python manage.py export_snapshots` / `import_snapshots` 在節點之間複製已向量化的文件 (區塊、metadata 與嵌入)，
+# 新節點直接載入向量庫，不必重新解析與計算嵌入；匯入端的 RAG_EMBEDDING_MODEL_NAME 必須與匯出端相同
+RAG_SNAPSHOT_DIR = os.path.join(BASE_DIR, 'snapshots') # 預設的快照輸出目錄
+
+# 向量庫維護：比對 Document 與 ChromaDB Collection、共用分片中的區塊、倒排/量化索引與 media 檔案，回收孤兒資料，
+# chroma.sqlite3 可回收的空間夠多時 VACUUM，並回報每個文件的索引大小 (定期執行需另外啟動 `celery -A rag_qa_project beat`)
+RAG_MAINTENANCE_INTERVAL_SECONDS = 24 * 3600 # Celery beat 執行 vector_store_maintenance_task 的間隔
+RAG_MAINTENANCE_ORPHAN_GRACE_SECONDS = 3600 # 孤兒檔案與目錄至少存在這麼久才回收 (避免清掉正在上傳或寫入的檔案)
+RAG_MAINTENANCE_VACUUM_MIN_FREE_BYTES = 256 * 1024 * 1024 # chroma.sqlite3 可回收的空頁超過此大小才 VACUUM (None 表示不自動 VACUUM)
+RAG_MAINTENANCE_SCAN_BATCH_SIZE = 5000 # 掃描共用分片 metadata 時每次讀取的區塊數
+RAG_MAINTENANCE_TIME_LIMIT = 3600 # 秒，維護任務的時間限制 (同時是避免重複執行的 Redis 鎖的期限)
+CELERY_BEAT_SCHEDULE = {
+    'vector-store-maintenance': {
+        'task': 'rag_app.tasks.vector_store_maintenance_task',
+        'schedule': RAG_MAINTENANCE_INTERVAL_SECONDS,
+    },
+}
+# 維護需要掃描所有 Collection，不套用 maintenance 佇列較短的時間限制
+CELERY_TASK_ANNOTATIONS['rag_app.tasks.vector_store_maintenance_task'].update(
+    soft_time_limit=RAG_MAINTENANCE_TIME_LIMIT, time_limit=RAG_MAINTENANCE_TIME_LIMIT + 60,
+)
+
+# 問答微批次：短時間窗口內到達的問題合併計算嵌入並一起檢索，相同且仍在生成中的問題共用同一次生成
+# 需以 threads pool 運行問答 Worker (見 RAG_CELERY_QUEUE_PROFILES['answer'])；設為 False 可比較有無微批次的延遲與吞吐量
+RAG_ANSWER_BATCHING_ENABLED = True
+RAG_ANSWER_BATCH_WINDOW_MS = 20 # 進程內有其他問答進行時，第一個問題等待其他問題的時間
+RAG_ANSWER_BATCH_MAX_SIZE = 32 # 一次合併計算的問題數上限
+
+# 答案快取：以文件為範圍，先精確比對正規化問題，再以問題嵌入做語意比對
+RAG_ANSWER_CACHE_ENABLED = True
+RAG_ANSWER_CACHE_SIMILARITY_THRESHOLD = 0.95 # 餘弦相似度門檻
+RAG_ANSWER_CACHE_MAX_ENTRIES_PER_DOCUMENT = 500
+RAG_ANSWER_CACHE_SEMANTIC_IN_WEB = False # Web 進程是否也計算問題嵌入做語意比對 (預設只做精確比對，語意比對交給已載入模型的 Worker；開啟時 Web 進程需載入嵌入模型)
+
+# 答案串流 (SSE)：Worker 將 token 寫入 Redis Stream，/api/qa/<id>/stream/ 轉送給瀏覽器
+RAG_STREAM_TTL = 600 # 秒，串流事件在 Redis 中的保留時間
+RAG_STREAM_TIMEOUT = 600 # 秒，SSE 連線等待答案的上限
+RAG_STREAM_HEARTBEAT_SECONDS = 15 # 無事件時送出 keep-alive 註解的間隔
+
+# 向量庫配置：'PER_DOCUMENT' 每文件一個 Collection；'SHARED' 所有區塊放在共用的分片 Collection，以 source_file_id 過濾
+# 既有文件可用 `python manage.py migrate_vector_layout --to SHARED` 轉換
+RAG_VECTOR_STORE_LAYOUT = 'PER_DOCUMENT'
+RAG_SHARED_COLLECTION_PREFIX = 'rag_chunks'
+RAG_SHARED_COLLECTION_SHARDS = 4 # 依文件ID分散到的共用 Collection 數量 (設定後請勿任意變更)
+
+# 向量檢索後端：'chroma' 直接查詢 Chroma 的 HNSW 索引；'quantized' 以每文件的量化向量索引 (memory-map 的 numpy 陣列) 檢索，
+# 先以量化碼估計距離取候選，再以精確的浮點向量重新排序，區塊文字與 metadata 仍由 Chroma 提供 (尚無量化索引的文件自動改查 Chroma)
+# 既有文件可用 `python manage.py build_quantized_index` 補建，並以 --evaluate 比較與 Chroma 結果的 recall@k
+RAG_VECTOR_SEARCH_BACKEND = 'chroma'
+RAG_QUANTIZED_INDEX_DIR = os.path.join(BASE_DIR, 'quantized_index')
+RAG_QUANTIZATION = 'int8' # 'int8' (約 1/4 記憶體) 或 'binary' (約 1/32 記憶體，需要較多的重新排序候選)
+RAG_QUANTIZED_RERANK_FACTOR = {'int8': 4, 'binary': 20} # 取 k 的幾倍候選以精確向量重新排序
+RAG_QUANTIZED_RERANK_DTYPE = 'float16' # 量化索引中重新排序向量的型別 ('float16' 或 'float32')，查詢時只讀取候選區塊的列
+RAG_QUANTIZED_COARSE_MIN_VECTORS = 4096 # 區塊數達到此值時建立 k-means 粗分群 (IVF)，查詢時只掃描最近的幾群
+RAG_QUANTIZED_NPROBE = 16 # 每次查詢掃描的群數
+RAG_QUANTIZED_INDEX_CACHE_SIZE = 64 # 每個進程保留開啟的文件量化索引數 (LRU)
+
+# 列表 API (/api/documents/、/api/qa/)：cursor 分頁，可用 ?fields= 只取需要的欄位，並以 ETag 支援條件式 GET
+RAG_API_PAGE_SIZE = 20 # 預設每頁筆數 (可用 ?page_size= 調整)
+RAG_API_MAX_PAGE_SIZE = 200
+
+# 多文件/全庫提問
+RAG_RETRIEVAL_MAX_WORKERS = min(16, (os.cpu_count() or 1) * 2) # 並行查詢向量庫的執行緒數
+
+# 問答 Context 組合：多取候選區塊，去除分塊重疊造成的重複文字、合併同頁相鄰的區塊，並以 MMR 挑選多樣的區塊填滿 token 預算
+# 設為 False 時沿用直接貼上前 RAG_RETRIEVAL_TOP_K 個區塊原文的做法
+RAG_RETRIEVAL_TOP_K = 5
+RAG_CONTEXT_BUILDER_ENABLED = True
+RAG_CONTEXT_TOKEN_BUDGET = 1000 # Prompt 中 Context 的 token 上限 (估計值)
+RAG_CONTEXT_CANDIDATES = 20 # 檢索的候選區塊數
+RAG_CONTEXT_MMR_LAMBDA = 0.7 # MMR 中相關性的權重 (1 表示只看相關性，越小越重視多樣性)
+RAG_CONTEXT_CHARS_PER_TOKEN = 4 # 估計 token 數時，非中日韓文字每幾個字元算一個 token
+
+# Cross-encoder 重新排序：檢索多取候選，以 cross-encoder 在 CPU 上為 (問題, 區塊) 重新評分，只把最相關的區塊交給 Context 組合與生成
+# 每個問題有固定的時間預算，用完時尚未評分的候選維持原本的檢索順序
+RAG_RERANK_ENABLED = False
+RAG_RERANK_MODEL_NAME = 'cross-encoder/ms-marco-MiniLM-L-6-v2'
+RAG_RERANK_CANDIDATES = 50 # 重新排序的候選區塊數 (之後取前 RAG_CONTEXT_CANDIDATES 或 RAG_RETRIEVAL_TOP_K 個)
+RAG_RERANK_BATCH_SIZE = 16 # 每批評分的 (問題, 區塊) 對數
+RAG_RERANK_MAX_LENGTH = 256 # 每對輸入的 token 上限 (超過截斷)
+RAG_RERANK_BUDGET_MS = 300 # 每個問題重新排序的時間預算 (毫秒，含快取查詢)
+RAG_RERANK_CACHE_SIZE = 20000 # 進程內保留的 (問題, 區塊) 分數筆數
+
+# 語意搜尋 API：GET /api/documents/<id>/search/?q= 與 /api/documents/search/?q=，同步回傳排序後的區塊，不經過 Celery 也不呼叫 LLM
+# 嵌入模型與 ChromaDB 客戶端常駐在 Web 進程內；可用 `python manage.py benchmark_rag --search-queries` 量測延遲
+RAG_SEARCH_DEFAULT_K = 10
+RAG_SEARCH_MAX_K = 50
+RAG_SEARCH_MAX_QUERY_CHARS = 1000
+RAG_SEARCH_WARM_UP_IN_WEB = False # True 時 Web 進程啟動時就載入嵌入模型並建立 ChromaDB 客戶端 (每個 Web 進程各一份模型；預設由第一個搜尋請求載入)
+RAG_SEARCH_RERANK_BUDGET_MS = 30 # ?rerank=1 時 cross-encoder 的時間預算 (毫秒，需啟用 RAG_RERANK_ENABLED)
+RAG_SEARCH_LATENCY_TARGET_MS = 50 # 基準測試中 p95 延遲的目標
+
+# 混合檢索：BM25 關鍵字倒排索引 + 向量檢索，以 RRF (Reciprocal Rank Fusion) 融合
+# 既有文件可用 `python manage.py build_lexical_index` 補建倒排索引
+RAG_HYBRID_SEARCH_ENABLED = True
+RAG_LEXICAL_INDEX_DIR = os.path.join(BASE_DIR, 'lexical_index')
+RAG_LEXICAL_INDEX_CACHE_SIZE = 64 # 每個進程保留在記憶體中的文件倒排索引數 (LRU)
+RAG_HYBRID_CANDIDATES = 20 # 每一路檢索取回的候選區塊數
+RAG_HYBRID_RRF_K = 60 # RRF 平滑常數
+RAG_LEXICAL_MAX_DOCUMENTS = 32 # 範圍超過此文件數 (例如全庫提問) 時，關鍵字檢索只搜尋向量檢索命中的前幾個文件
+
+# 批次上傳與匯入：多個檔案或 zip 壓縮檔一次上傳，內容相同的檔案直接略過，小文件的區塊合併成完整的嵌入批次
+RAG_BULK_UPLOAD_MAX_FILES = 1000 # 單次批次上傳 (含 zip 展開後) 最多的檔案數
+RAG_BULK_UPLOAD_MAX_MEMBER_BYTES = 100 * 1024 * 1024 # zip 內單一檔案解壓後的大小上限
+RAG_BULK_INGEST_DOCUMENTS_PER_TASK = 50 # 每個批次匯入任務負責的小文件數 (多個任務可分散到不同 Worker)
+RAG_BULK_INGEST_COALESCE_MAX_BYTES = 2 * 1024 * 1024 # 超過此大小的檔案改以單一文件任務處理 (本身就能湊滿嵌入批次)
+DATA_UPLOAD_MAX_NUMBER_FILES = RAG_BULK_UPLOAD_MAX_FILES
+
+# 串流上傳 (僅 ASGI)：請求本文邊接收邊寫入磁碟並計算 SHA-256，不支援、格式不符、過大或重複的檔案在寫完之前就拒絕
+RAG_STREAM_UPLOAD_PATH = '/api/documents/stream/'
+RAG_STREAM_UPLOAD_TMP_DIR = os.path.join(MEDIA_ROOT, 'partial') # 接收中的暫存檔 (需與 MEDIA_ROOT 在同一檔案系統，完成後直接搬移)
+RAG_UPLOAD_MAX_BYTES = 1024 * 1024 * 1024 # 單一檔案的大小上限
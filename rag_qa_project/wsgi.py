@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'rag_qa_project.settings')
 
 application = get_wsgi_application()
+
+# 需在 Django 初始化之後匯入；語意搜尋在 Web 進程內計算嵌入，啟動時先載入模型，避免第一個請求等待
+from rag_app.registry import warm_up_web_process  # noqa: E402
+
+warm_up_web_process()